@@ -0,0 +1,78 @@
+'''
+Micro-benchmark: ParseDict payload encoding vs direct protobuf encoding
+
+run from the source directory: python -m benchmarks.payload_encoding
+'''
+from sparkplug_node_app import helpers, mqtt_functions
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag
+from typing import List
+import logging
+import time
+
+
+METRIC_COUNTS = [100, 10_000, 100_000]
+
+SAMPLE_VALUES = [
+    (SparkplugDataTypes.Int32, -1234),
+    (SparkplugDataTypes.Int64, 9_876_543_210),
+    (SparkplugDataTypes.Float, 3.1415),
+    (SparkplugDataTypes.Double, 2.718281828),
+    (SparkplugDataTypes.Boolean, True),
+    (SparkplugDataTypes.String, 'benchmark string value'),
+]
+
+
+def make_node(metric_count: int) -> SparkplugEdgeNode:
+    metrics = []
+    for idx in range(metric_count):
+        datatype, value = SAMPLE_VALUES[idx % len(SAMPLE_VALUES)]
+        metrics.append(SparkplugMemoryTag(
+            name=f'benchmark/Tag {idx}',
+            datatype=datatype,
+            initial_value=value,
+            writable=bool(idx % 2)
+        ))
+    brokers = [mqtt_functions.BrokerInfo(client_id='benchmark', host='localhost', port=1883, use_tls=False)]
+    return SparkplugEdgeNode(group_id='benchmark', edge_node_id='benchmark', brokers=brokers, metrics=metrics)
+
+
+def best_of(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+
+def run(metric_counts: List[int] = METRIC_COUNTS):
+    print(f'{"metrics":>8} {"form":>6} {"ParseDict ms":>14} {"direct ms":>11} {"speedup":>8} {"bytes":>10}')
+    for metric_count in metric_counts:
+        node = make_node(metric_count)
+        metrics = node.read_metrics(rbe=False)
+        timestamp = helpers.millis()
+        repeat = 5 if metric_count < 100_000 else 2
+
+        for birth in (False, True):
+            def parse_dict_path():
+                dicts = [metric.as_birth_metric() if birth else metric.as_rbe_metric() for metric in metrics]
+                return node.make_payload_from_metrics(dicts, timestamp=timestamp)
+
+            def direct_path():
+                return node.make_payload_from_metric_objects(metrics, birth=birth, timestamp=timestamp)
+
+            expected = parse_dict_path()
+            actual = direct_path()
+            if expected != actual:
+                raise AssertionError(f'Encoded payloads differ ({metric_count} metrics, birth={birth})')
+
+            parse_dict_time = best_of(parse_dict_path, repeat)
+            direct_time = best_of(direct_path, repeat)
+            print(f'{metric_count:>8} {"birth" if birth else "rbe":>6} {parse_dict_time * 1000:>14.1f} {direct_time * 1000:>11.1f} {parse_dict_time / direct_time:>7.1f}x {len(actual):>10}')
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    run()
@@ -1,5 +1,6 @@
 from sparkplug_node_app import env, logging
 from sparkplug_node_app import sparkplug, mqtt_functions
+from sparkplug_node_app.store_forward import StoreForwardConfig
 
 
 def on_set_client(node: sparkplug.SparkplugEdgeNode, mqtt_client: mqtt_functions.mqtt.Client):
@@ -13,7 +14,6 @@ string_tag = sparkplug.SparkplugMemoryTag(
     datatype=sparkplug.SparkplugDataTypes.String,
     initial_value='This is a writable string tag',
     writable=True,
-    disable_alias=True,
     persistence_file=env.MEMORY_TAGS_FILEPATH
 )
 
@@ -22,7 +22,6 @@ int_tag = sparkplug.SparkplugMemoryTag(
     datatype=sparkplug.SparkplugDataTypes.Int64,
     initial_value=2341,
     writable=True,
-    disable_alias=True,
     persistence_file=env.MEMORY_TAGS_FILEPATH
 )
 
@@ -31,7 +30,6 @@ float_tag = sparkplug.SparkplugMemoryTag(
     datatype=sparkplug.SparkplugDataTypes.Float,
     initial_value=3.1415,
     writable=True,
-    disable_alias=True,
     persistence_file=env.MEMORY_TAGS_FILEPATH
 )
 
@@ -56,7 +54,8 @@ edge_node = sparkplug.SparkplugEdgeNode(
     on_set_client=on_set_client,
     on_mqtt_connect=on_mqtt_connect,
     config_filepath=env.CONFIG_FILEPATH,
-    config_save_rate=20000
+    config_save_rate=20000,
+    store_forward=StoreForwardConfig(directory=env.STORE_FORWARD_DIRECTORY)
 )
 
 edge_node.loop_forever()
\ No newline at end of file
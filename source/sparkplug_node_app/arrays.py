@@ -0,0 +1,154 @@
+from array import array
+from functools import partial
+from typing import Callable, Dict
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # optional, NumPy arrays are then packed like any other buffer
+    np = None
+
+
+'''
+Sparkplug array datatypes travel as bytes_value: numeric elements packed little endian, BooleanArray as a
+little endian UInt32 count followed by the values packed into bits (first value in the high bit),
+StringArray as NUL terminated UTF-8 strings. Values are kept packed, so they compare as bytes
+'''
+TYPECODES = {
+    22: 'b', 23: 'h', 24: 'i', 25: 'q',  # Int8Array - Int64Array
+    26: 'B', 27: 'H', 28: 'I', 29: 'Q',  # UInt8Array - UInt64Array
+    30: 'f', 31: 'd',  # FloatArray, DoubleArray
+    34: 'q'  # DateTimeArray, epoch millis
+}
+BOOLEAN_ARRAY = 32
+STRING_ARRAY = 33
+
+_KINDS = {'b': 'i', 'h': 'i', 'i': 'i', 'l': 'i', 'q': 'i', 'B': 'u', 'H': 'u', 'I': 'u', 'L': 'u', 'Q': 'u', 'f': 'f', 'd': 'f'}
+_LITTLE = sys.byteorder == 'little'
+
+
+def _byte_order(view: memoryview, typecode: str):
+    '''little / big if the buffer holds typecode elements, raw if it holds bytes (already packed), None otherwise'''
+    fmt = view.format
+    order = sys.byteorder
+    if fmt[:1] in ('<', '>', '!', '=', '@'):
+        order = {'<': 'little', '>': 'big', '!': 'big'}.get(fmt[0], order)
+        fmt = fmt[1:]
+    if fmt in ('B', 'b', 'c') and view.itemsize == 1:
+        return 'raw'
+    if _KINDS.get(fmt) != _KINDS[typecode] or view.itemsize != array(typecode).itemsize:
+        return None
+    return order
+
+
+def _pack_ndarray(typecode: str, value) -> bytes:
+    '''NumPy array of another dtype, converted like the elements of a list (float to int is a TypeError, out of range an OverflowError)'''
+    dtype = np.dtype(typecode)
+    if value.dtype.kind not in ('biuf' if dtype.kind == 'f' else 'biu'):
+        raise TypeError(f'Cannot pack a {value.dtype} array as "{typecode}" elements!')
+    if dtype.kind != 'f' and value.size:
+        limits = np.iinfo(dtype)
+        if int(value.min()) < limits.min or int(value.max()) > limits.max:
+            raise OverflowError(f'Array values out of the "{typecode}" range [{limits.min}, {limits.max}]!')
+    return value.astype(dtype.newbyteorder('<'), casting='unsafe').tobytes()
+
+
+def _pack_numbers(typecode: str, value) -> bytes:
+    if isinstance(value, bytes):  # packed already (e.g. the bytes_value of an NCMD), kept as is
+        data = value
+    else:
+        data = None
+        try:
+            view = memoryview(value)
+        except TypeError:
+            view = None
+        order = None if view is None else _byte_order(view, typecode)
+        if order is not None:
+            data = view.tobytes()  # one copy, the caller may reuse its buffer for the next read
+            if order == 'big':
+                swapped = array(typecode)
+                swapped.frombytes(data)
+                swapped.byteswap()
+                data = swapped.tobytes()
+        elif np is not None and isinstance(value, np.ndarray):
+            data = _pack_ndarray(typecode, value)
+        else:
+            packed = array(typecode, value)
+            if not _LITTLE:
+                packed.byteswap()
+            data = packed.tobytes()
+    if len(data) % array(typecode).itemsize:
+        raise ValueError(f'Packed array of {len(data)} bytes does not hold whole "{typecode}" elements!')
+    return data
+
+
+def _pack_booleans(value) -> bytes:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = value if isinstance(value, bytes) else bytes(value)
+        if len(data) < 4 or len(data) != 4 + (int.from_bytes(data[:4], 'little') + 7) // 8:
+            raise ValueError('Packed BooleanArray length does not match its count!')
+        return data
+    if np is not None and isinstance(value, np.ndarray):
+        flags = value.astype(bool, copy=False).ravel()
+        return int(flags.size).to_bytes(4, 'little') + np.packbits(flags, bitorder='big').tobytes()
+    flags = [bool(flag) for flag in value]
+    bits = bytearray((len(flags) + 7) // 8)
+    for idx, flag in enumerate(flags):
+        if flag:
+            bits[idx >> 3] |= 0x80 >> (idx & 7)
+    return len(flags).to_bytes(4, 'little') + bytes(bits)
+
+
+def _pack_strings(value) -> bytes:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = value if isinstance(value, bytes) else bytes(value)
+        if data and not data.endswith(b'\x00'):
+            raise ValueError('Packed StringArray is not NUL terminated!')
+        return data
+    if isinstance(value, str):
+        raise TypeError('StringArray value must be a sequence of strings, not a string!')
+    encoded = []
+    for string in value:
+        if not isinstance(string, str) or '\x00' in string:
+            raise ValueError(f'Invalid StringArray element: {string!r}!')
+        encoded.append(string.encode('utf-8'))
+        encoded.append(b'\x00')
+    return b''.join(encoded)
+
+
+_PACKERS: Dict[int, Callable] = {datatype: partial(_pack_numbers, typecode) for datatype, typecode in TYPECODES.items()}
+_PACKERS[BOOLEAN_ARRAY] = _pack_booleans
+_PACKERS[STRING_ARRAY] = _pack_strings
+
+
+def array_packer(datatype: int) -> Callable[[object], bytes]:
+    '''
+    pack_array for one datatype: accepts packed bytes, buffers (array.array, NumPy arrays, memoryview) of the
+    element type, packed with one copy and no per element conversion, or any sequence of elements.
+    Raises TypeError / ValueError / OverflowError if the value does not fit the datatype
+    '''
+    return _PACKERS[datatype]
+
+
+def pack_array(datatype: int, value) -> bytes:
+    '''value packed as the bytes_value of an array datatype (see array_packer)'''
+    return _PACKERS[datatype](value)
+
+
+def unpack_array(datatype: int, data: bytes):
+    '''
+    Elements of a packed array: a read only memoryview over data for numeric datatypes
+    (an array.array on big endian hosts), a list of bools / strings for BooleanArray / StringArray
+    '''
+    if datatype == BOOLEAN_ARRAY:
+        count = int.from_bytes(data[:4], 'little')
+        return [bool(data[4 + (idx >> 3)] & (0x80 >> (idx & 7))) for idx in range(count)]
+    if datatype == STRING_ARRAY:
+        return [string.decode('utf-8') for string in bytes(data).split(b'\x00')[:-1]]
+    typecode = TYPECODES[datatype]
+    if _LITTLE:
+        return memoryview(data).cast(typecode)
+    elements = array(typecode)
+    elements.frombytes(data)
+    elements.byteswap()
+    return elements
@@ -0,0 +1,284 @@
+from sparkplug_node_app import helpers, mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugMetric
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import logging
+
+
+class AsyncioClientDriver:
+    '''
+    Runs a paho client's network IO on an asyncio event loop instead of paho's loop_start thread,
+    using paho's external event loop socket callbacks (see paho-mqtt examples/loop_asyncio.py)
+    '''
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt_functions.mqtt.Client) -> None:
+        self.__loop = loop
+        self.__client = client
+        self.__sock = None
+        self.__misc_task: Optional[asyncio.Task] = None
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_register_write
+        client.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    '''paho calls these from whichever thread drives it (the connect executor or the loop), so they hop onto the loop'''
+    def __on_socket_open(self, client, userdata, sock):
+        self.__call_soon(self.__add_reader, sock)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.__call_soon(self.__remove_socket, sock)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self.__call_soon(self.__loop.add_writer, sock, self.__client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self.__call_soon(self.__loop.remove_writer, sock)
+
+    def __call_soon(self, callback, *args):
+        if not self.__loop.is_closed():  # paho closes its sockets when the client is garbage collected
+            self.__loop.call_soon_threadsafe(callback, *args)
+
+    def __add_reader(self, sock):
+        self.__sock = sock
+        self.__loop.add_reader(sock, self.__client.loop_read)
+        if self.__misc_task is None or self.__misc_task.done():
+            self.__misc_task = self.__loop.create_task(self.__misc_loop())
+
+    def __remove_socket(self, sock):
+        self.__loop.remove_reader(sock)
+        self.__loop.remove_writer(sock)
+        if sock is self.__sock:
+            self.__sock = None
+        if self.__misc_task is not None:
+            self.__misc_task.cancel()
+            self.__misc_task = None
+
+    async def __misc_loop(self):
+        '''keepalive pings and retries, what loop_start does once per second'''
+        while self.__client.loop_misc() == mqtt_functions.mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def connect(self) -> bool:
+        '''Open the connection (blocking DNS / TCP connect runs on the default executor), False if it failed'''
+        try:
+            await self.__loop.run_in_executor(None, self.__client.reconnect)
+        except (OSError, ValueError) as err:
+            logging.warning(f'MQTT connect failed: {err}')
+            return False
+        return True
+
+    def close(self):
+        '''Drop the socket of a client that is being retired'''
+        sock = self.__client.socket()
+        if sock is not None:
+            self.__remove_socket(sock)
+            sock.close()
+
+
+class AsyncSparkplugEdgeNode(SparkplugEdgeNode):
+    '''
+    Edge node driven by an asyncio event loop: run with `await node.run_forever()`.
+    Metrics may have async read / write functions and on_read / on_write callbacks, they are awaited
+    concurrently (grouped by data_source like read_workers mode). Plain blocking reads run on the
+    read_workers executor (the loop's default executor if read_workers is not set), non blocking
+    reads (memory tags) run inline. The mqtt client runs on the same event loop.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__wake_event: Optional[asyncio.Event] = None
+        self.__drivers: Dict[int, AsyncioClientDriver] = {}
+        self.__pending_reads: Dict[object, asyncio.Task] = {}
+        self.__ncmd_tasks = set()
+        super().__init__(*args, **kwargs)
+
+    async def read_metrics_async(self, rbe: bool = True, scan_classes: Optional[Iterable[str]] = None) -> List[SparkplugMetric]:
+        '''
+        read_metrics() for the event loop, returns the metrics that should be published.
+        Reads that miss their timeout, or whose previous read is still running, are marked stale.
+        '''
+        loop = asyncio.get_running_loop()
+        groups: Dict[object, List[SparkplugMetric]] = {}
+        inline = []
+        for metric in self._scan_targets(scan_classes, rbe=rbe):
+            if not metric.is_async and not metric.blocking_read:
+                inline.append(metric)
+                continue
+            key = metric.data_source if metric.data_source is not None else id(metric)
+            groups.setdefault(key, []).append(metric)
+
+        now = helpers.monotonic_millis()
+        deadlines: Dict[asyncio.Task, int] = {}
+        tasks: Dict[asyncio.Task, List[SparkplugMetric]] = {}
+        progress: Dict[asyncio.Task, List[SparkplugMetric]] = {}
+        stale: List[SparkplugMetric] = []
+        for key, group in groups.items():
+            pending = self.__pending_reads.get(key)
+            if pending is not None and not pending.done():
+                logging.debug(f'Previous read of data source "{key}" still running, skipping it this scan')
+                stale.extend(group)
+                continue
+            units = self._read_units(group)
+            done_reading = []
+            task = loop.create_task(self.__read_group(loop, units, done_reading))
+            self.__pending_reads[key] = task
+            tasks[task] = group
+            progress[task] = done_reading
+            deadlines[task] = self._read_deadline(now, units)
+
+        for unit in self._read_units(inline):
+            unit.read()
+
+        read_ok: List[SparkplugMetric] = []
+        not_done = set(tasks)
+        while not_done:
+            timeout = (min(deadlines[task] for task in not_done) - helpers.monotonic_millis()) / 1000
+            done, not_done = await asyncio.wait(not_done, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                read_ok.extend(tasks[task])
+            now = helpers.monotonic_millis()
+            for task in [task for task in not_done if deadlines[task] <= now]:  # left running, the data source is skipped until it finishes
+                not_done.discard(task)
+                finished_ids = {id(metric) for metric in progress[task]}
+                read_ok.extend(progress[task])
+                stale.extend(metric for metric in tasks[task] if id(metric) not in finished_ids)
+
+        return self._collect_read_results(inline + read_ok, stale, rbe=rbe)
+
+    async def __read_group(self, loop: asyncio.AbstractEventLoop, units: list, done_reading: List[SparkplugMetric]):
+        for unit in units:
+            if unit.is_async:
+                await unit.async_read()
+            else:
+                await loop.run_in_executor(self._read_executor, unit.read)
+            if isinstance(unit, SparkplugMetric):
+                done_reading.append(unit)
+            else:
+                done_reading.extend(unit.metrics)
+
+    async def rbe(self, scan_classes: Optional[Iterable[str]] = None) -> List[SparkplugMetric]:
+        '''
+        Read the metrics of scan_classes (all of them if None), and publish the changed metrics as one NDATA
+        plus one DDATA per device (stored while offline), returns the published metrics
+        '''
+        metrics_to_publish = await self.read_metrics_async(scan_classes=scan_classes)
+        if metrics_to_publish:
+            logging.debug(f'{len(metrics_to_publish)} Values have changed, publish')
+            self._publish_changes(metrics_to_publish)
+        return metrics_to_publish
+
+    async def run_forever(self):
+        logging.info('Starting Edge Node asyncio loop!')
+        self.__loop = asyncio.get_running_loop()
+        self.__wake_event = asyncio.Event()
+        await self.read_metrics_async(rbe=False)  # NBIRTH is built from the last values read
+        scheduler = self._scheduler
+        try:
+            while True:
+                self._update_deadlines()
+                next_deadline = scheduler.next_deadline
+                timeout = None if next_deadline is None else max(next_deadline - helpers.monotonic_millis(), 0) / 1000
+                try:
+                    await asyncio.wait_for(self.__wake_event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wake_event.clear()
+                due = scheduler.pop_due()
+                forced = self._take_force_rbe()
+                scan_classes = self._take_due_scan_classes()
+                if scan_classes:
+                    logging.debug(f'Tag Read Due! (scan classes: {", ".join(sorted(scan_classes))})')
+                elif forced:
+                    logging.debug('RBE Forced!')
+                if scan_classes or forced:
+                    await self.rbe(scan_classes | forced)
+                if 'config_save' in due:
+                    logging.debug('Config Save Due!')
+                    await self.__loop.run_in_executor(None, self.save_config)
+                if 'replay' in due:
+                    self._replay_stored()
+                if 'batch' in due:
+                    self._publish_batches()
+                if 'sample' in due:
+                    await self.__sample(self._take_due_samples())
+        finally:
+            self._publish_batches(flush=True)
+            self.stop_client()
+            self.__loop = None
+            self.__wake_event = None
+
+    async def __sample(self, metrics: List[SparkplugMetric]):
+        '''Samples between scans, read like scans read (async, on the read executor if blocking, or inline)'''
+        pending = []
+        for metric in metrics:
+            if metric.is_async:
+                pending.append(metric.async_sample())
+            elif metric.blocking_read:
+                pending.append(self.__loop.run_in_executor(self._read_executor, metric.sample))
+            else:
+                metric.sample()
+        if pending:
+            await asyncio.gather(*pending)
+
+    '''
+    SparkplugEdgeNode hooks
+    '''
+    def _wake(self):
+        super()._wake()
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__wake_event.set)
+
+    def _request_rbe(self, scan_classes: Set[str]):
+        if self.__loop is not None:
+            self.force_rbe(scan_classes)
+        else:
+            super()._request_rbe(scan_classes)
+
+    def _birth_metrics(self, device=None) -> List[SparkplugMetric]:
+        '''Reads may be async, so NBIRTH / DBIRTH carry the values of the last scan'''
+        if self.__loop is None:
+            return super()._birth_metrics(device)
+        metrics = list(self.registry if device is None else device.metrics)
+        self._mark_published(metrics)
+        return metrics
+
+    def _process_ncmd(self, client: mqtt_functions.mqtt.Client, payload: sparkplug_pb2.Payload, device=None):
+        '''Writes are awaited in a task, the network IO of the loop is not held up by slow writes'''
+        if self.__loop is None:
+            return super()._process_ncmd(client, payload, device=device)
+        writes = self._split_group_writes(self._resolve_ncmd_writes(payload, device=device))
+        task = self.__loop.create_task(self.__write_ncmd(client, *writes, device=device))
+        self.__ncmd_tasks.add(task)
+        task.add_done_callback(self.__ncmd_tasks.discard)
+
+    async def __write_ncmd(self, client: mqtt_functions.mqtt.Client, writes: list, group_writes: list, device=None):
+        results = []
+        for metric_obj, new_value in writes:  # in NCMD order, a later write to the same metric wins
+            results.append((metric_obj, new_value, await metric_obj.async_write(new_value)))
+        for group, member_writes in group_writes:
+            successes = await group.async_write(member_writes)
+            results.extend((metric_obj, new_value, success) for (metric_obj, new_value), success in zip(member_writes, successes))
+        self._finish_ncmd(client, results, device=device)
+
+    def _run_client(self, client: mqtt_functions.mqtt.Client, broker: mqtt_functions.BrokerInfo):
+        if self.__loop is None:
+            return super()._run_client(client, broker)
+        driver = AsyncioClientDriver(self.__loop, client)
+        self.__drivers[id(client)] = driver
+        client.connect_async(
+            host=broker.host,
+            port=broker.port,
+            clean_start=True
+        )
+        self.__loop.create_task(self.__connect(client, driver))
+
+    async def __connect(self, client: mqtt_functions.mqtt.Client, driver: AsyncioClientDriver):
+        if not await driver.connect() and client is self.client:
+            self._connect_attempt_failed()
+
+    def _stop_client_loop(self, client: mqtt_functions.mqtt.Client):
+        driver = self.__drivers.pop(id(client), None)
+        if driver is None:
+            return super()._stop_client_loop(client)
+        # give a queued NDEATH / DISCONNECT a moment to go out before dropping the socket
+        self.__loop.call_later(1, driver.close)
@@ -0,0 +1,145 @@
+from sparkplug_node_app import helpers
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.publish_tracker import LatencyHistogram
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Tuple
+import threading
+
+
+@dataclass(frozen=True, kw_only=True)
+class BatchConfig:
+    max_latency: int = 100  # ms a change may wait for others to join its NDATA / DDATA
+    max_bytes: int = 64 * 1024  # a batch this large (estimated encoded size) is published right away
+    history: bool = False  # keep every sample of a metric in the batch, not only the latest
+
+    def __post_init__(self):
+        if self.max_latency < 0 or self.max_bytes <= 0:
+            raise ValueError('BatchConfig max_latency cannot be negative and max_bytes must be positive!')
+
+
+class BatchStats:
+    '''Size of the published batches (metrics, bytes) and the latency batching added to their first change'''
+    def __init__(self) -> None:
+        self.batches = 0
+        self.samples = 0  # metric samples added
+        self.merged = 0  # samples replaced by a later sample of the same metric
+        self.metrics = 0  # metrics published
+        self.bytes = 0
+        self.max_metrics = 0
+        self.max_bytes = 0
+        self.size_flushes = 0  # batches published early because they reached max_bytes
+        self.added_latency = LatencyHistogram()
+
+    def record(self, metrics: int, size: int, latency: int, by_size: bool):
+        self.batches += 1
+        self.metrics += metrics
+        self.bytes += size
+        self.max_metrics = max(self.max_metrics, metrics)
+        self.max_bytes = max(self.max_bytes, size)
+        if by_size:
+            self.size_flushes += 1
+        self.added_latency.record(latency)
+
+    def as_dict(self) -> dict:
+        return {
+            'batches': self.batches,
+            'samples': self.samples,
+            'merged': self.merged,
+            'metrics': self.metrics,
+            'bytes': self.bytes,
+            'mean_metrics': round(self.metrics / self.batches, 1) if self.batches else 0.0,
+            'max_metrics': self.max_metrics,
+            'max_bytes': self.max_bytes,
+            'size_flushes': self.size_flushes,
+            'added_latency': self.added_latency.as_dict()
+        }
+
+
+class _Batch:
+    def __init__(self, started: int) -> None:
+        self.started = started
+        self.size = 0
+        self.samples: Dict[Hashable, sparkplug_pb2.Payload.Metric] = {}
+        self.history: List[sparkplug_pb2.Payload.Metric] = []
+
+
+class PublishBatcher:
+    '''
+    Coalesces the NDATA / DDATA of a topic over a window: a batch is published max_latency ms after its first change,
+    or as soon as it reaches max_bytes, so bursts of scans and writes go out as one message.
+    Only the latest sample of a metric is kept unless history is set. Safe to use from any thread
+    '''
+    def __init__(self, config: BatchConfig) -> None:
+        self.__config = config
+        self.__lock = threading.Lock()
+        self.__batches: Dict[str, _Batch] = {}
+        self.__stats = BatchStats()
+
+    @property
+    def config(self) -> BatchConfig:
+        return self.__config
+
+    @property
+    def stats(self) -> BatchStats:
+        return self.__stats
+
+    def add(self, topic: str, keys: List[Hashable], payload: sparkplug_pb2.Payload) -> bool:
+        '''
+        Add the metrics of payload (keys[i] identifies the metric of payload.metrics[i], None for an entry that is never replaced),
+        True if the batch of topic is full
+        '''
+        with self.__lock:
+            batch = self.__batches.get(topic)
+            if batch is None:
+                batch = self.__batches[topic] = _Batch(helpers.monotonic_millis())
+            self.__stats.samples += len(keys)
+            for key, metric in zip(keys, payload.metrics):
+                batch.size += metric.ByteSize() + 4  # field tag and length
+                if self.__config.history:
+                    batch.history.append(metric)
+                    continue
+                if key is None:
+                    key = object()
+                previous = batch.samples.pop(key, None)  # the latest sample moves behind the entries added since
+                if previous is not None:
+                    self.__stats.merged += 1
+                    batch.size -= previous.ByteSize() + 4
+                    if previous.HasField('properties') and not metric.HasField('properties'):
+                        metric.properties.CopyFrom(previous.properties)  # keep a Quality change the replaced sample carried
+                batch.samples[key] = metric
+            return batch.size >= self.__config.max_bytes
+
+    @property
+    def next_deadline(self) -> Optional[int]:
+        '''Monotonic millis at which the oldest batch is due, None if nothing is waiting'''
+        with self.__lock:
+            if not self.__batches:
+                return None
+            return min(batch.started for batch in self.__batches.values()) + self.__config.max_latency
+
+    def take(self, topic: str) -> Optional[sparkplug_pb2.Payload]:
+        '''The batch of topic as one payload, published now because it is full'''
+        with self.__lock:
+            batch = self.__batches.pop(topic, None)
+            return None if batch is None else self.__payload(batch, by_size=True)
+
+    def take_due(self, now: Optional[int] = None, flush: bool = False) -> List[Tuple[str, sparkplug_pb2.Payload]]:
+        '''(topic, payload) of the batches whose window ended (all of them if flush)'''
+        now = helpers.monotonic_millis() if now is None else now
+        with self.__lock:
+            due = [topic for topic, batch in self.__batches.items() if flush or batch.started + self.__config.max_latency <= now]
+            return [(topic, self.__payload(self.__batches.pop(topic), by_size=False)) for topic in due]
+
+    def clear(self) -> int:
+        '''Drop the waiting batches (an NBIRTH supersedes them), returns the number of metrics dropped'''
+        with self.__lock:
+            dropped = sum(len(batch.history) + len(batch.samples) for batch in self.__batches.values())
+            self.__batches.clear()
+            return dropped
+
+    def __payload(self, batch: _Batch, by_size: bool) -> sparkplug_pb2.Payload:
+        payload = sparkplug_pb2.Payload()
+        payload.timestamp = helpers.millis()
+        payload.metrics.extend(batch.history if self.__config.history else batch.samples.values())
+        self.__stats.record(len(payload.metrics), batch.size, helpers.monotonic_millis() - batch.started, by_size)
+        return payload
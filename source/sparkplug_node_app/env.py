@@ -22,4 +22,6 @@ DATA_DIRECTORY = environ.get('DATA_DIRECTORY', default=f'/etc/sparkplug/{SPARKPL
 
 CONFIG_FILEPATH = environ.get('CONFIG_FILEPATH', default=f'{DATA_DIRECTORY}config.json')
 
-MEMORY_TAGS_FILEPATH = environ.get('MEMORY_TAGS_FILEPATH', default=f'{DATA_DIRECTORY}memory-tags.json')
\ No newline at end of file
+MEMORY_TAGS_FILEPATH = environ.get('MEMORY_TAGS_FILEPATH', default=f'{DATA_DIRECTORY}memory-tags.json')
+
+STORE_FORWARD_DIRECTORY = environ.get('STORE_FORWARD_DIRECTORY', default=f'{DATA_DIRECTORY}store-forward/')
\ No newline at end of file
@@ -0,0 +1,83 @@
+from sparkplug_node_app import helpers
+from dataclasses import dataclass
+from collections import deque
+from typing import List, Optional
+import random
+
+
+@dataclass(frozen=True, kw_only=True)
+class FailoverConfig:
+    connect_timeout: int = 10_000  # ms for a connection attempt to be acknowledged before trying the next broker
+    backoff_initial: int = 1_000
+    backoff_max: int = 60_000
+    backoff_multiplier: float = 2.0
+    backoff_jitter: float = 0.2  # +/- fraction of the delay
+    primary_check_rate: int = 60_000  # ms between attempts to get back to the primary broker
+    standby: bool = False  # keep a connection open to the next broker for fast switchover
+
+
+class Backoff:
+    '''Exponential backoff with jitter, delays in milliseconds'''
+    def __init__(self, initial: int, maximum: int, multiplier: float = 2.0, jitter: float = 0.2) -> None:
+        self.__initial = initial
+        self.__maximum = maximum
+        self.__multiplier = multiplier
+        self.__jitter = jitter
+        self.__attempts = 0
+
+    def next_delay(self) -> int:
+        delay = min(self.__maximum, self.__initial * self.__multiplier ** self.__attempts)
+        self.__attempts += 1
+        return int(delay * (1 + random.uniform(-self.__jitter, self.__jitter)))
+
+    def reset(self):
+        self.__attempts = 0
+
+    @property
+    def attempts(self) -> int:
+        return self.__attempts
+
+
+class FailoverStats:
+    '''Counters and per transition timings of the broker connection'''
+    def __init__(self, history: int = 100) -> None:
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.failovers = 0
+        self.fallbacks = 0
+        self.standby_promotions = 0
+        self.__transitions = deque(maxlen=history)
+
+    def record_transition(self, from_broker: Optional[str], to_broker: str, reason: str, offline_millis: int):
+        '''reason is one of "connect", "reconnect", "failover", "fallback"'''
+        if reason == 'failover':
+            self.failovers += 1
+        elif reason == 'fallback':
+            self.fallbacks += 1
+        self.__transitions.append({
+            'timestamp': helpers.millis(),
+            'from': from_broker,
+            'to': to_broker,
+            'reason': reason,
+            'offline_millis': offline_millis
+        })
+
+    @property
+    def transitions(self) -> List[dict]:
+        return list(self.__transitions)
+
+    @property
+    def last_transition(self) -> Optional[dict]:
+        return self.__transitions[-1] if self.__transitions else None
+
+    def as_dict(self) -> dict:
+        return {
+            'connect_attempts': self.connect_attempts,
+            'connect_failures': self.connect_failures,
+            'disconnects': self.disconnects,
+            'failovers': self.failovers,
+            'fallbacks': self.fallbacks,
+            'standby_promotions': self.standby_promotions,
+            'last_transition': self.last_transition
+        }
@@ -1,9 +1,58 @@
-from time import time
+from time import time, monotonic, perf_counter
+import json
+import os
 
 def millis() -> int:
     return int(time() * 1000)
 
 
+def monotonic_millis() -> int:
+    '''Milliseconds from a clock that never goes backwards, use for intervals and deadlines'''
+    return int(monotonic() * 1000)
+
+
+def perf_millis() -> float:
+    '''High resolution milliseconds for timing code, only meaningful as a difference'''
+    return perf_counter() * 1000
+
+
+class PhaseTimer:
+    '''Records how long consecutive named phases take, in milliseconds'''
+    def __init__(self):
+        self.__timings = {}
+        self.__last = perf_millis()
+
+    def lap(self, phase: str) -> float:
+        now = perf_millis()
+        self.__timings[phase] = now - self.__last
+        self.__last = now
+        return self.__timings[phase]
+
+    def add(self, phase: str, millis: float):
+        '''Record a phase that was timed elsewhere'''
+        self.__timings[phase] = millis
+
+    @property
+    def timings(self) -> dict:
+        return dict(self.__timings)
+
+    def __str__(self) -> str:
+        return ', '.join(f'{phase}: {millis:.1f}ms' for phase, millis in self.__timings.items())
+
+
+def atomic_write_json(filepath: str, data, indent: int = None):
+    '''Write json to a temp file next to filepath then rename it over filepath, readers never see a partial file'''
+    directory_path = os.path.dirname(filepath)
+    if directory_path:
+        os.makedirs(directory_path, exist_ok=True)
+    temp_filepath = f'{filepath}.tmp'
+    with open(temp_filepath, 'w', newline='') as file:
+        json.dump(data, file, indent=indent)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filepath, filepath)
+
+
 class Incrementor:
     def __init__(self, step: int = 1, maximum: int = None):
         self.__count = 0
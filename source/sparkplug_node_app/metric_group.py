@@ -0,0 +1,252 @@
+from sparkplug_node_app import helpers
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+from types import CoroutineType
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+import inspect
+import logging
+
+
+class MetricGroup:
+    '''
+    Bulk metric source: one read_function() call per scan feeds all the member metrics (add_metric),
+    which are stamped with the same read timestamp. The writes of one NCMD to several members
+    go to write_function in one call.
+
+    read_function() returns the values of the members indexed by their key: a dict (keys are the member names
+    unless given), or a list / tuple for integer keys (e.g. the registers of a PLC block read).
+    A member whose key is missing, or whose value does not fit its datatype, fails its read.
+
+    write_function(values) gets a dict key -> value and returns a success flag for all of them,
+    or a dict key -> success flag.
+
+    Members share the group's data_source (the group name if not set), read_timeout and scan_class,
+    so concurrent reads keep the group on one worker. read_function / write_function may be coroutine functions,
+    such groups are read with async_read() (see AsyncSparkplugEdgeNode)
+    '''
+    def __init__(
+        self,
+        name: str,
+        read_function: Callable,
+        write_function: Optional[Callable] = None,
+        data_source: Optional[str] = None,
+        read_timeout: Optional[int] = None,
+        scan_class: Optional[str] = None
+    ) -> None:
+        self.__name = name
+        self.__read_fn = read_function
+        self.__write_fn = write_function
+        self.__data_source = data_source if data_source is not None else name
+        self.__read_timeout = read_timeout
+        self.__scan_class = scan_class
+        self.__metrics: List['GroupMetric'] = []
+        self.__last_read_ok = False
+        self.__failed: Set[int] = set()  # ids of the members that failed the last read
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def read_function(self) -> Callable:
+        return self.__read_fn
+
+    @property
+    def write_function(self) -> Optional[Callable]:
+        return self.__write_fn
+
+    @property
+    def data_source(self) -> str:
+        return self.__data_source
+
+    @property
+    def read_timeout(self) -> Optional[int]:
+        return self.__read_timeout
+
+    @property
+    def scan_class(self) -> Optional[str]:
+        return self.__scan_class
+
+    @property
+    def metrics(self) -> List['GroupMetric']:
+        return self.__metrics
+
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.__read_fn) or inspect.iscoroutinefunction(self.__write_fn)
+
+    @property
+    def last_read_ok(self) -> bool:
+        '''True if the last read_function call succeeded'''
+        return self.__last_read_ok
+
+    def member_ok(self, metric: 'GroupMetric') -> bool:
+        '''True if metric got a value from the last read'''
+        return self.__last_read_ok and id(metric) not in self.__failed
+
+    def add_metric(self, name: str, datatype: SparkplugDataTypes, key: Optional[Hashable] = None, writable: bool = False, **kwargs) -> 'GroupMetric':
+        '''
+        Create a member metric, its value is read_function()[key] (key defaults to the name).
+        kwargs are the other SparkplugMetric arguments (alias, disable_alias, rbe_ignore, rbe_policy, on_read, on_write)
+        '''
+        if writable and self.__write_fn is None:
+            raise ValueError(f'Metric group "{self.__name}" has no write_function, "{name}" cannot be writable!')
+        metric = GroupMetric(self, name if key is None else key, name, datatype, writable=writable, **kwargs)
+        self.__metrics.append(metric)
+        return metric
+
+    def read(self) -> bool:
+        '''Read all the members with one read_function call, False if the call failed (every member failed)'''
+        try:
+            values = self.__read_fn()
+            if isinstance(values, CoroutineType):
+                values.close()
+                raise TypeError(f'Metric group "{self.__name}" has an async read function, use async_read()')
+        except Exception as err:
+            logging.debug(f'Read of metric group "{self.__name}" failed: {err}')
+            values = None
+        for metric, success in self.__fan_out(values):
+            if metric.on_read:
+                metric.on_read(metric_obj=metric, current_value=metric.current_value, success=success)
+        return self.__last_read_ok
+
+    async def async_read(self) -> bool:
+        '''read() for use on an event loop, read_function and the members' on_read may return awaitables'''
+        try:
+            values = self.__read_fn()
+            if inspect.isawaitable(values):
+                values = await values
+        except Exception as err:
+            logging.debug(f'Read of metric group "{self.__name}" failed: {err}')
+            values = None
+        for metric, success in self.__fan_out(values):
+            if metric.on_read:
+                result = metric.on_read(metric_obj=metric, current_value=metric.current_value, success=success)
+                if inspect.isawaitable(result):
+                    await result
+        return self.__last_read_ok
+
+    def __fan_out(self, values) -> List[Tuple['GroupMetric', bool]]:
+        '''Store the members' values with one timestamp, (metric, success) per member'''
+        self.__last_read_ok = values is not None
+        self.__failed = set()
+        if values is None:
+            return [(metric, False) for metric in self.__metrics]
+        millis = helpers.millis()
+        results = []
+        for metric in self.__metrics:
+            try:
+                success = metric.store_read(values[metric.key], millis)
+            except (KeyError, IndexError, TypeError):
+                success = False
+            if not success:
+                self.__failed.add(id(metric))
+            results.append((metric, success))
+        return results
+
+    def write(self, writes: List[Tuple['GroupMetric', object]]) -> List[bool]:
+        '''Write (member, value) pairs with one write_function call, a success flag per pair (a later write to the same member wins)'''
+        values, results = self.__prepare_writes(writes)
+        if values:
+            try:
+                outcome = self.__write_fn(values)
+                if isinstance(outcome, CoroutineType):
+                    outcome.close()
+                    raise TypeError(f'Metric group "{self.__name}" has an async write function, use async_write()')
+            except Exception as err:
+                logging.debug(f'Write to metric group "{self.__name}" failed: {err}')
+                outcome = False
+            self.__apply_outcome(writes, results, outcome)
+        for (metric, value), success in zip(writes, results):
+            if metric.on_write:
+                metric.on_write(metric_obj=metric, value_written=value, success=success)
+        return results
+
+    async def async_write(self, writes: List[Tuple['GroupMetric', object]]) -> List[bool]:
+        '''write() for use on an event loop, write_function and the members' on_write may return awaitables'''
+        values, results = self.__prepare_writes(writes)
+        if values:
+            try:
+                outcome = self.__write_fn(values)
+                if inspect.isawaitable(outcome):
+                    outcome = await outcome
+            except Exception as err:
+                logging.debug(f'Write to metric group "{self.__name}" failed: {err}')
+                outcome = False
+            self.__apply_outcome(writes, results, outcome)
+        for (metric, value), success in zip(writes, results):
+            if metric.on_write:
+                result = metric.on_write(metric_obj=metric, value_written=value, success=success)
+                if inspect.isawaitable(result):
+                    await result
+        return results
+
+    def __prepare_writes(self, writes: List[Tuple['GroupMetric', object]]) -> Tuple[Dict[Hashable, object], List[bool]]:
+        '''(key -> coerced value for write_function, success flags with False for the writes that cannot be made)'''
+        values: Dict[Hashable, object] = {}
+        results = []
+        for metric, value in writes:
+            if metric.group is not self or not metric.writable:
+                results.append(False)
+                continue
+            try:
+                values[metric.key] = metric.column.coerce_fn(value)
+            except (TypeError, ValueError):
+                results.append(False)
+                continue
+            results.append(None)  # decided by write_function
+        return values, results
+
+    @staticmethod
+    def __apply_outcome(writes: List[Tuple['GroupMetric', object]], results: List[Optional[bool]], outcome):
+        for idx, (metric, value) in enumerate(writes):
+            if results[idx] is not None:
+                continue
+            if isinstance(outcome, dict):
+                results[idx] = bool(outcome.get(metric.key, False))
+            else:
+                results[idx] = bool(outcome)
+
+
+class GroupMetric(SparkplugMetric):
+    '''Member of a MetricGroup: reading it reads the whole group, writing it goes through the group's write_function'''
+    __slots__ = ('__group', '__key')
+
+    def __init__(self, group: MetricGroup, key: Hashable, name: str, datatype: SparkplugDataTypes, writable: bool = False, **kwargs) -> None:
+        self.__group = group
+        self.__key = key
+        super().__init__(
+            name=name,
+            datatype=datatype,
+            read_function=group.read_function,
+            write_function=group.write_function if writable else None,
+            data_source=group.data_source,
+            read_timeout=group.read_timeout,
+            scan_class=group.scan_class,
+            **kwargs
+        )
+
+    @property
+    def group(self) -> MetricGroup:
+        return self.__group
+
+    @property
+    def key(self) -> Hashable:
+        return self.__key
+
+    def read(self) -> bool:
+        self.__group.read()
+        return self.__group.member_ok(self)
+
+    async def async_read(self) -> bool:
+        await self.__group.async_read()
+        return self.__group.member_ok(self)
+
+    def write(self, value) -> bool:
+        if not self.writable:
+            return False
+        return self.__group.write([(self, value)])[0]
+
+    async def async_write(self, value) -> bool:
+        if not self.writable:
+            return False
+        return (await self.__group.async_write([(self, value)]))[0]
@@ -0,0 +1,507 @@
+from sparkplug_node_app.rbe import RbePolicy
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+import operator
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # optional, columns then compare buffers and loop in Python
+    np = None
+
+
+def diff_rows(current: bytes, previous: bytes, itemsize: int, block_rows: int = 512) -> List[int]:
+    '''Rows whose itemsize wide cells differ between two equally long buffers, equal blocks are skipped with one compare'''
+    rows = []
+    step = itemsize * block_rows
+    for start in range(0, len(current), step):
+        end = min(start + step, len(current))
+        if current[start:end] == previous[start:end]:
+            continue
+        for offset in range(start, end, itemsize):
+            if current[offset:offset + itemsize] != previous[offset:offset + itemsize]:
+                rows.append(offset // itemsize)
+    return rows
+
+
+def ints_to_uints(values, bit_size: int = 32) -> list:
+    '''Bulk SparkplugMetric.int_to_uint: a list of ints, or an int64 NumPy array (converted without a Python loop)'''
+    if np is not None and isinstance(values, np.ndarray):
+        if bit_size == 64:
+            return values.view(np.uint64).tolist()
+        return np.where(values < 0, values + 2 ** bit_size, values).tolist()
+    max_uint = 2 ** bit_size
+    return [(max_uint + value if value < 0 else value) if isinstance(value, int) else None for value in values]
+
+
+class MetricColumn:
+    '''
+    Values of all the metrics of one datatype: current value, previous value, read timestamp and alias per row,
+    plus the RBE state (last published value and time). Numeric and boolean datatypes are kept in typed arrays
+    (None as a null flag), the others in lists, array datatypes as their packed bytes. With NumPy, change detection, RbePolicy evaluation and
+    payload value conversion run over the typed arrays without a Python loop per row
+    '''
+    TYPECODES = {
+        1: 'q', 2: 'q', 3: 'q', 4: 'q',  # Int8 - Int64
+        5: 'q', 6: 'q', 7: 'q',  # UInt8 - UInt32, UInt64 does not fit a signed array and is kept in a list
+        9: 'd', 10: 'd',  # Float, Double (Float is kept as a double so values compare as read)
+        11: 'b'  # Boolean
+    }
+    NO_ALIAS = -1
+    NEVER = -1  # published millis of a row that was never published
+    NUMPY_MIN_ROWS = 64  # below this the per call overhead of NumPy outweighs the Python loop
+
+    def __init__(self, datatype, lock: threading.Lock, track_owners: bool = True, use_numpy: bool = False) -> None:
+        self.__datatype = datatype
+        self.__value_key = datatype.value_key
+        self.__coerce_fn = datatype.coerce_fn
+        self.__lock = lock
+        self.__typecode = self.TYPECODES.get(datatype.value)
+        if self.__typecode is not None:
+            self.__values = array(self.__typecode)
+            self.__previous = array(self.__typecode)
+            self.__published = array(self.__typecode)
+            self.__convert: Callable = float if self.__typecode == 'd' else (bool if self.__typecode == 'b' else operator.index)
+        else:
+            self.__values = []
+            self.__previous = []
+            self.__published = []
+            self.__convert = self.__coerce_fn if datatype.is_array else None  # arrays are kept packed, they compare as bytes
+        self.__nulls = bytearray()
+        self.__previous_nulls = bytearray()
+        self.__published_nulls = bytearray()
+        self.__published_millis = array('q')
+        self.__timestamps = array('q')
+        self.__aliases = array('q')
+        self.__touched = bytearray()  # read since the last collect()
+        self.__policies: Dict[int, RbePolicy] = {}  # rows with an RbePolicy
+        self.__policy_arrays: Optional[tuple] = None  # NumPy form of __policies, rebuilt when it changes
+        self.__owners: Optional[list] = [] if track_owners else None
+        self.__free: List[int] = []
+        self.__numpy = use_numpy and np is not None and self.__typecode is not None
+
+    @property
+    def datatype(self):
+        return self.__datatype
+
+    @property
+    def value_key(self) -> str:
+        return self.__value_key
+
+    @property
+    def coerce_fn(self):
+        return self.__coerce_fn
+
+    @property
+    def typed(self) -> bool:
+        '''True if the values are kept in typed arrays'''
+        return self.__typecode is not None
+
+    @property
+    def vectorized(self) -> bool:
+        '''True if the column runs its whole column operations with NumPy'''
+        return self.__numpy
+
+    @property
+    def values(self):
+        return self.__values
+
+    @property
+    def previous(self):
+        return self.__previous
+
+    @property
+    def nulls(self) -> bytearray:
+        return self.__nulls
+
+    @property
+    def previous_nulls(self) -> bytearray:
+        return self.__previous_nulls
+
+    @property
+    def timestamps(self) -> array:
+        return self.__timestamps
+
+    @property
+    def aliases(self) -> array:
+        return self.__aliases
+
+    def __len__(self) -> int:
+        return len(self.__timestamps) - len(self.__free)
+
+    def allocate(self, owner=None, policy: Optional[RbePolicy] = None) -> int:
+        if self.__free:
+            row = self.__free.pop()
+        else:
+            row = len(self.__timestamps)
+            empty = 0 if self.typed else None
+            self.__values.append(empty)
+            self.__previous.append(empty)
+            self.__published.append(empty)
+            self.__nulls.append(1)
+            self.__previous_nulls.append(1)
+            self.__published_nulls.append(1)
+            self.__published_millis.append(self.NEVER)
+            self.__timestamps.append(0)
+            self.__aliases.append(self.NO_ALIAS)
+            self.__touched.append(0)
+            if self.__owners is not None:
+                self.__owners.append(None)
+        if policy is not None:
+            self.__policies[row] = policy
+            self.__policy_arrays = None
+        if self.__owners is not None:
+            self.__owners[row] = owner
+        return row
+
+    def release(self, row: int):
+        with self.__lock:
+            empty = 0 if self.typed else None
+            self.__values[row] = empty
+            self.__previous[row] = empty
+            self.__published[row] = empty
+            self.__nulls[row] = 1
+            self.__previous_nulls[row] = 1
+            self.__published_nulls[row] = 1
+            self.__published_millis[row] = self.NEVER
+            self.__timestamps[row] = 0
+            self.__aliases[row] = self.NO_ALIAS
+            self.__touched[row] = 0
+            if self.__policies.pop(row, None) is not None:
+                self.__policy_arrays = None
+            if self.__owners is not None:
+                self.__owners[row] = None
+            self.__free.append(row)
+
+    def get(self, row: int):
+        if self.__nulls[row]:
+            return None
+        value = self.__values[row]
+        return bool(value) if self.__typecode == 'b' else value
+
+    def get_previous(self, row: int):
+        if self.__previous_nulls[row]:
+            return None
+        value = self.__previous[row]
+        return bool(value) if self.__typecode == 'b' else value
+
+    def get_published(self, row: int):
+        if self.__published_nulls[row]:
+            return None
+        value = self.__published[row]
+        return bool(value) if self.__typecode == 'b' else value
+
+    def store(self, row: int, value, millis: int):
+        '''
+        Shift the current value of row to previous and store value read at millis.
+        Raises TypeError / ValueError / OverflowError (and keeps the row as is) if value does not fit the column.
+        Lock free (this is the hot path of every read): the touched flag is set last, collect() swaps the touched
+        buffer, so a store racing a collect is picked up by that collect or the next one
+        '''
+        null = value is None
+        if null:
+            value = 0 if self.__typecode is not None else None
+        elif self.__convert is not None:
+            value = self.__convert(value)
+        current = self.__values[row]
+        self.__values[row] = value
+        self.__previous[row] = current
+        self.__previous_nulls[row] = self.__nulls[row]
+        self.__nulls[row] = null
+        self.__timestamps[row] = millis
+        self.__touched[row] = 1
+
+    def copy_row(self, row: int, source: 'MetricColumn', source_row: int):
+        with self.__lock:
+            self.__values[row] = source.values[source_row]
+            self.__previous[row] = source.previous[source_row]
+            self.__nulls[row] = source.nulls[source_row]
+            self.__previous_nulls[row] = source.previous_nulls[source_row]
+            self.__timestamps[row] = source.timestamps[source_row]
+            self.__aliases[row] = source.aliases[source_row]
+            self.__published[row] = source.__published[source_row]
+            self.__published_nulls[row] = source.__published_nulls[source_row]
+            self.__published_millis[row] = source.__published_millis[source_row]
+
+    def mark_published(self, row: int, now: int):
+        '''Remember the current value of row as published at now (monotonic millis), the reference of its RbePolicy'''
+        self.__published[row] = self.__values[row]
+        self.__published_nulls[row] = self.__nulls[row]
+        self.__published_millis[row] = now
+
+    def row_changed(self, row: int) -> bool:
+        '''Current value of row differs from the previous one, NaN to NaN is not a change (same as changed_rows)'''
+        if self.__nulls[row] != self.__previous_nulls[row]:
+            return True
+        value, previous = self.__values[row], self.__previous[row]
+        if self.__typecode == 'd':
+            return value != previous and (value == value or previous == previous)
+        return value != previous
+
+    def rbe_due(self, row: int, now: int, policy: Optional[RbePolicy]) -> bool:
+        '''
+        True if the current value of row should be published: row_changed filtered by policy,
+        which compares against the last published value (see mark_published). now is monotonic millis
+        '''
+        if policy is None:
+            return self.row_changed(row)
+        published_millis = self.__published_millis[row]
+        if published_millis == self.NEVER:
+            return True
+        elapsed = now - published_millis
+        if policy.max_silence is not None and elapsed >= policy.max_silence:
+            return True
+        if policy.min_interval is not None and elapsed < policy.min_interval:
+            return False
+        value, published = self.get(row), self.get_published(row)
+        if value == published:
+            return False
+        if self.typed and value is not None and published is not None:
+            delta = abs(value - published)
+            if policy.deadband is not None and delta <= policy.deadband:
+                return False
+            if policy.deadband_percent is not None and delta <= abs(published) * policy.deadband_percent / 100:
+                return False
+        return True
+
+    def changed_rows(self) -> List[int]:
+        '''Rows whose current value differs from the previous one, compared a whole column at a time'''
+        if self.__numpy:
+            return np.flatnonzero(self.__changed_mask()).tolist()
+        if self.typed:
+            current, previous = self.__values.tobytes(), self.__previous.tobytes()
+            rows = [] if current == previous else diff_rows(current, previous, self.__values.itemsize)
+        elif self.__values == self.__previous:
+            rows = []
+        else:
+            rows = [row for row, (value, previous) in enumerate(zip(self.__values, self.__previous)) if value != previous]
+        if self.__nulls != self.__previous_nulls:
+            rows = sorted(set(rows).union(diff_rows(bytes(self.__nulls), bytes(self.__previous_nulls), 1)))
+        return rows
+
+    def collect(self, now: int) -> Tuple[List[int], int]:
+        '''
+        Rows read since the last collect that are due for publishing (see rbe_due), and the number of changed rows
+        held back by their RbePolicy. Clears the touched flags
+        '''
+        with self.__lock:
+            touched = self.__touched
+            touched_count = touched.count(1)
+            if not touched_count:
+                return [], 0
+            self.__touched = bytearray(len(touched))
+            if touched_count * 32 < len(touched):  # few reads, check the touched rows one by one
+                rows = []
+                row = touched.find(1)
+                while row != -1:
+                    rows.append(row)
+                    row = touched.find(1, row + 1)
+                policy_rows = [row for row in rows if row in self.__policies]
+                if policy_rows:
+                    rows = [row for row in rows if row not in self.__policies and self.row_changed(row)]
+                else:
+                    return [row for row in rows if self.row_changed(row)], 0
+            elif self.__numpy:
+                touched_mask = np.frombuffer(touched, dtype=np.uint8) != 0
+                mask = self.__changed_mask() & touched_mask
+                policy_rows = []
+                if self.__policies:
+                    all_policy_rows = self.__policy_arrays_cached()[0]
+                    policy_rows = all_policy_rows[touched_mask[all_policy_rows]].tolist()
+                    mask[all_policy_rows] = False
+                rows = np.flatnonzero(mask).tolist()
+            else:
+                rows = [row for row in self.changed_rows() if touched[row] and row not in self.__policies]
+                policy_rows = [row for row in self.__policies if touched[row]]
+            due, suppressed = self.__policy_due(policy_rows, now)
+            rows.extend(due)
+            return rows, suppressed
+
+    def __policy_due(self, rows: List[int], now: int) -> Tuple[List[int], int]:
+        '''(rows with an RbePolicy that are due, number of the others whose value changed)'''
+        if not rows:
+            return [], 0
+        if not self.__numpy or len(rows) < self.NUMPY_MIN_ROWS:
+            due = [row for row in rows if self.rbe_due(row, now, self.__policies[row])]
+            due_set = set(due)
+            return due, sum(1 for row in rows if row not in due_set and self.row_changed(row))
+
+        policy_rows, deadband, deadband_percent, min_interval, max_silence = self.__policy_arrays_cached()
+        idx = np.asarray(rows, dtype=np.int64)
+        pos = np.searchsorted(policy_rows, idx)
+        dtype = np.dtype(self.__typecode)
+        value = np.frombuffer(self.__values, dtype=dtype)[idx]
+        published = np.frombuffer(self.__published, dtype=dtype)[idx]
+        null = np.frombuffer(self.__nulls, dtype=np.uint8)[idx] != 0
+        published_null = np.frombuffer(self.__published_nulls, dtype=np.uint8)[idx] != 0
+        published_millis = np.frombuffer(self.__published_millis, dtype=np.int64)[idx]
+
+        elapsed = (now - published_millis).astype(np.float64)
+        with np.errstate(invalid='ignore'):  # NaN (no setting / NaN values) compares False
+            silent = elapsed >= max_silence[pos]
+            held = elapsed < min_interval[pos]
+            both = ~null & ~published_null
+            differs = (null != published_null) | (both & (value != published))
+            value, published = value.astype(np.float64), published.astype(np.float64)
+            delta = np.abs(value - published)
+            within = both & ((delta <= deadband[pos]) | (delta <= np.abs(published) * deadband_percent[pos] / 100))
+        due = (published_millis == self.NEVER) | silent | (~held & differs & ~within)
+        suppressed = int(np.count_nonzero(~due & self.__changed_mask(idx)))
+        return idx[due].tolist(), suppressed
+
+    def __policy_arrays_cached(self) -> tuple:
+        '''(sorted policy rows, deadband, deadband_percent, min_interval, max_silence) as NumPy arrays, NaN if unset'''
+        if self.__policy_arrays is None:
+            rows = sorted(self.__policies)
+            def setting(name):
+                values = [getattr(self.__policies[row], name) for row in rows]
+                return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            self.__policy_arrays = (
+                np.array(rows, dtype=np.int64),
+                setting('deadband'),
+                setting('deadband_percent'),
+                setting('min_interval'),
+                setting('max_silence')
+            )
+        return self.__policy_arrays
+
+    def __changed_mask(self, idx=None):
+        '''row_changed for all rows (or the rows in idx) as a NumPy bool array'''
+        dtype = np.dtype(self.__typecode)
+        value = np.frombuffer(self.__values, dtype=dtype)
+        previous = np.frombuffer(self.__previous, dtype=dtype)
+        null = np.frombuffer(self.__nulls, dtype=np.uint8)
+        previous_null = np.frombuffer(self.__previous_nulls, dtype=np.uint8)
+        if idx is not None:
+            value, previous, null, previous_null = value[idx], previous[idx], null[idx], previous_null[idx]
+        changed = value != previous
+        if self.__typecode == 'd':
+            changed &= ~(np.isnan(value) & np.isnan(previous))
+        return np.where((null | previous_null) != 0, null != previous_null, changed)
+
+    def payload_values(self, rows: List[int]) -> list:
+        '''
+        Values of rows as they go into a payload: unsigned ints (see SparkplugMetric.int_to_uint), bools, floats.
+        Null rows give None, check nulls to tell them from values that cannot be encoded
+        '''
+        value_key = self.__value_key
+        if self.__numpy and len(rows) >= self.NUMPY_MIN_ROWS:
+            values = np.frombuffer(self.__values, dtype=np.dtype(self.__typecode))[np.asarray(rows, dtype=np.int64)]
+            if value_key == 'int_value':
+                return ints_to_uints(values, bit_size=32)
+            elif value_key == 'long_value':
+                return ints_to_uints(values, bit_size=64)
+            elif value_key == 'boolean_value':
+                return values.astype(bool).tolist()
+            return values.tolist()
+        values = [self.get(row) for row in rows]
+        if value_key == 'int_value':
+            return ints_to_uints(values, bit_size=32)
+        elif value_key == 'long_value':
+            return ints_to_uints(values, bit_size=64)
+        return values
+
+    def fill_payload_values(self, pb_metrics: list, rows: List[int]):
+        '''Set the values of rows on the matching protobuf Metrics (is_null for null rows), converted in bulk'''
+        value_key, nulls = self.__value_key, self.__nulls
+        for pb_metric, row, value in zip(pb_metrics, rows, self.payload_values(rows)):
+            if nulls[row]:
+                pb_metric.is_null = True
+            elif value is not None:
+                setattr(pb_metric, value_key, value)
+
+    def clear_touched(self, rows: Optional[List[int]] = None):
+        '''Forget the reads of rows (all of them if None) since the last collect()'''
+        if rows is None:
+            self.__touched = bytearray(len(self.__touched))
+            return
+        touched = self.__touched
+        for row in rows:
+            touched[row] = 0
+
+    def owner(self, row: int):
+        return None if self.__owners is None else self.__owners[row]
+
+
+class MetricTable:
+    '''
+    Columnar store of metric values, one MetricColumn per datatype. SparkplugMetric objects are views on a row.
+    Metrics start in the shared staging table, the edge node moves its metrics into a table of its own
+    so it can run change detection over whole columns (collect()).
+    use_numpy: run the whole column operations with NumPy, None to use it if it is installed
+    '''
+    __staging: Optional['MetricTable'] = None
+    __staging_lock = threading.Lock()
+
+    def __init__(self, track_owners: bool = True, use_numpy: Optional[bool] = None) -> None:
+        if use_numpy and np is None:
+            raise ImportError('MetricTable use_numpy requires numpy to be installed!')
+        self.__lock = threading.Lock()
+        self.__track_owners = track_owners
+        self.__use_numpy = np is not None if use_numpy is None else use_numpy
+        self.__columns: Dict[int, MetricColumn] = {}
+
+    @classmethod
+    def staging(cls) -> 'MetricTable':
+        '''Table of the metrics that are not part of an edge node (yet), it does not reference the metrics'''
+        with cls.__staging_lock:
+            if cls.__staging is None:
+                cls.__staging = cls(track_owners=False, use_numpy=False)
+            return cls.__staging
+
+    @property
+    def columns(self) -> List[MetricColumn]:
+        return list(self.__columns.values())
+
+    @property
+    def vectorized(self) -> bool:
+        return self.__use_numpy
+
+    def column(self, datatype) -> MetricColumn:
+        column = self.__columns.get(datatype.value)
+        if column is None:
+            with self.__lock:
+                column = self.__columns.get(datatype.value)
+                if column is None:
+                    column = MetricColumn(datatype, self.__lock, track_owners=self.__track_owners, use_numpy=self.__use_numpy)
+                    self.__columns[datatype.value] = column
+        return column
+
+    def allocate(self, datatype, owner=None, policy: Optional[RbePolicy] = None) -> Tuple[MetricColumn, int]:
+        column = self.column(datatype)
+        with self.__lock:
+            return column, column.allocate(owner=owner if self.__track_owners else None, policy=policy)
+
+    def __len__(self) -> int:
+        return sum(len(column) for column in self.__columns.values())
+
+    def collect(self, now: int) -> Tuple[list, int]:
+        '''
+        Metrics read since the last collect that are due for publishing: changed, or let through by their RbePolicy
+        (now is monotonic millis). Also returns how many changed metrics their policy held back.
+        Idle columns cost one buffer comparison
+        '''
+        metrics = []
+        suppressed = 0
+        for column in self.__columns.values():
+            rows, column_suppressed = column.collect(now)
+            suppressed += column_suppressed
+            for row in rows:
+                owner = column.owner(row)
+                if owner is not None:
+                    metrics.append(owner)
+        return metrics, suppressed
+
+    def clear_touched(self, metrics: Optional[list] = None):
+        '''Forget the reads of metrics (all of them if None) since the last collect()'''
+        with self.__lock:
+            if metrics is None:
+                for column in self.__columns.values():
+                    column.clear_touched()
+                return
+            by_column: Dict[int, Tuple[MetricColumn, List[int]]] = {}
+            for metric in metrics:
+                column = metric.column
+                by_column.setdefault(id(column), (column, []))[1].append(metric.row)
+            for column, rows in by_column.values():
+                column.clear_touched(rows)
@@ -0,0 +1,88 @@
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from typing import Dict, List
+
+
+def varint_size(value: int) -> int:
+    '''Encoded size of a protobuf varint'''
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def split_payload(payload: sparkplug_pb2.Payload, max_size: int) -> List[sparkplug_pb2.Payload]:
+    '''
+    Split payload into payloads of at most max_size encoded bytes, keeping the metrics in order.
+    The chunks repeat the header fields (timestamp, seq, ...), the caller sets their seq.
+    A metric too large on its own goes alone in a chunk that exceeds max_size
+    '''
+    total = payload.ByteSize()
+    if total <= max_size or len(payload.metrics) < 2:
+        return [payload]
+    metric_sizes = []
+    for metric in payload.metrics:
+        size = metric.ByteSize()
+        metric_sizes.append(1 + varint_size(size) + size)  # field tag, length, message
+    header_size = total - sum(metric_sizes)
+
+    header = sparkplug_pb2.Payload()
+    for field, value in payload.ListFields():
+        if field.name != 'metrics':
+            setattr(header, field.name, value)
+
+    chunks = []
+    start, size = 0, header_size
+    for idx, metric_size in enumerate(metric_sizes):
+        if size + metric_size > max_size and idx > start:
+            chunks.append((start, idx))
+            start, size = idx, header_size
+        size += metric_size
+    chunks.append((start, len(metric_sizes)))
+
+    payloads = []
+    for start, end in chunks:
+        chunk = sparkplug_pb2.Payload()
+        chunk.MergeFrom(header)
+        chunk.metrics.extend(payload.metrics[start:end])
+        payloads.append(chunk)
+    return payloads
+
+
+class PayloadSizeStats:
+    '''Encoded sizes of the published payloads per message type (NBIRTH, NDATA, DDATA...), and how often they were split'''
+    def __init__(self) -> None:
+        self.__types: Dict[str, Dict[str, int]] = {}
+
+    def __entry(self, message_type: str) -> Dict[str, int]:
+        entry = self.__types.get(message_type)
+        if entry is None:
+            entry = self.__types[message_type] = {'messages': 0, 'bytes': 0, 'max_bytes': 0, 'splits': 0, 'oversized': 0}
+        return entry
+
+    def record(self, message_type: str, size: int):
+        entry = self.__entry(message_type)
+        entry['messages'] += 1
+        entry['bytes'] += size
+        if size > entry['max_bytes']:
+            entry['max_bytes'] = size
+
+    def record_split(self, message_type: str, chunks: int):
+        '''A payload over the size limit went out as chunks messages'''
+        self.__entry(message_type)['splits'] += chunks - 1
+
+    def record_oversized(self, message_type: str):
+        '''A payload went out over the size limit (births cannot be split, or one metric was larger than the limit)'''
+        self.__entry(message_type)['oversized'] += 1
+
+    def as_dict(self) -> dict:
+        return {message_type: dict(entry) for message_type, entry in self.__types.items()}
@@ -0,0 +1,163 @@
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+import logging
+import queue
+import threading
+import time
+
+
+@dataclass(frozen=True, kw_only=True)
+class PipelineConfig:
+    encode_queue: int = 8  # scans waiting to be encoded, a scan blocks when it is full
+    publish_queue: int = 64  # encoded messages waiting to be published
+    max_inflight: int = 1000  # publishes paho has not written out yet, publishing pauses above it
+    backpressure_poll: int = 5  # ms between checks of the in flight count while paused
+
+
+class PipelineStats:
+    '''Jobs through the pipeline, and how often a stage had to wait for the next one'''
+    def __init__(self) -> None:
+        self.encoded = 0
+        self.published = 0
+        self.errors = 0
+        self.encode_waits = 0  # scans that blocked on a full encode queue
+        self.publish_waits = 0  # encoded messages that blocked on a full publish queue
+        self.backpressure_pauses = 0  # publishes held back while paho's outgoing queue was over max_inflight
+        self.discarded = 0  # jobs taken out of the queues by discard()
+
+    def as_dict(self) -> dict:
+        return {
+            'encoded': self.encoded,
+            'published': self.published,
+            'errors': self.errors,
+            'encode_waits': self.encode_waits,
+            'publish_waits': self.publish_waits,
+            'backpressure_pauses': self.backpressure_pauses,
+            'discarded': self.discarded
+        }
+
+
+class PublishPipeline:
+    '''
+    Encode and publish stages on threads of their own, fed through bounded queues:
+    scan (caller) -> encode(job) -> publish(encoded) once inflight() is at most max_inflight.
+    A full queue blocks the stage feeding it, so a slow broker slows the scans down instead of piling up messages
+    '''
+    __STOP = object()
+
+    def __init__(
+        self,
+        config: PipelineConfig,
+        encode: Callable[[object], object],
+        publish: Callable[[object], None],
+        inflight: Callable[[], int]
+    ) -> None:
+        self.__config = config
+        self.__encode = encode
+        self.__publish = publish
+        self.__inflight = inflight
+        self.__encode_queue: queue.Queue = queue.Queue(maxsize=config.encode_queue)
+        self.__publish_queue: queue.Queue = queue.Queue(maxsize=config.publish_queue)
+        self.__threads = []
+        self.__stopping = False
+        self.__stats = PipelineStats()
+
+    @property
+    def config(self) -> PipelineConfig:
+        return self.__config
+
+    @property
+    def stats(self) -> PipelineStats:
+        return self.__stats
+
+    @property
+    def running(self) -> bool:
+        return bool(self.__threads)
+
+    def start(self):
+        if self.__threads:
+            return
+        self.__threads = [
+            threading.Thread(target=self.__encode_loop, name='sparkplug-encode', daemon=True),
+            threading.Thread(target=self.__publish_loop, name='sparkplug-publish', daemon=True)
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        '''Publish what was submitted, then stop the stage threads'''
+        if not self.__threads:
+            return
+        self.__stopping = True  # what is left goes out without waiting for backpressure
+        self.__encode_queue.put(self.__STOP)
+        for thread in self.__threads:
+            thread.join(timeout)
+        self.__threads = []
+        self.__stopping = False
+
+    def submit(self, job):
+        '''Queue job for encoding, blocks while the encode queue is full'''
+        self.__put(self.__encode_queue, job, 'encode_waits')
+
+    def discard(self) -> Tuple[List[object], List[object]]:
+        '''Take the queued jobs out of the pipeline: (jobs not encoded yet, encoded jobs not published yet)'''
+        jobs = self.__take_all(self.__encode_queue)
+        encoded = self.__take_all(self.__publish_queue)
+        self.__stats.discarded += len(jobs) + len(encoded)
+        return jobs, encoded
+
+    def __take_all(self, source: queue.Queue) -> List[object]:
+        items = []
+        stop = False
+        while True:
+            try:
+                item = source.get_nowait()
+            except queue.Empty:
+                break
+            if item is self.__STOP:
+                stop = True
+            else:
+                items.append(item)
+        if stop:  # stop() is waiting for it
+            source.put(self.__STOP)
+        return items
+
+    def __put(self, target: queue.Queue, item, wait_counter: str):
+        try:
+            target.put_nowait(item)
+        except queue.Full:
+            setattr(self.__stats, wait_counter, getattr(self.__stats, wait_counter) + 1)
+            target.put(item)
+
+    def __encode_loop(self):
+        while True:
+            job = self.__encode_queue.get()
+            if job is self.__STOP:
+                self.__publish_queue.put(self.__STOP)
+                return
+            try:
+                encoded = self.__encode(job)
+            except Exception as err:
+                self.__stats.errors += 1
+                logging.error(f'Pipeline encode failed: {err}')
+                continue
+            self.__stats.encoded += 1
+            self.__put(self.__publish_queue, encoded, 'publish_waits')
+
+    def __publish_loop(self):
+        poll = self.__config.backpressure_poll / 1000
+        while True:
+            encoded = self.__publish_queue.get()
+            if encoded is self.__STOP:
+                return
+            if self.__inflight() > self.__config.max_inflight:
+                self.__stats.backpressure_pauses += 1
+                while self.__inflight() > self.__config.max_inflight and not self.__stopping:
+                    time.sleep(poll)
+            try:
+                self.__publish(encoded)
+            except Exception as err:
+                self.__stats.errors += 1
+                logging.error(f'Pipeline publish failed: {err}')
+                continue
+            self.__stats.published += 1
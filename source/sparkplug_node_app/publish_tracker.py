@@ -0,0 +1,140 @@
+from typing import Dict, Optional, Tuple
+import threading
+import time
+
+
+class LatencyHistogram:
+    '''Publish latencies (ms from client.publish() to paho's on_publish) counted in fixed buckets'''
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self) -> None:
+        self.__counts = [0] * (len(self.BOUNDS) + 1)  # the last bucket is over the last bound
+        self.__count = 0
+        self.__total = 0.0
+        self.__max = 0.0
+
+    def record(self, millis: float):
+        idx = 0
+        for bound in self.BOUNDS:
+            if millis <= bound:
+                break
+            idx += 1
+        self.__counts[idx] += 1
+        self.__count += 1
+        self.__total += millis
+        if millis > self.__max:
+            self.__max = millis
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def max(self) -> float:
+        return self.__max
+
+    @property
+    def mean(self) -> float:
+        return self.__total / self.__count if self.__count else 0.0
+
+    def as_dict(self) -> dict:
+        buckets = {f'<={bound}ms': count for bound, count in zip(self.BOUNDS, self.__counts)}
+        buckets[f'>{self.BOUNDS[-1]}ms'] = self.__counts[-1]
+        return {
+            'count': self.__count,
+            'mean_ms': round(self.mean, 3),
+            'max_ms': round(self.__max, 3),
+            'buckets': buckets
+        }
+
+
+class PublishTracker:
+    '''
+    Publishes in flight, by mid: message type, size and enqueue time, completed in O(1) from paho's on_publish.
+    Bounded to max_inflight entries (the oldest are dropped, e.g. QoS 0 messages lost with their connection).
+    on_publish may run on the network thread before client.publish() returned the mid, such early
+    completions are held until the mid is tracked, for at most max_early_age ms. Safe to use from any thread
+    '''
+    def __init__(self, max_inflight: int = 4096, max_early_age: int = 10_000) -> None:
+        self.__max_inflight = max_inflight
+        self.__max_early_age = max_early_age * 1_000_000
+        self.__lock = threading.Lock()
+        self.__inflight: Dict[int, Tuple[str, int, int]] = {}  # mid -> (message type, size, enqueued ns)
+        self.__early: Dict[int, int] = {}  # mid -> completed ns, completed before they were tracked
+        self.__histograms: Dict[str, LatencyHistogram] = {}
+        self.completed = 0
+        self.dropped = 0
+
+    @staticmethod
+    def now() -> int:
+        '''Enqueue time to pass to track(), taken right before client.publish()'''
+        return time.perf_counter_ns()
+
+    def track(self, mid: int, message_type: str, size: int, enqueued: Optional[int] = None):
+        '''enqueued (see now()) defaults to the current time, which misses publishes completed before track() was called'''
+        enqueued = time.perf_counter_ns() if enqueued is None else enqueued
+        with self.__lock:
+            completed_at = self.__early.pop(mid, None)
+            if completed_at is not None and completed_at >= enqueued:
+                self.__record(message_type, completed_at - enqueued)
+                return
+            # a completion from before this publish was enqueued belongs to an earlier use of the mid (paho wraps them)
+            self.__inflight.pop(mid, None)
+            self.__inflight[mid] = (message_type, size, enqueued)
+            if len(self.__inflight) > self.__max_inflight:
+                del self.__inflight[next(iter(self.__inflight))]
+                self.dropped += 1
+
+    def complete(self, mid: int) -> Optional[Tuple[str, int, float]]:
+        '''(message type, size, latency ms) of a tracked publish, None if mid was not tracked yet'''
+        now = time.perf_counter_ns()
+        with self.__lock:
+            entry = self.__inflight.pop(mid, None)
+            if entry is None:
+                self.__early.pop(mid, None)
+                self.__early[mid] = now
+                self.__expire_early(now)
+                return None
+            message_type, size, enqueued = entry
+            return message_type, size, self.__record(message_type, now - enqueued)
+
+    def __expire_early(self, now: int):
+        '''Forget completions held longer than max_early_age, or over max_inflight (publishes not tracked, e.g. made by user code)'''
+        early = self.__early
+        while early:
+            mid, completed_at = next(iter(early.items()))
+            if len(early) <= self.__max_inflight and now - completed_at <= self.__max_early_age:
+                break
+            del early[mid]
+
+    def __record(self, message_type: str, nanos: int) -> float:
+        millis = nanos / 1_000_000
+        histogram = self.__histograms.get(message_type)
+        if histogram is None:
+            histogram = self.__histograms[message_type] = LatencyHistogram()
+        histogram.record(millis)
+        self.completed += 1
+        return millis
+
+    def clear(self):
+        '''Forget the publishes in flight, their connection is gone'''
+        with self.__lock:
+            self.dropped += len(self.__inflight)
+            self.__inflight.clear()
+            self.__early.clear()
+
+    @property
+    def inflight(self) -> int:
+        return len(self.__inflight)
+
+    @property
+    def histograms(self) -> Dict[str, LatencyHistogram]:
+        return dict(self.__histograms)
+
+    def as_dict(self) -> dict:
+        return {
+            'inflight': len(self.__inflight),
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'latency': {message_type: histogram.as_dict() for message_type, histogram in self.__histograms.items()}
+        }
@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass(frozen=True, kw_only=True)
+class RbePolicy:
+    '''
+    Report by exception filter of a metric, compared against the last published value:
+    deadband: publish only if the value moved more than this (absolute, numeric metrics)
+    deadband_percent: publish only if the value moved more than this percentage of the last published value
+    min_interval: ms, never publish more often than this
+    max_silence: ms, publish the current value at least this often even if it did not change (heartbeat)
+    '''
+    deadband: Optional[float] = None
+    deadband_percent: Optional[float] = None
+    min_interval: Optional[int] = None
+    max_silence: Optional[int] = None
+
+    def __post_init__(self):
+        for name in ['deadband', 'deadband_percent', 'min_interval', 'max_silence']:
+            value = getattr(self, name)
+            if value is not None and value < 0:
+                raise ValueError(f'RbePolicy {name} cannot be negative!')
+
+    @property
+    def time_based(self) -> bool:
+        '''True if the policy can publish or release a change later without a new value (min_interval, max_silence)'''
+        return self.min_interval is not None or self.max_silence is not None
+
+    @property
+    def properties(self) -> List[dict]:
+        '''The policy as Sparkplug metric properties, advertised in NBIRTH'''
+        properties = []
+        if self.deadband is not None:
+            properties.append({'key': 'deadband', 'type': 10, 'value': float(self.deadband)})
+        if self.deadband_percent is not None:
+            properties.append({'key': 'deadbandPercent', 'type': 10, 'value': float(self.deadband_percent)})
+        if self.min_interval is not None:
+            properties.append({'key': 'minInterval', 'type': 8, 'value': int(self.min_interval)})
+        if self.max_silence is not None:
+            properties.append({'key': 'maxSilence', 'type': 8, 'value': int(self.max_silence)})
+        return properties
+
+
+class RbeStats:
+    '''Counts of RBE decisions: metrics published, and changed metrics held back by their RbePolicy'''
+    def __init__(self) -> None:
+        self.published = 0
+        self.suppressed = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'published': self.published,
+            'suppressed': self.suppressed
+        }
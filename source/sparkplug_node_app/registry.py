@@ -0,0 +1,209 @@
+from sparkplug_node_app import helpers
+from sparkplug_node_app.sparkplug_tags import SparkplugMetric
+from typing import Callable, Dict, Iterator, List, Optional, Set
+import logging
+import threading
+import json
+import os
+
+
+class MetricRegistry:
+    '''
+    Ordered collection of metrics with dict indexes by name and by alias, used for O(1) NCMD dispatch
+    '''
+    def __init__(self, metrics: Optional[List[SparkplugMetric]] = None) -> None:
+        self.__metrics: List[SparkplugMetric] = []
+        self.__by_name: Dict[str, SparkplugMetric] = {}
+        self.__by_alias: Dict[int, SparkplugMetric] = {}
+        self.__ambiguous_aliases: Set[int] = set()
+        for metric in metrics or []:
+            self.add(metric)
+
+    def add(self, metric: SparkplugMetric):
+        if metric.name in self.__by_name:
+            raise ValueError(f'Duplicate metric name: "{metric.name}"!')
+        self.__metrics.append(metric)
+        self.__by_name[metric.name] = metric
+        self.__index_alias(metric)
+
+    def __index_alias(self, metric: SparkplugMetric):
+        if metric.disable_alias or metric.alias is None:
+            return
+        alias = metric.alias
+        if alias in self.__ambiguous_aliases:
+            return
+        if alias in self.__by_alias:
+            logging.warning(f'Alias {alias} is shared by "{self.__by_alias[alias].name}" and "{metric.name}", it will not be resolved')
+            del self.__by_alias[alias]
+            self.__ambiguous_aliases.add(alias)
+            return
+        self.__by_alias[alias] = metric
+
+    def by_name(self, name: str) -> Optional[SparkplugMetric]:
+        return self.__by_name.get(name)
+
+    def by_alias(self, alias: int) -> Optional[SparkplugMetric]:
+        return self.__by_alias.get(alias)
+
+    def get(self, name: Optional[str] = None, alias: Optional[int] = None) -> Optional[SparkplugMetric]:
+        '''Resolve a metric by name, or by alias when no name is given (Sparkplug NCMD may carry either)'''
+        if name:
+            return self.by_name(name)
+        if alias is not None:
+            return self.by_alias(alias)
+        return None
+
+    @property
+    def metrics(self) -> List[SparkplugMetric]:
+        return self.__metrics
+
+    def __iter__(self) -> Iterator[SparkplugMetric]:
+        return iter(self.__metrics)
+
+    def __len__(self) -> int:
+        return len(self.__metrics)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__by_name
+
+    def reindex(self):
+        '''Rebuild the alias index, after aliases were assigned to metrics already added'''
+        self.__by_alias.clear()
+        self.__ambiguous_aliases.clear()
+        for metric in self.__metrics:
+            self.__index_alias(metric)
+
+
+class ChangeSet:
+    '''
+    Push metrics (memory tags) that reported a change since they were last taken, in the order they changed.
+    Lets an RBE scan read only what changed instead of every metric. Safe to mark from any thread
+    '''
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__changed: Dict[int, SparkplugMetric] = {}
+
+    def mark(self, metric: SparkplugMetric):
+        with self.__lock:
+            self.__changed[id(metric)] = metric
+
+    def take(self, select: Optional[Callable[[SparkplugMetric], bool]] = None) -> List[SparkplugMetric]:
+        '''Remove and return the changed metrics (only the ones select returns True for, if given)'''
+        with self.__lock:
+            if select is None:
+                taken = list(self.__changed.values())
+                self.__changed.clear()
+                return taken
+            taken = [metric for metric in self.__changed.values() if select(metric)]
+            for metric in taken:
+                del self.__changed[id(metric)]
+            return taken
+
+    def clear(self):
+        with self.__lock:
+            self.__changed.clear()
+
+    def __len__(self) -> int:
+        return len(self.__changed)
+
+
+class AliasAllocator:
+    '''
+    Hands out dense, unique metric aliases and remembers the name -> alias map in a json file,
+    so a metric keeps its alias across rebirths and restarts
+    '''
+    def __init__(self, filepath: Optional[str] = None) -> None:
+        self.__filepath = filepath
+        self.__aliases: Dict[str, int] = {}
+        self.__names: Dict[int, str] = {}
+        self.__in_use: Dict[int, str] = {}  # aliases assign() gave to the metrics of this edge node, by alias
+        self.__next_alias = 1
+        self.__dirty = False
+        if filepath:
+            self.__load()
+
+    def __load(self):
+        if not os.path.isfile(self.__filepath):
+            return
+        try:
+            with open(self.__filepath, 'r') as file:
+                data = json.load(file)
+        except json.JSONDecodeError:
+            logging.error(f'Could not load alias file "{self.__filepath}" (invalid json), aliases will be reallocated')
+            return
+        for name, alias in data.items():
+            if isinstance(alias, int) and alias > 0 and alias not in self.__names:
+                self.__bind(name, alias)
+        self.__dirty = False
+
+    def __bind(self, name: str, alias: int):
+        previous_alias = self.__aliases.get(name)
+        if previous_alias is not None:
+            del self.__names[previous_alias]
+        previous_name = self.__names.get(alias)
+        if previous_name is not None:
+            del self.__aliases[previous_name]
+        self.__aliases[name] = alias
+        self.__names[alias] = name
+        self.__dirty = True
+
+    def allocate(self, name: str) -> int:
+        '''Alias of name, allocating the lowest free alias the first time a name is seen'''
+        alias = self.__aliases.get(name)
+        if alias is not None:
+            return alias
+        while self.__next_alias in self.__names:
+            self.__next_alias += 1
+        alias = self.__next_alias
+        self.__bind(name, alias)
+        return alias
+
+    @staticmethod
+    def key(name: str, device_id: Optional[str] = None) -> str:
+        '''Entry of a metric in the map, the metrics of a device are namespaced by its id (aliases are unique per edge node)'''
+        return name if device_id is None else f'{device_id}\t{name}'
+
+    def assign(self, metrics: List[SparkplugMetric], device_id: Optional[str] = None):
+        '''
+        Set the alias of every alias enabled metric without an explicit alias (metrics of the device device_id, if given).
+        Explicit aliases win over remembered ones, raises ValueError if two metrics claim the same explicit alias
+        or an explicit alias is already assigned to another metric of the edge node (e.g. a node metric, for a device metric)
+        '''
+        explicit: Dict[int, str] = {}
+        for metric in metrics:
+            if metric.disable_alias or metric.alias is None:
+                continue
+            name = self.key(metric.name, device_id)
+            if explicit.get(metric.alias, name) != name:
+                raise ValueError(f'Alias {metric.alias} is set on both "{explicit[metric.alias]}" and "{name}"!')
+            if self.__in_use.get(metric.alias, name) != name:
+                raise ValueError(f'Alias {metric.alias} of "{name}" is already assigned to "{self.__in_use[metric.alias]}"!')
+            explicit[metric.alias] = name
+
+        for alias, name in explicit.items():
+            if self.__aliases.get(name) != alias:
+                self.__bind(name, alias)
+
+        for metric in metrics:
+            if metric.disable_alias:
+                continue
+            name = self.key(metric.name, device_id)
+            if metric.alias is None:
+                metric.set_alias(self.allocate(name))
+            self.__in_use[metric.alias] = name
+
+    def save(self) -> bool:
+        '''Write the name -> alias map to disk if it changed, returns True if the file was written'''
+        if not self.__filepath or not self.__dirty:
+            return False
+        helpers.atomic_write_json(self.__filepath, self.__aliases)
+        self.__dirty = False
+        return True
+
+    @property
+    def filepath(self) -> Optional[str]:
+        return self.__filepath
+
+    @property
+    def aliases(self) -> Dict[str, int]:
+        return dict(self.__aliases)
@@ -0,0 +1,91 @@
+from sparkplug_node_app import helpers
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+import threading
+
+
+class SampleBuffer:
+    '''
+    Ring buffer of the (millis, value) samples a metric took between publishes, the oldest are dropped
+    once it holds size samples. A sample equal to the one before it is not kept. Safe to use from any thread
+    '''
+    def __init__(self, size: int) -> None:
+        if size <= 0:
+            raise ValueError(f'Invalid sample buffer size: {size}!')
+        self.__samples: deque = deque(maxlen=size)
+        self.__lock = threading.Lock()
+        self.__last = None
+        self.__has_last = False
+        self.dropped = 0
+
+    def append(self, value, millis: int, current=None) -> bool:
+        '''False if value repeats the previous sample (current, the metric's scan value, before the first one)'''
+        with self.__lock:
+            if value == (self.__last if self.__has_last else current):
+                return False
+            self.__last, self.__has_last = value, True
+            if len(self.__samples) == self.__samples.maxlen:
+                self.dropped += 1
+            self.__samples.append((millis, value))
+            return True
+
+    def drain(self, before: Optional[int] = None) -> List[Tuple[int, object]]:
+        '''The buffered samples older than before (millis, all of them if None), oldest first, they leave the buffer'''
+        with self.__lock:
+            if before is None or not self.__samples or self.__samples[-1][0] < before:
+                samples = list(self.__samples)
+                self.__samples.clear()
+                return samples
+            samples = []
+            while self.__samples and self.__samples[0][0] < before:
+                samples.append(self.__samples.popleft())
+            return samples
+
+    def pending(self, before: Optional[int] = None) -> bool:
+        '''True if drain(before) would return samples'''
+        with self.__lock:
+            return bool(self.__samples) and (before is None or self.__samples[0][0] < before)
+
+    def __len__(self) -> int:
+        return len(self.__samples)
+
+    @property
+    def size(self) -> int:
+        return self.__samples.maxlen
+
+
+class SampleSchedule:
+    '''
+    Metrics the edge node samples between scans, grouped by sample_rate (ms).
+    Like scan classes, samples follow a fixed grid (last deadline + rate)
+    '''
+    def __init__(self) -> None:
+        self.__groups: Dict[int, list] = {}
+        self.__last: Dict[int, int] = {}
+
+    def add(self, metric):
+        self.__groups.setdefault(metric.sample_rate, []).append(metric)
+
+    @property
+    def metrics(self) -> list:
+        return [metric for group in self.__groups.values() for metric in group]
+
+    @property
+    def next_deadline(self) -> Optional[int]:
+        '''Monotonic millis at which the next sample is due, None if no metric is sampled'''
+        if not self.__groups:
+            return None
+        now = helpers.monotonic_millis()
+        return min(self.__last[rate] + rate if rate in self.__last else now for rate in self.__groups)
+
+    def take_due(self, now: Optional[int] = None) -> list:
+        '''The metrics to sample now, their next sample is scheduled'''
+        now = helpers.monotonic_millis() if now is None else now
+        due = []
+        for rate, group in self.__groups.items():
+            last = self.__last.get(rate)
+            if last is not None and last + rate > now:
+                continue
+            self.__last[rate] = now if last is None or now - (last + rate) >= rate else last + rate
+            due.extend(group)
+        return due
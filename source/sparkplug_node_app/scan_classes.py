@@ -0,0 +1,92 @@
+from sparkplug_node_app import helpers
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric, SparkplugMemoryTag
+from typing import List, Optional
+
+
+class ScanClass:
+    '''
+    Named group of metrics read at its own rate. The rate is a writable memory tag, so it can be changed with NCMD:
+    "Node Control/Scan Rate" for the default class, "Node Control/Scan Classes/<name>/Scan Rate" for the others.
+    Scans follow a fixed grid (last deadline + rate), so classes whose rates divide each other come due together
+    and are published in the same NDATA.
+    '''
+    DEFAULT = 'default'
+    RATE_TAG_PREFIX = 'Node Control/Scan Classes/'
+    MIN_RATE = 500
+    MAX_RATE = 3_600_000
+
+    def __init__(self, name: str, rate: Optional[int] = None) -> None:
+        self.__name = name
+        self.__rate = self.valid_rate(rate)
+        self.__metrics: List[SparkplugMetric] = []
+        self.__polled_metrics: List[SparkplugMetric] = []
+        self.__last_scan: Optional[int] = None
+        self.__rate_tag = SparkplugMemoryTag(
+            name=self.rate_tag_name(name),
+            datatype=SparkplugDataTypes.Int64,
+            initial_value=self.__rate,
+            writable=True,
+            disable_alias=True,
+            on_write=self.__on_rate_write,
+            write_validator=lambda current_value, new_value: self.MIN_RATE - 1 < new_value < self.MAX_RATE + 1
+        )
+
+    @classmethod
+    def valid_rate(cls, rate: Optional[int], default: int = 1000) -> int:
+        if not rate or rate > cls.MAX_RATE or rate < cls.MIN_RATE:
+            return default
+        return rate
+
+    @classmethod
+    def rate_tag_name(cls, name: str) -> str:
+        if name == cls.DEFAULT:
+            return 'Node Control/Scan Rate'
+        return f'{cls.RATE_TAG_PREFIX}{name}/Scan Rate'
+
+    def __on_rate_write(self, metric_obj, value_written, success):
+        if success:
+            self.__rate = value_written
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def rate(self) -> int:
+        return self.__rate
+
+    @property
+    def rate_tag(self) -> SparkplugMemoryTag:
+        return self.__rate_tag
+
+    @property
+    def metrics(self) -> List[SparkplugMetric]:
+        return self.__metrics
+
+    @property
+    def polled_metrics(self) -> List[SparkplugMetric]:
+        '''Metrics read on every scan, the others push their changes (see ChangeSet)'''
+        return self.__polled_metrics
+
+    def add(self, metric: SparkplugMetric, polled: bool = True):
+        self.__metrics.append(metric)
+        if polled:
+            self.__polled_metrics.append(metric)
+
+    @property
+    def next_deadline(self) -> int:
+        '''Monotonic millis at which the next scan of this class is due'''
+        if self.__last_scan is None:
+            return helpers.monotonic_millis()
+        return self.__last_scan + self.__rate
+
+    def due(self, now: int) -> bool:
+        return self.__last_scan is None or self.__last_scan + self.__rate <= now
+
+    def scanned(self, now: int):
+        '''Move to the next grid point, or restart the grid at now if the class fell more than one period behind'''
+        if self.__last_scan is None:
+            self.__last_scan = now
+            return
+        deadline = self.__last_scan + self.__rate
+        self.__last_scan = deadline if now - deadline < self.__rate else now
@@ -0,0 +1,122 @@
+from sparkplug_node_app import helpers
+from typing import Dict, List, Optional
+import threading
+
+
+class TickStats:
+    '''Lateness (ms between a deadline and the moment it was serviced) of a named tick'''
+    def __init__(self, name: str) -> None:
+        self.__name = name
+        self.__count = 0
+        self.__last = 0
+        self.__max = 0
+        self.__total = 0
+
+    def record(self, lateness: int):
+        lateness = max(lateness, 0)
+        self.__count += 1
+        self.__last = lateness
+        self.__total += lateness
+        if lateness > self.__max:
+            self.__max = lateness
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def last(self) -> int:
+        return self.__last
+
+    @property
+    def max(self) -> int:
+        return self.__max
+
+    @property
+    def mean(self) -> float:
+        if not self.__count:
+            return 0.0
+        return self.__total / self.__count
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'last': self.last,
+            'max': self.max,
+            'mean': self.mean
+        }
+
+
+class DeadlineScheduler:
+    '''
+    Sleeps until the earliest named deadline (monotonic millis) is due, or until wake() is called.
+    Deadlines can be set from any thread, the waiting thread re-evaluates them immediately.
+    '''
+    def __init__(self) -> None:
+        self.__condition = threading.Condition()
+        self.__woken = False
+        self.__deadlines: Dict[str, int] = {}
+        self.__stats: Dict[str, TickStats] = {}
+
+    def set_deadline(self, name: str, deadline: Optional[int]):
+        '''Set (or clear with None) the monotonic millis deadline for the tick "name"'''
+        with self.__condition:
+            if deadline is None:
+                self.__deadlines.pop(name, None)
+            else:
+                self.__deadlines[name] = deadline
+            self.__condition.notify_all()
+
+    def wake(self):
+        '''Interrupt wait() so the caller services pending work now'''
+        with self.__condition:
+            self.__woken = True
+            self.__condition.notify_all()
+
+    @property
+    def next_deadline(self) -> Optional[int]:
+        with self.__condition:
+            return min(self.__deadlines.values(), default=None)
+
+    def wait(self, timeout: Optional[int] = None) -> List[str]:
+        '''
+        Block until at least one deadline is due, wake() is called or timeout (ms) expires.
+        Returns the names of the due deadlines, which are consumed and their lateness recorded.
+        '''
+        give_up = None if timeout is None else helpers.monotonic_millis() + timeout
+        with self.__condition:
+            while not self.__woken:
+                now = helpers.monotonic_millis()
+                wake_at = min(self.__deadlines.values(), default=None)
+                if give_up is not None and (wake_at is None or give_up < wake_at):
+                    wake_at = give_up
+                if wake_at is not None and wake_at <= now:
+                    break
+                self.__condition.wait(None if wake_at is None else (wake_at - now) / 1000)
+            self.__woken = False
+            return self.__consume_due()
+
+    def pop_due(self) -> List[str]:
+        '''Non blocking wait(): consume and return the deadlines that are due now, for callers that sleep elsewhere (e.g. an event loop)'''
+        with self.__condition:
+            self.__woken = False
+            return self.__consume_due()
+
+    def __consume_due(self) -> List[str]:
+        now = helpers.monotonic_millis()
+        due = [name for name, deadline in self.__deadlines.items() if deadline <= now]
+        for name in due:
+            lateness = now - self.__deadlines.pop(name)
+            if name not in self.__stats:
+                self.__stats[name] = TickStats(name)
+            self.__stats[name].record(lateness)
+        return due
+
+    @property
+    def stats(self) -> Dict[str, TickStats]:
+        with self.__condition:
+            return dict(self.__stats)
@@ -1,30 +1,102 @@
 from sparkplug_node_app.protobuf_files import sparkplug_pb2
 from sparkplug_node_app import config, mqtt_functions
+from sparkplug_node_app.scheduler import DeadlineScheduler, TickStats
+from sparkplug_node_app.registry import MetricRegistry, AliasAllocator, ChangeSet
+from sparkplug_node_app.store_forward import SegmentLog, StoreForwardConfig
+from sparkplug_node_app.failover import Backoff, FailoverConfig, FailoverStats
+from sparkplug_node_app.scan_classes import ScanClass
+from sparkplug_node_app.rbe import RbeStats
+from sparkplug_node_app.metric_table import MetricTable
+from sparkplug_node_app.payloads import PayloadSizeStats, encode_varint, split_payload
+from sparkplug_node_app.publish_tracker import PublishTracker
+from sparkplug_node_app.pipeline import PipelineConfig, PipelineStats, PublishPipeline
+from sparkplug_node_app.batching import BatchConfig, BatchStats, PublishBatcher
+from sparkplug_node_app.samples import SampleSchedule
 from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric, SparkplugMemoryTag
-from google.protobuf.json_format import MessageToJson, MessageToDict, Parse, ParseDict, ParseError
+from google.protobuf.json_format import MessageToJson, Parse, ParseDict, ParseError
 from google.protobuf.message import DecodeError, EncodeError
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Dict, Iterable, Tuple, Set
 from enum import Enum
 import logging
 from sparkplug_node_app import helpers
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from collections import deque
+import threading
 import time
 import uuid
 import os
 import json
 
 
+class NodeControlMetric(SparkplugMetric):
+    '''Node Control metric whose read is a constant (e.g. "Node Control/Rebirth"), read inline instead of on the read workers'''
+    __slots__ = ()
+
+    @property
+    def blocking_read(self) -> bool:
+        return False
+
+
+class SparkplugDeviceTopics:
+    def __init__(self, group_id: str, edge_node_id: str, device_id: str) -> None:
+        if not device_id or any(char in device_id for char in '/+#'):
+            raise ValueError(f'Invalid device id of "{device_id}"')
+        self._dbirth = f'spBv1.0/{group_id}/DBIRTH/{edge_node_id}/{device_id}'
+        self._ddeath = f'spBv1.0/{group_id}/DDEATH/{edge_node_id}/{device_id}'
+        self._ddata = f'spBv1.0/{group_id}/DDATA/{edge_node_id}/{device_id}'
+        self._dcmd = f'spBv1.0/{group_id}/DCMD/{edge_node_id}/{device_id}'
+
+    @property
+    def DBIRTH(self) -> str:
+        return self._dbirth
+
+    @property
+    def DDEATH(self) -> str:
+        return self._ddeath
+
+    @property
+    def DDATA(self) -> str:
+        return self._ddata
+
+    @property
+    def DCMD(self) -> str:
+        return self._dcmd
+
+
 class SparkplugEdgeNodeTopics:
     def __init__(self, group_id: str, edge_node_id: str, host_application_id: str = None) -> None:
         if group_id == 'STATE':
             raise ValueError(f'Invalid group id of "{group_id}"')
+        self._group_id = group_id
+        self._edge_node_id = edge_node_id
         self._nbirth = f'spBv1.0/{group_id}/NBIRTH/{edge_node_id}'
         self._ndeath = f'spBv1.0/{group_id}/NDEATH/{edge_node_id}'
         self._ndata = f'spBv1.0/{group_id}/NDATA/{edge_node_id}'
         self._ncmd = f'spBv1.0/{group_id}/NCMD/{edge_node_id}'
+        self._dcmd_prefix = f'spBv1.0/{group_id}/DCMD/{edge_node_id}/'
+        self._devices: Dict[str, SparkplugDeviceTopics] = {}
 
         self._host_application = None if host_application_id is None else f'spBv1.0/STATE/{host_application_id}'
 
+    def device(self, device_id: str) -> SparkplugDeviceTopics:
+        '''Topics of a device of this edge node, built once per device'''
+        topics = self._devices.get(device_id)
+        if topics is None:
+            topics = self._devices[device_id] = SparkplugDeviceTopics(self._group_id, self._edge_node_id, device_id)
+        return topics
+
+    @property
+    def DCMD(self) -> str:
+        '''Subscription for the DCMD of every device of this edge node'''
+        return self._dcmd_prefix + '+'
+
+    def dcmd_device_id(self, topic: str) -> Optional[str]:
+        '''Device id of a DCMD topic of this edge node, None for any other topic'''
+        if not topic.startswith(self._dcmd_prefix):
+            return None
+        device_id = topic[len(self._dcmd_prefix):]
+        return device_id if device_id and '/' not in device_id else None
+
     @property
     def NBIRTH(self) -> str:
         return self._nbirth
@@ -51,6 +123,8 @@ class SparkplugEdgeNodeTopics:
 
 
 class SparkplugEdgeNode:
+    WRITE_FAILED_PROPERTIES = [{'key': 'writeResult', 'type': SparkplugDataTypes.Boolean.value, 'value': False}]
+
     def __init__(self,
         group_id: str,
         edge_node_id: str,
@@ -64,21 +138,72 @@ class SparkplugEdgeNode:
         on_mqtt_publish: Optional[Callable[['SparkplugEdgeNode', mqtt_functions.mqtt.Client], None]] = None,
         on_mqtt_message: Optional[Callable[['SparkplugEdgeNode', mqtt_functions.mqtt.Client], None]] = None,
         on_mqtt_disconnect: Optional[Callable[['SparkplugEdgeNode', mqtt_functions.mqtt.Client], None]] = None,
-        config_filepath: str = None
+        config_filepath: str = None,
+        store_forward: Optional[StoreForwardConfig] = None,
+        failover: Optional[FailoverConfig] = None,
+        read_workers: Optional[int] = None,
+        read_timeout: int = 1000,
+        scan_classes: Optional[Dict[str, int]] = None,
+        vectorized: Optional[bool] = None,
+        max_payload_size: Optional[int] = None,
+        rebirth_on_write_failure: bool = False,
+        pipeline: Optional[PipelineConfig] = None,
+        batching: Optional[BatchConfig] = None
         ) -> None:
+        '''
+        scan_classes maps extra scan class names to their scan rate (ms), metrics join one with their scan_class argument.
+        Metrics without a scan class are read at scan_rate
+
+        vectorized runs RBE change detection, RbePolicy filtering and payload value conversion of numeric
+        metrics with NumPy (an optional dependency), None to do so if it is installed
+
+        max_payload_size (bytes, e.g. the broker's maximum packet size less the topic) splits NDATA / DDATA
+        into several messages with consecutive seq. NBIRTH / DBIRTH cannot be split, over the limit they are
+        rebuilt without the RbePolicy properties, move metrics to devices if that is not enough
 
+        Failed NCMD / DCMD writes are acknowledged with one NDATA / DDATA per command carrying the current value
+        of the metrics that were not written (writeResult property False). rebirth_on_write_failure publishes
+        a full NBIRTH / DBIRTH instead
+
+        pipeline moves NDATA / DDATA encoding and publishing of loop_forever() to stage threads behind bounded queues
+        (see PublishPipeline), messages carry the latest values of their metrics when they are encoded.
+        NCMD / DCMD are then handed from the mqtt network thread to the loop
+
+        batching coalesces the NDATA / DDATA of the scans and writes within a window (see PublishBatcher) into one
+        message per topic, keeping the latest value of each metric unless BatchConfig.history is set.
+        The batches are published by the loop, or by flush_batches()
+        '''
+        if max_payload_size is not None and max_payload_size <= 0:
+            raise ValueError(f'Invalid max_payload_size: {max_payload_size}!')
+
+        startup = helpers.PhaseTimer()
         metrics = [] if metrics is None else metrics
         for metric in metrics:
-            if metric.name in ['Node Control/Scan Rate', 'Node Control/Rebirth']:
+            if metric.name in ['Node Control/Scan Rate', 'Node Control/Rebirth'] or metric.name.startswith(ScanClass.RATE_TAG_PREFIX):
                 raise ValueError(f'Invalid metric name: "{metric.name}"!')
 
         self.__topics = SparkplugEdgeNodeTopics(group_id=group_id, edge_node_id=edge_node_id, host_application_id=host_application_id)
         self.__brokers = brokers
-        self.__metrics = metrics
         self.__running = False
-        self.__force_rbe = False
-
-        scan_rate = 1000 if not scan_rate or scan_rate > 3_600_000 or scan_rate < 500 else scan_rate
+        self.__force_rbe: Set[str] = set()
+        self.__force_rbe_lock = threading.Lock()
+        self.__loop_running = False
+        self.__online = False
+        self.__scheduler = DeadlineScheduler()
+
+        '''NDATA produced while offline is stored and replayed as historical data after the next NBIRTH'''
+        self.__store_forward = SegmentLog(store_forward) if store_forward else None
+        self.__last_replay = 0
+
+        '''Opt-in concurrent reads: blocking metric reads are fanned out over read_workers threads'''
+        self.__read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='sparkplug-read') if read_workers else None
+        self.__read_timeout = read_timeout
+        self.__pending_reads: Dict[object, Future] = {}
+
+        scan_rate = ScanClass.valid_rate(scan_rate)
+        scan_classes = dict(scan_classes or {})
+        if ScanClass.DEFAULT in scan_classes:
+            raise ValueError(f'Invalid scan class name: "{ScanClass.DEFAULT}"!')
         config_save_rate = 600_000 if not config_save_rate or config_save_rate > 36_000_000 or config_save_rate < 20_000 else config_save_rate
 
         self.__config_filepath = None
@@ -92,23 +217,76 @@ class SparkplugEdgeNode:
                     scan_rate = config_data['recreate_node_args']['scan_rate']
                 if 'config_save_rate' in config_data['recreate_node_args'].keys():
                     config_save_rate = config_data['recreate_node_args']['config_save_rate']
+                for name, rate in config_data['recreate_node_args'].get('scan_classes', {}).items():
+                    if name in scan_classes:
+                        scan_classes[name] = rate
                 # TODO fully implement
-
-        self.__scan_rate = SparkplugMemoryTag(
-            name='Node Control/Scan Rate',
-            datatype=SparkplugDataTypes.Int64,
-            initial_value=scan_rate,
-            writable=True,
-            disable_alias=True
+        startup.lap('config')
+
+        '''Each scan class has its own rate tag, "Node Control/Scan Rate" belongs to the default class'''
+        self.__scan_classes: Dict[str, ScanClass] = {ScanClass.DEFAULT: ScanClass(ScanClass.DEFAULT, scan_rate)}
+        for name, rate in scan_classes.items():
+            self.__scan_classes[name] = ScanClass(name, rate)
+        self.__scan_rate = self.__scan_classes[ScanClass.DEFAULT].rate_tag
+
+        self.__rebirth = NodeControlMetric(
+            name='Node Control/Rebirth',
+            datatype=SparkplugDataTypes.Boolean,
+            read_function=lambda prev_value: False,
+            write_function=self.__request_rebirth,
+            disable_alias=True,
+            rbe_ignore=True
         )
 
-        metrics.append(self.__scan_rate)
-
+        self.__aliases = AliasAllocator(self.alias_filepath(self.__config_filepath))
+        self.__aliases.assign(metrics)
+        self.__aliases.save()
+
+        self.__registry = MetricRegistry(metrics)
+        self.__registry.add(self.__scan_rate)
+        self.__registry.add(self.__rebirth)
+        for scan_class in self.__scan_classes.values():
+            if scan_class.name != ScanClass.DEFAULT:
+                self.__registry.add(scan_class.rate_tag)
+
+        '''Push metrics report their changes into __changes, RBE scans read those instead of polling them'''
+        self.__changes = ChangeSet()
+        '''Values live in the node's own columnar table, RBE change detection runs over whole columns'''
+        self.__table = MetricTable(use_numpy=vectorized)
+        self.__has_groups = False
+        '''Metrics with a history_size buffer samples taken between scans, those with a sample_rate are sampled by the loop'''
+        self.__sampled: List[SparkplugMetric] = []
+        self.__sampling = SampleSchedule()
+        for metric in self.__registry:
+            self.__bind_metric(metric)
+
+        '''Devices scan with the node's scan classes, the changes of a scan go out as NDATA plus one DDATA per device'''
+        self.__devices: Dict[str, SparkplugDevice] = {}
+        self.__device_of: Dict[int, SparkplugDevice] = {}
+        self.__session = 0  # incremented by every NBIRTH, a device is online once it was born in the current session
+        startup.lap('metrics')
+
+        persistence_stores = {id(metric.store): metric.store for metric in metrics if isinstance(metric, SparkplugMemoryTag) and metric.persistent}
+        startup.add('persistence_load', sum(store.load_millis for store in persistence_stores.values()))
 
         self.__bdseq = helpers.Incrementor()
         self.__seq = helpers.Incrementor(maximum=255)
 
-        self.__mid_deque = deque(maxlen=10)
+        '''seq is taken when a message is encoded, encoding and client.publish() happen under __publish_lock so seq follows publish order'''
+        self.__publish_lock = threading.RLock()
+        self.__publishes = PublishTracker()
+        self.__pipeline = PublishPipeline(
+            pipeline,
+            encode=self.__encode_job,
+            publish=self.__publish_job,
+            inflight=lambda: self.__publishes.inflight
+        ) if pipeline else None
+        self.__commands = deque()  # (client, payload, device) of NCMD / DCMD waiting for the loop
+        self.__batcher = PublishBatcher(batching) if batching else None
+
+        self.__max_payload_size = max_payload_size
+        self.__rebirth_on_write_failure = rebirth_on_write_failure
+        self.__payload_sizes = PayloadSizeStats()
 
         self.__config_save_rate = config_save_rate
         self.__last_config_save = 0
@@ -124,20 +302,101 @@ class SparkplugEdgeNode:
         )
 
         self.__last_read = 0
+        self.__rbe_stats = RbeStats()
 
         if not brokers:
             raise ValueError('No brokers supplied to SparkPlugEdgeNode!')
 
-        # set the primary broker TODO implement broker walk, etc
         self.__primary_broker_idx = 0
         for idx, broker in enumerate(brokers):
             if broker.primary:
                 self.__primary_broker_idx = idx
                 break
-        
+
+        '''Broker walk state, driven from loop_forever'''
+        self.__failover = failover if failover else FailoverConfig()
+        self.__failover_stats = FailoverStats()
+        self.__backoff = Backoff(
+            initial=self.__failover.backoff_initial,
+            maximum=self.__failover.backoff_max,
+            multiplier=self.__failover.backoff_multiplier,
+            jitter=self.__failover.backoff_jitter
+        )
+        self.__connect_deadline: Optional[int] = None
+        self.__connect_failed = False
+        self.__next_connect_attempt = 0
+        self.__offline_since: Optional[int] = None
+        self.__online_broker_idx: Optional[int] = None
+        self.__standby_client: Optional[mqtt_functions.mqtt.Client] = None
+        self.__standby_broker_idx: Optional[int] = None
+        self.__standby_deadline: Optional[int] = None
+        self.__next_standby_attempt = 0
+
         self.__set_broker(self.__primary_broker_idx)
+        startup.lap('client')
+
+        self.__startup_timings = startup.timings
+        logging.info(f'Edge Node ready: {startup}')
 
         
+    def __bind_metric(self, metric: SparkplugMetric):
+        '''Move metric into the node's table and its scan class'''
+        scan_class = self.__scan_classes.get(metric.scan_class or ScanClass.DEFAULT)
+        if scan_class is None:
+            raise ValueError(f'Metric "{metric.name}" has an unknown scan class: "{metric.scan_class}"!')
+        metric.bind_table(self.__table)
+        pushed = metric.pushes_changes and (metric.rbe_policy is None or not metric.rbe_policy.time_based)
+        if pushed:
+            metric.set_change_listener(self.__changes.mark)
+        scan_class.add(metric, polled=not pushed)
+        if metric.group is not None:
+            self.__has_groups = True
+        if metric.sample_buffer is not None:
+            self.__sampled.append(metric)
+        if metric.sample_rate is not None:
+            if metric.group is not None:
+                raise ValueError(f'Metric "{metric.name}" is read through a MetricGroup and cannot have a sample_rate, use record_sample()!')
+            self.__sampling.add(metric)
+
+    def _add_device(self, device: 'SparkplugDevice'):
+        '''Called by SparkplugDevice: alias, table and scan class its metrics, route its DCMD and publish its DBIRTH if the node is online'''
+        if device.device_id in self.__devices:
+            raise ValueError(f'Duplicate device id: "{device.device_id}"!')
+        for metric in device.metrics:
+            if metric.scan_class is not None and metric.scan_class not in self.__scan_classes:
+                raise ValueError(f'Metric "{metric.name}" of device "{device.device_id}" has an unknown scan class: "{metric.scan_class}"!')
+            if isinstance(metric, SparkplugMemoryTag) and metric.persistent and metric.device_id != device.device_id:
+                raise ValueError(f'Persistent memory tag "{metric.name}" of device "{device.device_id}" must be created with device_id="{device.device_id}"!')
+        self.__aliases.assign(device.metrics, device_id=device.device_id)
+        self.__aliases.save()
+        device.registry.reindex()
+        for metric in device.metrics:
+            self.__bind_metric(metric)
+            self.__device_of[id(metric)] = device
+        self.__devices[device.device_id] = device
+        if self.__online:  # the node is born already, the device is born now instead of with the next NBIRTH
+            if len(self.__devices) == 1:
+                self.__client.subscribe(self.__topics.DCMD)
+            self._publish_dbirth(device)
+
+    @property
+    def devices(self) -> Dict[str, 'SparkplugDevice']:
+        return self.__devices
+
+    @property
+    def topics(self) -> SparkplugEdgeNodeTopics:
+        return self.__topics
+
+    @property
+    def _session(self) -> int:
+        '''Count of NBIRTHs published, DBIRTHs belong to the session they were published in'''
+        return self.__session
+
+    @property
+    def startup_timings(self) -> Dict[str, float]:
+        '''Milliseconds spent in each startup phase of __init__ (persistence_load happens while the memory tags are created)'''
+        return self.__startup_timings
+
     @property
     def primary_broker(self) -> mqtt_functions.BrokerInfo:
         return self.__brokers[self.__primary_broker_idx]
@@ -146,44 +405,206 @@ class SparkplugEdgeNode:
     def current_broker(self) -> mqtt_functions.BrokerInfo:
         return self.__brokers[self.__current_broker_idx]
 
+    @property
+    def client(self) -> mqtt_functions.mqtt.Client:
+        '''The mqtt client of the current broker'''
+        return self.__client
+
+    @property
+    def failover_stats(self) -> FailoverStats:
+        return self.__failover_stats
+
     def __set_client(self, client: mqtt_functions.mqtt.Client):
         '''
         Set the mqtt client and get it ready for connection
         '''
         self.__client = client
+        self.__publishes.clear()  # mids are per client, the publishes of a retired client never complete
         self.__client.on_connect = self.__on_mqtt_connect
         self.__client.on_publish = self.__on_mqtt_publish
         self.__client.on_disconnect = self.__on_mqtt_disconnect
         self.__client.on_message = self.__on_mqtt_messge
         self.__client.message_callback_add(self.__topics.NCMD, self.__on_ncmd_message)
+        self.__client.message_callback_add(self.__topics.DCMD, self.__on_dcmd_message)
         if self.__callbacks['on_set_client']:
             self.__callbacks['on_set_client'](node=self, mqtt_client=client)
     
     def __set_broker(self, idx: int):
         if self.__running:
-            self.__client.loop_stop()
+            self.__retire_client(self.__client)
+            self.__running = False
         self.__current_broker_idx = idx
-        self.__set_client(self.primary_broker.create_client())
+        self.__set_client(self.__brokers[idx].create_client())
 
     def start_client(self):
         if self.__running:
-            self.__client.loop_stop()
-        
-        broker = self.current_broker
+            self._stop_client_loop(self.__client)
 
-        self.__client.will_set(topic=self.__topics.NDEATH, payload=self.__get_ndeath_payload(), qos=1)
+        self.__connect_client(self.__client, self.current_broker)
+        self.__running = True
+        self.__connect_failed = False
+        self.__connect_deadline = helpers.monotonic_millis() + self.__failover.connect_timeout
+        self.__failover_stats.connect_attempts += 1
+
+    def __connect_client(self, client: mqtt_functions.mqtt.Client, broker: mqtt_functions.BrokerInfo):
+        client.will_set(topic=self.__topics.NDEATH, payload=self.__get_ndeath_payload(), qos=1)
+        self._run_client(client, broker)
 
-        self.__client.connect_async(
+    def _run_client(self, client: mqtt_functions.mqtt.Client, broker: mqtt_functions.BrokerInfo):
+        '''Start connecting client to broker and run its network loop (paho's loop_start thread)'''
+        client.connect_async(
             host=broker.host,
             port=broker.port,
             clean_start=True
         )
-        self.__client.loop_start()
+        client.loop_start()
+
+    def _stop_client_loop(self, client: mqtt_functions.mqtt.Client):
+        client.loop_stop()
+
+    def _connect_attempt_failed(self):
+        '''Report that the current connection attempt failed, the loop moves on to the next broker'''
+        self.__connect_failed = True
+        self._wake()
+
+    @staticmethod
+    def __detach_client(client: mqtt_functions.mqtt.Client):
+        client.on_connect = None
+        client.on_disconnect = None
+        client.on_publish = None
+        client.on_message = None
+
+    def __retire_client(self, client: mqtt_functions.mqtt.Client, publish_death: Optional[bytes] = None, topic: Optional[str] = None):
+        '''
+        Detach callbacks and stop a client, optionally publishing its NDEATH first (a clean disconnect suppresses the will).
+        Can block for up to a second while paho's network thread finishes a reconnect wait
+        '''
+        self.__detach_client(client)
+        if publish_death is not None and client.is_connected():
+            client.publish(topic=topic, payload=publish_death, qos=1)
+            client.disconnect()
+        self._stop_client_loop(client)
+
+    def __next_broker_idx(self, idx: int) -> int:
+        return (idx + 1) % len(self.__brokers)
+
+    def __broker_name(self, idx: Optional[int]) -> Optional[str]:
+        if idx is None:
+            return None
+        broker = self.__brokers[idx]
+        return broker.name or f'{broker.host}:{broker.port}'
+
+    def _maintain_connection(self) -> Optional[int]:
+        '''
+        Connect, fail over across the broker list and fall back to the primary broker.
+        Runs on the loop thread, returns the monotonic millis at which it needs to run again (None if idle)
+        '''
+        now = helpers.monotonic_millis()
+        if self.online:
+            self.__backoff.reset()
+            return self.__maintain_standby(now)
+
+        if self.__offline_since is None:
+            self.__offline_since = now
+
+        if self.__standby_client is not None and self.__standby_client.is_connected():
+            logging.warning(f'Switching to standby broker "{self.__broker_name(self.__standby_broker_idx)}"')
+            self.__promote_standby(reason='failover')
+            return None
+
+        if self.__connect_deadline is not None:
+            if not self.__connect_failed and now < self.__connect_deadline:
+                return self.__connect_deadline
+            logging.warning(f'Connection to broker "{self.__broker_name(self.__current_broker_idx)}" failed')
+            self.__failover_stats.connect_failures += 1
+            self.__connect_deadline = None
+            self.__next_connect_attempt = now + self.__backoff.next_delay()
+            self.__set_broker(self.__next_broker_idx(self.__current_broker_idx))
+
+        if now < self.__next_connect_attempt:
+            return self.__next_connect_attempt
+
+        if self.__running:  # disconnected after being online, start over with a fresh client
+            self.__set_broker(self.__current_broker_idx)
+        logging.info(f'Connecting to broker "{self.__broker_name(self.__current_broker_idx)}"')
+        self.start_client()
+        return self.__connect_deadline
+
+    def __maintain_standby(self, now: int) -> Optional[int]:
+        '''Keep a connection to the primary broker (when on a backup) or to the next broker (when standby is enabled)'''
+        target_idx = None
+        if self.__current_broker_idx != self.__primary_broker_idx:
+            target_idx = self.__primary_broker_idx
+        elif self.__failover.standby and len(self.__brokers) > 1:
+            target_idx = self.__next_broker_idx(self.__current_broker_idx)
+
+        if self.__standby_client is not None and self.__standby_broker_idx != target_idx:
+            self.__stop_standby()
+        if target_idx is None:
+            return None
+
+        if self.__standby_client is None:
+            if now < self.__next_standby_attempt:
+                return self.__next_standby_attempt
+            self.__start_standby(target_idx)
+            return self.__standby_deadline
+
+        if self.__standby_client.is_connected():
+            if target_idx == self.__primary_broker_idx:
+                logging.info(f'Primary broker "{self.__broker_name(target_idx)}" is back, falling back to it')
+                self.__promote_standby(reason='fallback')
+            return None
+
+        if now >= self.__standby_deadline:
+            logging.debug(f'Standby broker "{self.__broker_name(target_idx)}" unreachable')
+            self.__stop_standby()
+            self.__next_standby_attempt = now + self.__failover.primary_check_rate
+            return self.__next_standby_attempt
+        return self.__standby_deadline
+
+    def __start_standby(self, idx: int):
+        '''The standby connection carries the NDEATH of the next bdSeq as its will, so it can be promoted as is'''
+        client = self.__brokers[idx].create_client()
+        client.on_connect = lambda *args, **kwargs: self._wake()
+        self.__connect_client(client, self.__brokers[idx])
+        self.__standby_client = client
+        self.__standby_broker_idx = idx
+        self.__standby_deadline = helpers.monotonic_millis() + self.__failover.connect_timeout
+
+    def __stop_standby(self):
+        if self.__standby_client is not None:
+            self.__retire_client(self.__standby_client)
+        self.__standby_client = None
+        self.__standby_broker_idx = None
+        self.__standby_deadline = None
+
+    def __promote_standby(self, reason: str):
+        client, idx = self.__standby_client, self.__standby_broker_idx
+        self.__standby_client = None
+        self.__standby_broker_idx = None
+        self.__standby_deadline = None
+
+        old_client = self.__client if self.__running else None
+        old_death = self.__get_ndeath_payload(rebirth=True) if self.online else None
+        self.__online = False
+        if old_client is not None:
+            self.__detach_client(old_client)
+
+        self.__connect_deadline = None
+        self.__current_broker_idx = idx
+        self.__set_client(client)
         self.__running = True
+        self.__failover_stats.standby_promotions += 1
+        self.__go_online(client, reason=reason)
+
+        if old_client is not None:  # after the NBIRTH, stopping the old client can block
+            self.__retire_client(old_client, publish_death=old_death, topic=self.__topics.NDEATH)
 
     def stop_client(self):
-        self.__client.loop_stop()
+        self._stop_client_loop(self.__client)
+        self.__stop_standby()
         self.__running = False
+        self.__connect_deadline = None
 
     def save_config(self) -> bool:
         '''
@@ -197,23 +618,37 @@ class SparkplugEdgeNode:
         config = {
             'bdSeq': self.__bdseq.current_value,
             'recreate_node_args': {
-                'scan_rate': self.__scan_rate.current_value,
+                'scan_rate': self.__scan_classes[ScanClass.DEFAULT].rate,
+                'scan_classes': {name: scan_class.rate for name, scan_class in self.__scan_classes.items() if name != ScanClass.DEFAULT},
                 'config_save_rate': self.__config_save_rate
             }
         }
 
-        with open(filepath, 'w') as file:
-            json.dump(config, file, indent=4)
+        helpers.atomic_write_json(filepath, config, indent=4)
 
-        for metric in self.metrics:
+        stores = {}
+        device_metrics = [metric for device in list(self.__devices.values()) for metric in device.metrics]
+        for metric in self.metrics + device_metrics:
             if not isinstance(metric, SparkplugMemoryTag) or not metric.persistent:
                 continue
-            logging.debug(f'Saving tag "{metric.name}" to disk')
-            metric.save_to_disk()
+            stores[id(metric.store)] = metric.store
+        for store in stores.values():
+            store.flush()
 
-        self.__last_config_save = helpers.millis()
+        self.__last_config_save = helpers.monotonic_millis()
         return True
 
+    @staticmethod
+    def alias_filepath(config_filepath: Optional[str]) -> Optional[str]:
+        '''The name -> alias map is kept next to the config file'''
+        if not config_filepath:
+            return None
+        return os.path.join(os.path.dirname(config_filepath), 'aliases.json')
+
+    @property
+    def aliases(self) -> AliasAllocator:
+        return self.__aliases
+
     @staticmethod
     def __init_config_file(config_filepath: str):
         if not config_filepath:
@@ -243,137 +678,779 @@ class SparkplugEdgeNode:
             return json.load(file)
 
 
-    def read(self, rbe: bool = True) -> List[dict]:
+    def read_metrics(self, rbe: bool = True, scan_classes: Optional[Iterable[str]] = None) -> List[SparkplugMetric]:
+        '''
+        Read all metrics (or the metrics of scan_classes), returns the metrics that should be published:
+        every metric read if rbe is False, otherwise only the changed metrics that are not rbe_ignore
+        '''
+        return self._read_targets(self._scan_targets(scan_classes, rbe=rbe), rbe=rbe)
+
+    def _read_targets(self, metrics: List[SparkplugMetric], rbe: bool = True) -> List[SparkplugMetric]:
+        if self.__read_executor is not None:
+            return self.__read_concurrently(metrics, rbe=rbe)
+
+        for unit in self._read_units(metrics):
+            unit.read()
+        return self._collect_changed(metrics, rbe=rbe)
+
+    def _read_units(self, metrics: Iterable[SparkplugMetric]) -> list:
+        '''What to call read() on for metrics: the metrics, with the members of a MetricGroup replaced by their group (read once)'''
+        if not self.__has_groups:
+            return metrics
+        units = []
+        groups = set()
+        for metric in metrics:
+            group = metric.group
+            if group is None:
+                units.append(metric)
+            elif id(group) not in groups:
+                groups.add(id(group))
+                units.append(group)
+        return units
+
+    def _read_deadline(self, now: int, units: list) -> int:
+        '''Monotonic millis by which the read units (metrics / groups) of one data source should have been read'''
+        return now + sum(unit.read_timeout or self.__read_timeout for unit in units)
+
+    def _scan_targets(self, scan_classes: Optional[Iterable[str]] = None, rbe: bool = True) -> List[SparkplugMetric]:
+        '''
+        Metrics to read for a scan of scan_classes (every class if None): all their metrics if rbe is False,
+        otherwise their polled metrics followed by their push metrics that reported a change
+        '''
+        classes = list(self.__scan_classes.values()) if scan_classes is None else [self.__scan_classes[name] for name in set(scan_classes)]
+        if not rbe:
+            if scan_classes is None:
+                self.__changes.clear()
+                return self.__registry.metrics
+            names = {scan_class.name for scan_class in classes}
+            self.__changes.take(lambda metric: (metric.scan_class or ScanClass.DEFAULT) in names)
+            return [metric for scan_class in classes for metric in scan_class.metrics]
+
+        if len(classes) == len(self.__scan_classes):
+            changed = self.__changes.take()
+        else:
+            names = {scan_class.name for scan_class in classes}
+            changed = self.__changes.take(lambda metric: (metric.scan_class or ScanClass.DEFAULT) in names)
+        if len(classes) == 1:
+            polled = classes[0].polled_metrics
+        else:
+            polled = [metric for scan_class in classes for metric in scan_class.polled_metrics]
+        return polled + changed if changed else polled
+
+    @property
+    def pending_changes(self) -> int:
+        '''Number of push metrics that reported a change not yet read by a scan'''
+        return len(self.__changes)
+
+    @property
+    def scan_classes(self) -> Dict[str, ScanClass]:
+        return dict(self.__scan_classes)
+
+    def _take_due_scan_classes(self) -> Set[str]:
+        '''Names of the scan classes that are due now, their next scan is scheduled'''
+        now = helpers.monotonic_millis()
+        due = set()
+        for scan_class in self.__scan_classes.values():
+            if scan_class.due(now):
+                scan_class.scanned(now)
+                due.add(scan_class.name)
+        return due
+
+    def _collect_changed(self, metrics: Iterable[SparkplugMetric], rbe: bool = True) -> List[SparkplugMetric]:
+        '''Second half of a scan: pick the metrics to publish out of the freshly read metrics, and record the scan time'''
+        now = helpers.monotonic_millis()
+        if not rbe:
+            changed = list(metrics)
+            self._mark_published(changed, now)
+        else:
+            changed = self.__collect_table(now)
+        self._mark_read()
+        return changed
+
+    def _mark_published(self, metrics: List[SparkplugMetric], now: Optional[int] = None):
+        '''metrics are published with their current values (e.g. in a birth), the next scans compare against them'''
+        now = helpers.monotonic_millis() if now is None else now
+        self.__table.clear_touched(metrics)
+        for metric in metrics:
+            metric.mark_published(now)
+
+    def _collect_read_results(self, read_ok: List[SparkplugMetric], stale: List[SparkplugMetric], rbe: bool = True) -> List[SparkplugMetric]:
+        '''_collect_changed for concurrent reads: read_ok finished reading, stale missed their read timeout'''
+        self._mark_read()
+        now = helpers.monotonic_millis()
         changed = []
-        for metric in self.__metrics:
-            metric.read()
-            if not rbe:
-                changed.append(metric.as_birth_metric())
-                continue
-            if metric.rbe_ignore:
+        for metric in stale:
+            newly_stale = metric.set_stale(True)
+            if newly_stale:
+                logging.warning(f'Read of metric "{metric.name}" timed out, reporting it stale')
+            if not rbe or (newly_stale and not metric.rbe_ignore):
+                changed.append(metric)
+        if not rbe:
+            self.__table.clear_touched(read_ok)
+            for metric in read_ok:
+                metric.set_stale(False)
+                metric.mark_published(now)
+                changed.append(metric)
+            return changed
+
+        self.__table.clear_touched(stale)  # a timed out read that finished since is not reported while the metric is stale
+        quality_changed = {id(metric) for metric in read_ok if metric.set_stale(False) and self._rbe_select(metric, now, quality_changed=True)}
+        changed.extend(metric for metric in read_ok if id(metric) in quality_changed)
+        changed.extend(self.__collect_table(now, skip=quality_changed | {id(metric) for metric in stale}))
+        return changed
+
+    def __collect_table(self, now: int, skip: Set[int] = frozenset()) -> List[SparkplugMetric]:
+        '''The metrics of the table that are due for publishing (the table applies the RbePolicies), marked published'''
+        due, suppressed = self.__table.collect(now)
+        changed = [metric for metric in due if not metric.rbe_ignore and id(metric) not in skip]
+        if self.__sampled:
+            changed.extend(self.__sampled_changes(changed, skip))
+        for metric in changed:
+            metric.mark_published(now)
+        self.__rbe_stats.published += len(changed)
+        self.__rbe_stats.suppressed += suppressed
+        return changed
+
+    def __sampled_changes(self, changed: List[SparkplugMetric], skip: Set[int]) -> List[SparkplugMetric]:
+        '''Metrics whose value did not change since the last scan, but that buffered samples before it was read'''
+        selected = {id(metric) for metric in changed}
+        selected.update(skip)
+        return [
+            metric for metric in self.__sampled
+            if not metric.rbe_ignore and id(metric) not in selected and metric.sample_buffer.pending(metric.read_millis)
+        ]
+
+    def _rbe_select(self, metric: SparkplugMetric, now: int, quality_changed: bool = False) -> bool:
+        '''True if the freshly read metric goes into the NDATA, applies its RbePolicy and counts the decision'''
+        if metric.rbe_ignore:
+            return False
+        if quality_changed or metric.rbe_due(now):
+            metric.mark_published(now)
+            self.__rbe_stats.published += 1
+            return True
+        if metric.value_changed:
+            self.__rbe_stats.suppressed += 1
+        return False
+
+    @property
+    def table(self) -> MetricTable:
+        return self.__table
+
+    @property
+    def rbe_stats(self) -> RbeStats:
+        '''Metrics published by RBE, and changed metrics held back by their RbePolicy'''
+        return self.__rbe_stats
+
+    def _mark_read(self):
+        '''Record the end of a scan, the next one is due scan rate millis from now'''
+        self.__last_read = helpers.monotonic_millis()
+
+    def __read_concurrently(self, metrics: List[SparkplugMetric], rbe: bool = True) -> List[SparkplugMetric]:
+        '''
+        read_metrics for read_workers mode: blocking reads run on the executor, one task per data source
+        (or per metric without one). Reads that miss their timeout, or whose previous read is still running,
+        are marked stale and do not hold up the rest of the scan.
+        '''
+        groups: Dict[object, List[SparkplugMetric]] = {}
+        inline = []
+        for metric in metrics:
+            if not metric.blocking_read:
+                inline.append(metric)
                 continue
-            if not metric.value_changed:
+            key = metric.data_source if metric.data_source is not None else id(metric)
+            groups.setdefault(key, []).append(metric)
+
+        now = helpers.monotonic_millis()
+        deadlines: Dict[Future, int] = {}
+        futures: Dict[Future, List[SparkplugMetric]] = {}
+        progress: Dict[Future, List[SparkplugMetric]] = {}
+        stale: List[SparkplugMetric] = []
+        for key, group in groups.items():
+            pending = self.__pending_reads.get(key)
+            if pending is not None and not pending.done():
+                logging.debug(f'Previous read of data source "{key}" still running, skipping it this scan')
+                stale.extend(group)
                 continue
-            changed.append(metric.as_rbe_metric())
-        self.__last_read = helpers.millis()
-        return changed
+            units = self._read_units(group)
+            done_reading = []
+            future = self.__read_executor.submit(self.__read_group, units, done_reading)
+            self.__pending_reads[key] = future
+            futures[future] = group
+            progress[future] = done_reading
+            deadlines[future] = self._read_deadline(now, units)
+
+        for unit in self._read_units(inline):
+            unit.read()
+
+        read_ok: List[SparkplugMetric] = []
+        not_done = set(futures)
+        while not_done:
+            timeout = (min(deadlines[future] for future in not_done) - helpers.monotonic_millis()) / 1000
+            done, not_done = wait(not_done, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                read_ok.extend(futures[future])
+            now = helpers.monotonic_millis()
+            for future in [future for future in not_done if deadlines[future] <= now]:
+                not_done.discard(future)
+                finished = list(progress[future])
+                finished_ids = {id(metric) for metric in finished}
+                read_ok.extend(finished)
+                stale.extend(metric for metric in futures[future] if id(metric) not in finished_ids)
+        return self._collect_read_results(inline + read_ok, stale, rbe=rbe)
+
+    @staticmethod
+    def __read_group(units: list, done_reading: List[SparkplugMetric]):
+        '''Read the units of one data source one after the other, done_reading tracks the metrics read so far'''
+        for unit in units:
+            unit.read()
+            if isinstance(unit, SparkplugMetric):
+                done_reading.append(unit)
+            else:
+                done_reading.extend(unit.metrics)
+
+    def read(self, rbe: bool = True) -> List[dict]:
+        if not rbe:
+            return [metric.as_birth_metric() for metric in self.read_metrics(rbe=False)]
+        return [metric.as_rbe_metric() for metric in self.read_metrics(rbe=True)]
+
+    @property
+    def read_timeout(self) -> int:
+        '''Default per metric read timeout (ms) of concurrent reads'''
+        return self.__read_timeout
+
+    @property
+    def _read_executor(self) -> Optional[ThreadPoolExecutor]:
+        return self.__read_executor
 
     @property
     def metrics(self) -> List[SparkplugMetric]:
-        return self.__metrics
+        return self.__registry.metrics
+
+    @property
+    def registry(self) -> MetricRegistry:
+        return self.__registry
 
     @property
     def last_read_delta(self) -> int:
-        return helpers.millis() - self.__last_read
+        return helpers.monotonic_millis() - self.__last_read
     
     @property
     def read_due(self) -> bool:
-        if self.__scan_rate.current_value is None:
-            return True
-        return self.last_read_delta >= self.__scan_rate.current_value
+        '''True if any scan class is due'''
+        now = helpers.monotonic_millis()
+        return any(scan_class.due(now) for scan_class in self.__scan_classes.values())
 
     @property
     def last_config_save_delta(self) -> int:
-        return helpers.millis() - self.__last_config_save
+        return helpers.monotonic_millis() - self.__last_config_save
 
     @property
     def config_save_due(self) -> bool:
         if not self.__config_save_rate:
             return False
         return self.last_config_save_delta >= self.__config_save_rate
+
+    @property
+    def next_read_deadline(self) -> int:
+        '''Monotonic millis at which the next scan (of any scan class) is due'''
+        return min(scan_class.next_deadline for scan_class in self.__scan_classes.values())
+
+    @property
+    def next_config_save_deadline(self) -> Optional[int]:
+        '''Monotonic millis at which the next config save is due, None if config saving is disabled'''
+        if not self.__config_save_rate or not self.__config_filepath:
+            return None
+        if not self.__last_config_save:
+            return helpers.monotonic_millis()
+        return self.__last_config_save + self.__config_save_rate
+
+    @property
+    def tick_stats(self) -> Dict[str, TickStats]:
+        '''How late (ms) each scheduled tick ("scan", "config_save") fired relative to its deadline'''
+        return self.__scheduler.stats
     
-    def make_payload_from_metrics(self, metrics: List[dict]) -> bytes:
+    def make_payload_from_metrics(self, metrics: List[dict], timestamp: Optional[int] = None) -> bytes:
         payload_dict = {
-            'timestamp': helpers.millis(),
+            'timestamp': helpers.millis() if timestamp is None else timestamp,
             'seq': self.__seq.current_value,
             'metrics': metrics
         }
         return ParseDict(payload_dict, sparkplug_pb2.Payload()).SerializeToString()
 
+    def make_payload_from_metric_objects(self, metrics: List[SparkplugMetric], birth: bool = False, timestamp: Optional[int] = None, historical: bool = False) -> bytes:
+        '''
+        Same output as make_payload_from_metrics([metric.as_rbe_metric() ...]) (or as_birth_metric when birth is True),
+        but fills the protobuf messages directly instead of going through ParseDict
+        '''
+        payload = self.__new_payload(timestamp=timestamp)
+        payload.seq = self.__seq.current_value
+        self.__add_metrics_to_payload(payload, metrics, birth=birth, historical=historical)
+        return payload.SerializeToString()
+
+    def __split_data_payload(self, payload: sparkplug_pb2.Payload, message_type: str = 'NDATA') -> List[sparkplug_pb2.Payload]:
+        '''payload split to fit max_payload_size, the seq of the chunks is set when they are encoded'''
+        if self.__max_payload_size is None:
+            return [payload]
+        payload.seq = 255  # split with the widest seq, chunks may wrap past 127 (or be replayed with any seq)
+        chunks = split_payload(payload, self.__max_payload_size)
+        if len(chunks) > 1:
+            self.__payload_sizes.record_split(message_type, len(chunks))
+        return chunks
+
+    def __encode_chunks(self, chunks: List[sparkplug_pb2.Payload], message_type: str, seq: int) -> List[bytes]:
+        encoded = []
+        for idx, chunk in enumerate(chunks):
+            chunk.seq = (seq + idx) % 256
+            encoded.append(chunk.SerializeToString())
+            self.__check_encoded_size(message_type, len(encoded[-1]))
+        return encoded
+
+    def __check_encoded_size(self, message_type: str, size: int):
+        if self.__max_payload_size is not None and size > self.__max_payload_size:
+            logging.warning(f'{message_type} metric larger than max_payload_size ({size} > {self.__max_payload_size} bytes)')
+            self.__payload_sizes.record_oversized(message_type)
+
+    def __publish_chunks(self, client: mqtt_functions.mqtt.Client, topic: str, chunks: List[sparkplug_pb2.Payload]):
+        '''Publish the chunks of a payload with consecutive seq'''
+        message_type = self.__message_type(topic)
+        with self.__publish_lock:
+            for payload in self.__encode_chunks(chunks, message_type, self.__take_seq(len(chunks))):
+                self.__mqtt_publish(client=client, topic=topic, payload=payload)
+
+    def __take_seq(self, count: int = 1) -> int:
+        '''First of count consecutive seq numbers for messages being encoded, callers hold __publish_lock'''
+        seq = self.__seq.current_value
+        for _ in range(count):
+            self.__seq.next_value()
+        return seq
+
+    @staticmethod
+    def __new_payload(timestamp: Optional[int] = None) -> sparkplug_pb2.Payload:
+        payload = sparkplug_pb2.Payload()
+        payload.timestamp = helpers.millis() if timestamp is None else timestamp
+        return payload
+
+    @classmethod
+    def __add_metrics_to_payload(cls, payload: sparkplug_pb2.Payload, metrics: List[SparkplugMetric], birth: bool = False, historical: bool = False, compact: bool = False):
+        start = len(payload.metrics)
+        for metric in metrics:
+            pb_metric = payload.metrics.add()
+            if birth:
+                metric.fill_birth_metric(pb_metric, with_value=False, compact=compact)
+            else:
+                metric.fill_rbe_metric(pb_metric, with_value=False)
+        cls.__fill_values(payload.metrics[start:] if start else payload.metrics, metrics)
+        if historical:
+            for metric in payload.metrics:
+                metric.is_historical = True
+
+    def __add_data_metrics(self, payload: sparkplug_pb2.Payload, metrics: List[SparkplugMetric], historical: bool = False) -> List[SparkplugMetric]:
+        '''
+        NDATA / DDATA metrics, preceded by the samples the metrics buffered since their last publish.
+        Returns the metrics added after the samples, a metric whose last sample is its current value is not added again
+        '''
+        if self.__sampled:
+            metrics = [metric for metric in metrics if metric.sample_buffer is None or metric.fill_sample_metrics(payload.metrics)]
+        self.__add_metrics_to_payload(payload, metrics, historical=historical)
+        return metrics
+
+    @staticmethod
+    def __fill_values(pb_metrics, metrics: List[SparkplugMetric]):
+        '''Values are filled per column, so they are converted in bulk (see MetricColumn.fill_payload_values)'''
+        columns: Dict[int, tuple] = {}
+        for pb_metric, metric in zip(pb_metrics, metrics):
+            column = metric.column
+            entry = columns.get(id(column))
+            if entry is None:
+                entry = columns[id(column)] = (column, [], [])
+            entry[1].append(pb_metric)
+            entry[2].append(metric.row)
+        for column, column_pb_metrics, rows in columns.values():
+            column.fill_payload_values(column_pb_metrics, rows)
+
+    @classmethod
+    def __encode_birth_metrics(cls, metrics: List[SparkplugMetric]) -> bytes:
+        '''
+        The metrics of a birth as encoded Payload fields, to append to an encoded Payload header.
+        Each metric is its cached birth template with its current timestamp and value put in field number order,
+        so a rebirth only encodes what changed since the last one and the bytes are those of a full encode
+        '''
+        current = sparkplug_pb2.Payload()
+        for _ in metrics:
+            current.metrics.add()
+        cls.__fill_values(current.metrics, metrics)
+        encoded = bytearray()
+        for metric, pb_metric in zip(metrics, current.metrics):
+            head, datatype, properties = metric.birth_template()
+            timestamp = b'\x18' + encode_varint(metric.read_millis)  # Metric.timestamp (3)
+            value = pb_metric.SerializeToString()  # is_null (7) goes before the properties (9), a value (10+) after them
+            encoded += b'\x12'  # Payload.metrics, length delimited
+            encoded += encode_varint(len(head) + len(timestamp) + len(datatype) + len(properties) + len(value))
+            encoded += head
+            encoded += timestamp
+            encoded += datatype
+            if pb_metric.is_null:
+                encoded += value
+                encoded += properties
+            else:
+                encoded += properties
+                encoded += value
+        return bytes(encoded)
+
+    @staticmethod
+    def __add_node_metric(payload: sparkplug_pb2.Payload, name: str, datatype: SparkplugDataTypes, value) -> sparkplug_pb2.Payload.Metric:
+        metric = payload.metrics.add()
+        metric.timestamp = payload.timestamp
+        metric.name = name
+        metric.datatype = datatype.value
+        setattr(metric, datatype.value_key, value)
+        return metric
+
     def loop_forever(self):
-        if not self.__running:
-            logging.info('Starting Edge Node MQTT loop!')
-            self.start_client()
-        logging.info('MQTT started! Starting RBE loop')
-        while True:
-            if not self.__client.is_connected:
-                return
-            if self.read_due:
-                logging.debug('Tag Read Due!')
-                self._rbe()
-            elif self.__force_rbe:
-                logging.debug('RBE Forced!')
-                self.__force_rbe = False
-                self._rbe()
-            if self.config_save_due:
-                logging.debug('Config Save Due!')
-                self.save_config()
-
-    def _rbe(self):
-        metrics_to_publish = self.read()
+        logging.info('Starting Edge Node MQTT loop!')
+        self.__loop_running = True
+        if self.__pipeline is not None:
+            self.__pipeline.start()
+        try:
+            while True:
+                self._update_deadlines()
+                due = self.__scheduler.wait()
+                self.__run_commands()
+                forced = self._take_force_rbe()
+                scan_classes = self._take_due_scan_classes()
+                if scan_classes:
+                    logging.debug(f'Tag Read Due! (scan classes: {", ".join(sorted(scan_classes))})')
+                elif forced:
+                    logging.debug('RBE Forced!')
+                if scan_classes or forced:
+                    self._rbe(scan_classes | forced)
+                if 'config_save' in due:
+                    logging.debug('Config Save Due!')
+                    self.save_config()
+                if 'replay' in due:
+                    self._replay_stored()
+                if 'batch' in due:
+                    self._publish_batches()
+                if 'sample' in due:
+                    for metric in self._take_due_samples():
+                        metric.sample()
+        finally:
+            self.__loop_running = False
+            self._publish_batches(flush=True)
+            if self.__pipeline is not None:
+                self.__pipeline.stop()
+            self.__run_commands()
+
+    def _update_deadlines(self):
+        '''Service the broker connection and (re)set the deadlines of every loop tick'''
+        self.__scheduler.set_deadline('broker', self._maintain_connection())
+        self.__scheduler.set_deadline('scan', self.next_read_deadline)
+        self.__scheduler.set_deadline('config_save', self.next_config_save_deadline)
+        self.__scheduler.set_deadline('replay', self.next_replay_deadline)
+        self.__scheduler.set_deadline('batch', self.__batcher.next_deadline if self.__batcher is not None else None)
+        self.__scheduler.set_deadline('sample', self.__sampling.next_deadline)
+
+    def _take_due_samples(self) -> List[SparkplugMetric]:
+        '''Metrics whose sample_rate says they should be sampled now'''
+        return self.__sampling.take_due()
+
+    def _rbe(self, scan_classes: Optional[Iterable[str]] = None):
+        '''Read the metrics of scan_classes (all of them if None) and publish the changes as one NDATA'''
+        metrics_to_publish = self.read_metrics(scan_classes=scan_classes)
         if metrics_to_publish:
             logging.debug(f'{len(metrics_to_publish)} Values have changed, publish')
-            self.__mqtt_publish(
-                client=self.__client,
-                topic=self.__topics.NDATA,
-                payload=self.make_payload_from_metrics(metrics_to_publish)
-            )
+            self._publish_changes(metrics_to_publish)
+
+    def _publish_changes(self, metrics: List[SparkplugMetric]):
+        '''Publish the changes of a scan: node metrics as NDATA, device metrics as one DDATA per device'''
+        if not self.__device_of:
+            self._publish_ndata(metrics)
+            return
+        node_metrics = []
+        by_device: Dict[str, List[SparkplugMetric]] = {}
+        for metric in metrics:
+            device = self.__device_of.get(id(metric))
+            if device is None:
+                node_metrics.append(metric)
+            else:
+                by_device.setdefault(device.device_id, []).append(metric)
+        if node_metrics:
+            self._publish_ndata(node_metrics)
+        for device_id, device_metrics in by_device.items():
+            self._publish_ddata(self.__devices[device_id], device_metrics)
+
+    def _publish_ndata(self, metrics: List[SparkplugMetric]):
+        self.__publish_data(self.__topics.NDATA, metrics)
+
+    def _publish_ddata(self, device: 'SparkplugDevice', metrics: List[SparkplugMetric]):
+        if not device.enabled or (self.online and not device.online):
+            logging.debug(f'Device "{device.device_id}" is not born, dropping DDATA')
+            return
+        self.__publish_data(device.topics.DDATA, metrics)
+
+    def __publish_data(self, topic: str, metrics: List[SparkplugMetric]):
+        '''NDATA / DDATA (several messages if over max_payload_size), stored for replay while offline'''
+        message_type = self.__message_type(topic)
+        if self.__store_forward is not None and not self.online:
+            payload = self.__new_payload()
+            self.__add_data_metrics(payload, metrics, historical=True)
+            for chunk in self.__encode_chunks(self.__split_data_payload(payload, message_type), message_type, seq=0):  # seq is set on replay
+                if self.__store_forward.append(topic, chunk):
+                    logging.debug(f'Offline, stored {topic} with {len(metrics)} metrics')
+            return
+        if self.__batcher is not None:
+            payload = self.__new_payload()
+            metrics = self.__add_data_metrics(payload, metrics)  # the values of this scan, later scans may replace them in the batch
+            samples = [None] * (len(payload.metrics) - len(metrics))  # samples are always kept
+            if self.__batcher.add(topic, samples + [id(metric) for metric in metrics], payload):
+                self.__publish_batch(topic, self.__batcher.take(topic))
+            return
+        if self.__pipeline is not None and self.__pipeline.running:
+            payload = self.__new_payload()
+            self.__add_data_metrics(payload, metrics)  # values are taken on the loop thread, the encoder only serializes them
+            self.__pipeline.submit((topic, payload, self.__session))
+            return
+        payload = self.__new_payload()
+        self.__add_data_metrics(payload, metrics)
+        self.__publish_chunks(self.__client, topic, self.__split_data_payload(payload, message_type))
+
+    def _publish_batches(self, flush: bool = False):
+        '''Publish the batches whose window ended (all of them if flush)'''
+        if self.__batcher is None:
+            return
+        for topic, payload in self.__batcher.take_due(flush=flush):
+            self.__publish_batch(topic, payload)
+
+    def flush_batches(self):
+        '''Publish the batched NDATA / DDATA now'''
+        self._publish_batches(flush=True)
+
+    def __publish_batch(self, topic: str, payload: Optional[sparkplug_pb2.Payload]):
+        if payload is None:
+            return
+        if self.__pipeline is not None and self.__pipeline.running:
+            self.__pipeline.submit((topic, payload, self.__session))
+            return
+        self.__publish_job(self.__encode_job((topic, payload, self.__session)))
+
+    @property
+    def batch_stats(self) -> Optional[BatchStats]:
+        return self.__batcher.stats if self.__batcher is not None else None
 
-    def force_rbe(self):
-        self.__force_rbe = True
+    '''PublishPipeline stages'''
+    def __encode_job(self, job: Tuple[str, sparkplug_pb2.Payload, int]) -> Tuple[str, List[bytes], int]:
+        '''
+        job is (topic, payload, session) of a scan or a batch, the payload is split and serialized without seq:
+        __publish_job() appends the seq field when it publishes (protobuf merges fields, like the birth templates)
+        '''
+        topic, payload, session = job
+        message_type = self.__message_type(topic)
+        records = []
+        for chunk in self.__split_data_payload(payload, message_type):
+            chunk.ClearField('seq')
+            records.append(chunk.SerializeToString())
+            self.__check_encoded_size(message_type, len(records[-1]) + 3)  # + the seq field, at most 3 bytes
+        return topic, records, session
+
+    def __publish_job(self, encoded: Tuple[str, List[bytes], int]):
+        '''
+        Publish, unless the connection went away or an NBIRTH was published (a new session) while the message was queued:
+        it is then stored as historical data (dropped without store and forward), never published after the newer NBIRTH
+        '''
+        topic, records, session = encoded
+        with self.__publish_lock:
+            if self.online and session == self.__session:
+                seq = self.__take_seq(len(records))
+                for idx, record in enumerate(records):
+                    self.__mqtt_publish(client=self.__client, topic=topic, payload=record + b'\x18' + encode_varint((seq + idx) % 256))
+                return
+        self.__store_queued(topic, records)
+
+    def __discard_queued(self):
+        '''Jobs still queued in the pipeline at an NBIRTH are older than it: stored as historical data (or dropped)'''
+        jobs, encoded = self.__pipeline.discard()
+        for job in jobs:
+            encoded.append(self.__encode_job(job))
+        for topic, records, _ in encoded:
+            self.__store_queued(topic, records)
+
+    def __store_queued(self, topic: str, records: List[bytes]):
+        if self.__store_forward is None:
+            logging.debug(f'Offline or reborn, dropping queued {topic}')
+            return
+        for record in records:
+            chunk = sparkplug_pb2.Payload()
+            chunk.ParseFromString(record)
+            for metric in chunk.metrics:
+                metric.is_historical = True
+            chunk.seq = 0  # set on replay
+            self.__store_forward.append(topic, chunk.SerializeToString())
+
+    @property
+    def pipeline_stats(self) -> Optional[PipelineStats]:
+        return self.__pipeline.stats if self.__pipeline is not None else None
+
+    @property
+    def _pipeline(self) -> Optional[PublishPipeline]:
+        return self.__pipeline
+
+    @staticmethod
+    def __message_type(topic: str) -> str:
+        '''NBIRTH, NDATA, DDATA... of a spBv1.0 topic'''
+        parts = topic.split('/', 3)
+        return parts[2] if len(parts) > 2 else topic
+
+    def __birth_payload(self, metrics: List[SparkplugMetric], message_type: str, seq: int, bdseq: Optional[int] = None) -> bytes:
+        '''NBIRTH (with bdseq) / DBIRTH, rebuilt compact if it is over max_payload_size since births cannot be split'''
+        for compact in (False, True):
+            payload = self.__new_payload()
+            if bdseq is not None:
+                self.__add_node_metric(payload, 'bdSeq', SparkplugDataTypes.UInt64, bdseq)
+            if compact:
+                payload.seq = seq
+                self.__add_metrics_to_payload(payload, metrics, birth=True, compact=True)
+                encoded = payload.SerializeToString()
+            else:
+                encoded = payload.SerializeToString() + self.__encode_birth_metrics(metrics) + b'\x18' + encode_varint(seq)  # Payload.seq (3) after the metrics (2)
+            if self.__max_payload_size is None or len(encoded) <= self.__max_payload_size:
+                return encoded
+        logging.error(f'{message_type} is larger than max_payload_size ({len(encoded)} > {self.__max_payload_size} bytes) with {len(metrics)} metrics, it cannot be split: move metrics to devices')
+        self.__payload_sizes.record_oversized(message_type)
+        return encoded
+
+    @property
+    def payload_stats(self) -> PayloadSizeStats:
+        return self.__payload_sizes
+
+    def _publish_dbirth(self, device: 'SparkplugDevice', client: Optional[mqtt_functions.mqtt.Client] = None) -> bool:
+        '''Publish the DBIRTH of device if the node is online, returns True if it was published'''
+        client = self.__client if client is None else client
+        if not self.__online or not client.is_connected():
+            return False
+        metrics = self._birth_metrics(device)
+        with self.__publish_lock:
+            self.__mqtt_publish(client, device.topics.DBIRTH, self.__birth_payload(metrics, 'DBIRTH', seq=self.__take_seq()))
+        device._born(self.__session)
+        logging.debug(f'PUBLISHED DBIRTH of device "{device.device_id}"')
+        return True
+
+    def _publish_ddeath(self, device: 'SparkplugDevice') -> bool:
+        '''Publish the DDEATH of device if it is online, returns True if it was published'''
+        if not device.online:
+            return False
+        payload = self.__new_payload()
+        with self.__publish_lock:
+            payload.seq = self.__take_seq()
+            self.__mqtt_publish(self.__client, device.topics.DDEATH, payload.SerializeToString())
+        logging.debug(f'PUBLISHED DDEATH of device "{device.device_id}"')
+        return True
+
+    def __publish_device_births(self, client: mqtt_functions.mqtt.Client):
+        '''DBIRTH of every enabled device, after an NBIRTH'''
+        for device in list(self.__devices.values()):
+            if device.enabled:
+                self._publish_dbirth(device, client=client)
+
+    @property
+    def online(self) -> bool:
+        '''Connected to the broker and NBIRTH has been published'''
+        return self.__online and self.__client.is_connected()
+
+    @property
+    def store_forward(self) -> Optional[SegmentLog]:
+        return self.__store_forward
+
+    @property
+    def next_replay_deadline(self) -> Optional[int]:
+        '''Monotonic millis at which the next stored message should be replayed, None if there is nothing to replay'''
+        if self.__store_forward is None or not self.online or self.__store_forward.empty:
+            return None
+        return self.__last_replay + 1000 // max(self.__store_forward.config.replay_rate, 1)
+
+    def _replay_stored(self):
+        self.__last_replay = helpers.monotonic_millis()
+        record = self.__store_forward.peek()
+        if record is None:
+            return
+        topic, stored_payload = record
+        payload = sparkplug_pb2.Payload()
+        payload.ParseFromString(stored_payload)
+        with self.__publish_lock:
+            if not self.online:
+                return
+            payload.seq = self.__seq.current_value
+            result = self.__mqtt_publish(client=self.__client, topic=topic, payload=payload.SerializeToString())
+            if result.rc != mqtt_functions.mqtt.MQTT_ERR_SUCCESS:
+                logging.warning(f'Store and forward replay failed (rc {result.rc}), will retry')
+                return
+            self.__take_seq()  # only taken once published, a failed replay leaves no gap in seq
+        self.__store_forward.pop()
+        if self.__store_forward.empty:
+            logging.info(f'Store and forward replay complete: {self.__store_forward.stats}')
+
+    def force_rbe(self, scan_classes: Optional[Iterable[str]] = None):
+        '''Have the loop read and publish the scan classes now (all of them if None), safe to call from any thread'''
+        with self.__force_rbe_lock:
+            self.__force_rbe.update(self.__scan_classes if scan_classes is None else scan_classes)
+        self._wake()
+
+    def _take_force_rbe(self) -> Set[str]:
+        '''Scan classes (once) passed to force_rbe() since the last call'''
+        with self.__force_rbe_lock:
+            forced, self.__force_rbe = self.__force_rbe, set()
+        return forced
+
+    def _wake(self):
+        '''Wake the loop so it re-evaluates its deadlines now, safe to call from any thread'''
+        self.__scheduler.wake()
+
+    @property
+    def _scheduler(self) -> DeadlineScheduler:
+        return self.__scheduler
 
     '''
     Sparkplug functions
     '''
-    def __get_ndeath_payload(self) -> bytes:
-        millis = helpers.millis()
-        
-        return ParseDict({
-            'timestamp': millis,
-            'metrics': [
-                {
-                    'timestamp': millis,
-                    'name': 'bdSeq',
-                    'datatype': SparkplugDataTypes.UInt64.value,
-                    'long_value': self.__bdseq.current_value
-                }
-            ]
-        }, sparkplug_pb2.Payload()).SerializeToString()
-        
-    
-    def __get_nbirth_payload(self, rebirth: bool = False) -> bool:
-        logging.debug(f'MAKING BIRTH PAYLOAD, bdSeq: {self.__bdseq.previous_value if rebirth else self.__bdseq.current_value}')
-        millis = helpers.millis()
-        self.__seq.reset()  # Remove this line for sparkplug 3.0.0
+    def __get_ndeath_payload(self, rebirth: bool = False) -> bytes:
+        '''rebirth: death of the current session (its bdSeq was already incremented after NBIRTH)'''
+        payload = self.__new_payload()
+        self.__add_node_metric(payload, 'bdSeq', SparkplugDataTypes.UInt64, self.__bdseq.previous_value if rebirth else self.__bdseq.current_value)
+        return payload.SerializeToString()
 
-        payload = {
-            'timestamp': millis,
-            'seq': self.__seq.current_value,
-            'metrics': [
-                {
-                    'timestamp': millis,
-                    'name': 'bdSeq',
-                    'datatype': SparkplugDataTypes.UInt64.value,
-                    'long_value': self.__bdseq.previous_value if rebirth else self.__bdseq.current_value
-                },
-                {
-                    'timestamp': millis,
-                    'name': 'Node Control/Rebirth',
-                    'datatype': SparkplugDataTypes.Boolean.value,
-                    'boolean_value': False
-                }
-            ]
-        }
-        # add metrics to payload
-        payload['metrics'].extend(self.read(rbe=False))
-        
-        return ParseDict(payload, sparkplug_pb2.Payload()).SerializeToString()
-
-
-    def __sparkplug_message_published(self):
-        logging.info(f'SPARKPLUG MESSAGE PUBLISHED (seq: {self.__seq.current_value})')
-        self.__seq.next_value()
+    
+    def __publish_nbirth(self, client: mqtt_functions.mqtt.Client, rebirth: bool = False) -> mqtt_functions.mqtt.MQTTMessageInfo:
+        '''rebirth: NBIRTH of the current session again (its bdSeq was already incremented after the first NBIRTH)'''
+        bdseq = self.__bdseq.previous_value if rebirth else self.__bdseq.current_value
+        logging.debug(f'MAKING BIRTH PAYLOAD, bdSeq: {bdseq}')
+        if self.__batcher is not None:  # batched before the birth (e.g. scanned while connecting), older than its values
+            dropped = self.__batcher.clear()
+            if dropped:
+                logging.debug(f'Dropped {dropped} batched metrics superseded by the NBIRTH')
+        if self.__pipeline is not None:
+            self.__discard_queued()
+        metrics = self._birth_metrics()
+        with self.__publish_lock:
+            self.__seq.reset()  # Remove this line for sparkplug 3.0.0
+            payload = self.__birth_payload(metrics, 'NBIRTH', seq=self.__take_seq(), bdseq=bdseq)
+            return self.__mqtt_publish(client, self.__topics.NBIRTH, payload)
+
+
+    def _birth_metrics(self, device: Optional['SparkplugDevice'] = None) -> List[SparkplugMetric]:
+        '''Freshly read metrics for NBIRTH (or the DBIRTH of device)'''
+        if device is None:
+            return self.read_metrics(rbe=False)
+        return self._read_targets(device.metrics, rbe=False)
 
+    @property
+    def publish_stats(self) -> PublishTracker:
+        '''Publishes in flight and their latencies (publish to on_publish) per message type'''
+        return self.__publishes
+
+    def __request_rebirth(self, value) -> bool:
+        '''write_function of "Node Control/Rebirth", _finish_ncmd() rebirths for the commands that wrote True'''
+        if value:
+            logging.debug(f'REBIRTH NCMD SET')
+        return True
 
     def __on_ncmd_message(self, client, userdata, message):
         if message.topic != self.__topics.NCMD:
@@ -381,90 +1458,199 @@ class SparkplugEdgeNode:
             return
         logging.debug('Received NCMD Message!')
         try:
-            trigger_publish: bool = False
-            trigger_rebirth: bool = False
             payload = sparkplug_pb2.Payload()
             payload.ParseFromString(message.payload)
-            data = MessageToDict(payload)
-            for metric in data['metrics']:
-                if metric.get('name') is None and metric.get('alias') is None:
-                    continue
-
-                if metric['name'] == 'Node Control/Rebirth' and metric['booleanValue']:
-                    logging.debug(f'REBIRTH NCMD SET')
-                    trigger_rebirth = True
-                elif metric['name'] == 'Node Control/Scan Rate' and metric['longValue']:
-                    new_scan_rate = int(metric['longValue'])
-                    if 499 < new_scan_rate < 3600001:
-                        self.__scan_rate.write(new_scan_rate)
-                        trigger_publish = True
-                else:
-                    # match metric by name
-                    for metric_obj in self.__metrics:
-                        if metric['name'] != metric_obj.name:
-                            continue
-                        if not metric_obj.writable:
-                            logging.warning(f'Ignoring NCMD: cannot write to read only tag "{metric_obj.name}"')
-                            break
-                        if metric_obj.value_key_camel_case in metric.keys():
-                            new_value = metric[metric_obj.value_key_camel_case]
-
-                        value_key = metric_obj.value_key_camel_case if metric_obj.value_key_camel_case in metric.keys() else None
-                        if not value_key:
-                            if metric_obj.value_key in metric.keys():
-                                value_key = metric_obj.value_key
-                            else:
-                                logging.error(f'NCMD Error: mismatched value key for metric "{metric_obj.name}". Expected value key "{metric_obj.value_key_camel_case}"')
-                                break
-
-                        new_value = metric[value_key]
-                        if metric_obj.write(new_value):
-                            trigger_publish = True
-                            logging.info(f'NCMD, wrote "{new_value}" to metric "{metric_obj.name}"')
-                        else:
-                            logging.error(f'Failed to write value "{new_value}" to metric "{metric_obj.name}"')
-                            trigger_rebirth = True  # Trigger rebirth so app that sent NCMD will know value hasn't changed
-                        break
-            
-            if trigger_rebirth:
-                payload = self.__get_nbirth_payload(rebirth=True)
-                if payload:
-                    self.__mqtt_publish(client=client, topic=self.__topics.NBIRTH, payload=payload)
-                    logging.info('Rebirth Published!')
-                return
-            if not trigger_publish:
-                return
-            self._rbe()
+            self.__dispatch_command(client, payload)
         except (DecodeError, KeyError, ValueError) as err:
             logging.error(f'NCMD failed: {err}')
 
+    def __on_dcmd_message(self, client, userdata, message):
+        device = self.__devices.get(self.__topics.dcmd_device_id(message.topic))
+        if device is None:
+            logging.debug(f'Ignoring DCMD for unknown device: "{message.topic}"')
+            return
+        logging.debug(f'Received DCMD Message for device "{device.device_id}"!')
+        try:
+            payload = sparkplug_pb2.Payload()
+            payload.ParseFromString(message.payload)
+            self.__dispatch_command(client, payload, device=device)
+        except (DecodeError, KeyError, ValueError) as err:
+            logging.error(f'DCMD failed: {err}')
+
+    def __dispatch_command(self, client: mqtt_functions.mqtt.Client, payload: sparkplug_pb2.Payload, device: Optional['SparkplugDevice'] = None):
+        '''With a pipeline the loop runs the writes, the network thread only parses the command'''
+        if self.__pipeline is not None and self.__loop_running:
+            self.__commands.append((client, payload, device))
+            self._wake()
+            return
+        self._process_ncmd(client, payload, device=device)
+
+    def __run_commands(self):
+        while self.__commands:
+            client, payload, device = self.__commands.popleft()
+            try:
+                self._process_ncmd(client, payload, device=device)
+            except (KeyError, ValueError) as err:
+                logging.error(f'NCMD failed: {err}')
+
+    def _process_ncmd(self, client: mqtt_functions.mqtt.Client, payload: sparkplug_pb2.Payload, device: Optional['SparkplugDevice'] = None):
+        '''Write the metrics of an NCMD (or of a DCMD to device)'''
+        writes, group_writes = self._split_group_writes(self._resolve_ncmd_writes(payload, device=device))
+        results = []
+        for metric_obj, new_value in writes:
+            results.append((metric_obj, new_value, metric_obj.write(new_value)))
+        for group, member_writes in group_writes:
+            results.extend((metric_obj, new_value, success) for (metric_obj, new_value), success in zip(member_writes, group.write(member_writes)))
+        self._finish_ncmd(client, results, device=device)
+
+    @staticmethod
+    def _split_group_writes(writes: List[Tuple[SparkplugMetric, object]]) -> Tuple[list, list]:
+        '''(writes to plain metrics, [(group, writes to its members)]): the writes to a MetricGroup are made in one call'''
+        plain = []
+        groups: Dict[int, tuple] = {}
+        for metric_obj, new_value in writes:
+            group = metric_obj.group
+            if group is None:
+                plain.append((metric_obj, new_value))
+            else:
+                groups.setdefault(id(group), (group, []))[1].append((metric_obj, new_value))
+        return plain, list(groups.values())
+
+    def _resolve_ncmd_writes(self, payload: sparkplug_pb2.Payload, device: Optional['SparkplugDevice'] = None) -> List[Tuple[SparkplugMetric, object]]:
+        '''(metric, value) for every valid write in an NCMD (DCMD to device) payload, invalid ones are logged and skipped'''
+        registry = self.__registry if device is None else device.registry
+        writes = []
+        for metric in payload.metrics:
+            name = metric.name if metric.HasField('name') else None
+            alias = metric.alias if metric.HasField('alias') else None
+            if name is None and alias is None:
+                continue
+
+            metric_obj = registry.get(name=name, alias=alias)
+            if metric_obj is None:
+                logging.warning(f'Ignoring NCMD: unknown metric (name: "{name}", alias: {alias})')
+                continue
+            if not metric_obj.writable:
+                logging.warning(f'Ignoring NCMD: cannot write to read only tag "{metric_obj.name}"')
+                continue
+
+            value_key = metric.WhichOneof('value')
+            if value_key != metric_obj.value_key:
+                logging.error(f'NCMD Error: mismatched value key for metric "{metric_obj.name}". Expected value key "{metric_obj.value_key}"')
+                continue
+
+            writes.append((metric_obj, getattr(metric, value_key)))
+        return writes
+
+    def _finish_ncmd(self, client: mqtt_functions.mqtt.Client, results: List[Tuple[SparkplugMetric, object, bool]], device: Optional['SparkplugDevice'] = None):
+        '''Publish the outcome of the (metric, value, success) writes of an NCMD (or of a DCMD to device)'''
+        written_scan_classes: Set[str] = set()
+        failed: Dict[int, SparkplugMetric] = {}
+        rebirth_requested = False  # decided per command, commands may be written concurrently (AsyncSparkplugEdgeNode)
+        for metric_obj, new_value, success in results:
+            if success and metric_obj is self.__rebirth:
+                rebirth_requested = device is None and bool(new_value)
+                continue
+            if success:
+                written_scan_classes.add(metric_obj.scan_class or ScanClass.DEFAULT)
+                logging.info(f'NCMD, wrote "{new_value}" to metric "{metric_obj.name}"')
+                failed.pop(id(metric_obj), None)  # a later write to the same metric wins
+            else:
+                logging.error(f'Failed to write value "{new_value}" to metric "{metric_obj.name}"')
+                failed[id(metric_obj)] = metric_obj
+
+        '''The app that sent the command learns the values that did not change, from a write ack or a rebirth'''
+        trigger_rebirth = bool(failed) and self.__rebirth_on_write_failure
+        if failed and not trigger_rebirth:
+            self.__publish_write_ack(client, list(failed.values()), device=device)
+
+        if device is not None and trigger_rebirth:
+            if self._publish_dbirth(device, client=client):
+                logging.info(f'Rebirth of device "{device.device_id}" Published!')
+            return
+        if trigger_rebirth or rebirth_requested:
+            self.__session += 1
+            self.__publish_nbirth(client, rebirth=True)
+            logging.info('Rebirth Published!')
+            self.__publish_device_births(client)
+            return
+        if written_scan_classes:
+            self._request_rbe(written_scan_classes)
+
+    def __publish_write_ack(self, client: mqtt_functions.mqtt.Client, metrics: List[SparkplugMetric], device: Optional['SparkplugDevice'] = None):
+        '''One NDATA (DDATA of device) with the current value of the metrics whose write failed, flagged writeResult False'''
+        if device is not None and not device.online:
+            return
+        topic = self.__topics.NDATA if device is None else device.topics.DDATA
+        payload = self.__new_payload()
+        self.__add_metrics_to_payload(payload, metrics)
+        for pb_metric in payload.metrics:
+            SparkplugMetric.fill_metric_properties(pb_metric.properties, self.WRITE_FAILED_PROPERTIES)
+        self.__publish_chunks(client, topic, self.__split_data_payload(payload, self.__message_type(topic)))
+        logging.info(f'Write ack published for {len(metrics)} metrics')
+
+    def _request_rbe(self, scan_classes: Set[str]):
+        '''RBE of the scan classes of the metrics written by an NCMD'''
+        if self.__loop_running:
+            self.force_rbe(scan_classes)  # RBE on the loop thread, keeps the network thread free
+        else:
+            self._rbe(scan_classes)
+
     '''
     MQTT paho-mqtt client functions
     '''
-    def __mqtt_publish(self, client: mqtt_functions.mqtt.Client, topic: str, payload: str or bytes, qos: int = 0, retain: bool = False):
-        if not client.is_connected:
-            pass # TODO STORE AND FORWARD
+    def __mqtt_publish(self, client: mqtt_functions.mqtt.Client, topic: str, payload: str or bytes, qos: int = 0, retain: bool = False) -> mqtt_functions.mqtt.MQTTMessageInfo:
+        enqueued = self.__publishes.now()  # on_publish may fire before client.publish() returns
         result = client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
-        self.__mid_deque.append(result.mid)
+        message_type = self.__message_type(topic)
+        self.__payload_sizes.record(message_type, len(payload))
+        if result.rc == mqtt_functions.mqtt.MQTT_ERR_SUCCESS or qos > 0:
+            self.__publishes.track(result.mid, message_type, len(payload), enqueued=enqueued)
+        return result
 
     def __on_mqtt_connect(self, client, userdata, flags, rc, reasonCode = None, properties = None):
         return_code = mqtt_functions.ReturnCodes(rc)
         if rc != 0:
             logging.error(f'MQTT Connect failed: {return_code.description}')
+            self._connect_attempt_failed()
             return
         logging.info(f'MQTT Connection Success: {return_code.description}')
+        reason = 'connect' if self.__online_broker_idx is None else 'reconnect'
+        if self.__online_broker_idx is not None and self.__online_broker_idx != self.__current_broker_idx:
+            reason = 'failover'
+        self.__go_online(client, reason=reason)
+
+    def __go_online(self, client: mqtt_functions.mqtt.Client, reason: str):
         client.subscribe(self.__topics.NCMD)
+        if self.__devices:
+            client.subscribe(self.__topics.DCMD)
 
-        self.__mqtt_publish(client, self.__topics.NBIRTH, self.__get_nbirth_payload(rebirth=False))
+        self.__session += 1
+        self.__publish_nbirth(client)
         logging.debug(f'PUBLISHED NBIRTH')
         self.__bdseq.next_value()
+        self.__online = True
+        self.__connect_deadline = None  # not before: until online, the loop would take a cleared deadline for a lost connection
+        self.__publish_device_births(client)
+        now = helpers.monotonic_millis()
+        self.__failover_stats.record_transition(
+            from_broker=self.__broker_name(self.__online_broker_idx),
+            to_broker=self.__broker_name(self.__current_broker_idx),
+            reason=reason,
+            offline_millis=0 if self.__offline_since is None else now - self.__offline_since
+        )
+        self.__online_broker_idx = self.__current_broker_idx
+        self.__offline_since = None
+        self._wake()  # start replaying stored data
         if self.__callbacks['on_mqtt_connect']:
             self.__callbacks['on_mqtt_connect'](node=self, mqtt_client=client)
 
     def __on_mqtt_publish(self, client, userdata, mid):
         logging.debug(f'MQTT MESSAGE PUBLISHED')
-        if mid is not None and mid in self.__mid_deque:
-            self.__sparkplug_message_published()
+        completed = self.__publishes.complete(mid) if mid is not None else None
+        if completed is not None:
+            message_type, size, latency = completed
+            logging.info(f'SPARKPLUG MESSAGE PUBLISHED ({message_type}, {size} bytes, {latency:.1f} ms)')
         if self.__callbacks['on_mqtt_publish']:
             self.__callbacks['on_mqtt_publish'](node=self, mqtt_client=client)
 
@@ -473,6 +1659,11 @@ class SparkplugEdgeNode:
 
     def __on_mqtt_disconnect(self, client, userdata, rc):
         logging.error('MQTT DISCONNECTED')
+        if self.__online:
+            self.__failover_stats.disconnects += 1
+        self.__online = False
+        self.__publishes.clear()  # QoS 0 messages still queued went with the connection
+        self._wake()
         if self.__callbacks['on_mqtt_disconnect']:
             self.__callbacks['on_mqtt_disconnect'](node=self, mqtt_client=client)
 
@@ -480,8 +1671,64 @@ class SparkplugEdgeNode:
     
 
 class SparkplugDevice:
+    '''
+    Device behind an edge node: its metrics are published in DBIRTH / DDATA on the device's topics
+    and written with DCMD. The metrics are scanned by the edge node with its own (same scan classes, same table),
+    the changes of a scan go out as one DDATA per device. DBIRTH follows every NBIRTH while the device is enabled,
+    death() publishes DDEATH and keeps the device quiet until birth()
+    '''
     def __init__(self, edge_node: SparkplugEdgeNode, device_id: str, metrics: List[SparkplugMetric] = None) -> None:
-        raise NotImplementedError
+        self.__edge_node = edge_node
+        self.__topics = edge_node.topics.device(device_id)
+        self.__device_id = device_id
+        self.__registry = MetricRegistry(metrics)
+        self.__enabled = True
+        self.__birth_session: Optional[int] = None
+        edge_node._add_device(self)
+
+    @property
+    def device_id(self) -> str:
+        return self.__device_id
+
+    @property
+    def edge_node(self) -> SparkplugEdgeNode:
+        return self.__edge_node
+
+    @property
+    def topics(self) -> SparkplugDeviceTopics:
+        return self.__topics
+
+    @property
+    def registry(self) -> MetricRegistry:
+        return self.__registry
+
+    @property
+    def metrics(self) -> List[SparkplugMetric]:
+        return self.__registry.metrics
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    @property
+    def online(self) -> bool:
+        '''True if the DBIRTH of the device was published since the last NBIRTH of its node, and no DDEATH since'''
+        return self.__enabled and self.__edge_node.online and self.__birth_session == self.__edge_node._session
+
+    def _born(self, session: int):
+        self.__birth_session = session
+
+    def birth(self) -> bool:
+        '''Enable the device and publish its DBIRTH, returns False if the node is offline (it is born with the next NBIRTH)'''
+        self.__enabled = True
+        return self.__edge_node._publish_dbirth(self)
+
+    def death(self) -> bool:
+        '''Publish the DDEATH of the device and stop publishing its data, returns False if it was not online'''
+        published = self.__edge_node._publish_ddeath(self)
+        self.__enabled = False
+        self.__birth_session = None
+        return published
 
 
 
@@ -1,10 +1,21 @@
 from sparkplug_node_app import helpers
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.rbe import RbePolicy
+from sparkplug_node_app.metric_table import MetricColumn, MetricTable
+from sparkplug_node_app.samples import SampleBuffer
+from sparkplug_node_app.arrays import array_packer, unpack_array
 from enum import Enum
+from types import CoroutineType
+import inspect
 import os
 import logging
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Dict, Set, Tuple, TYPE_CHECKING
+import threading
 import json
 
+if TYPE_CHECKING:
+    from sparkplug_node_app.metric_group import MetricGroup
+
 class SparkplugDataTypes(Enum):
     """ Indexes of Data Types """
 
@@ -57,6 +68,10 @@ class SparkplugDataTypes(Enum):
     def is_number(self) -> bool:
         return 0 < self.value < 11
 
+    @property
+    def is_array(self) -> bool:
+        return 21 < self.value < 35
+
     @property
     def value_key(self) -> str:
         if self.value in [1, 2, 3, 5, 6, 7]:
@@ -71,7 +86,7 @@ class SparkplugDataTypes(Enum):
             return 'boolean_value'
         elif self.value in [12, 13, 14, 15]:
             return 'string_value'
-        elif self.value in [17, 18]:
+        elif self.value in [17, 18] or self.is_array:
             return 'bytes_value'
         raise NotImplementedError
 
@@ -92,11 +107,30 @@ class SparkplugDataTypes(Enum):
             return str
         elif self.value in [17, 18]:
             return bytes
+        elif self.is_array:
+            return array_packer(self.value)  # packed little endian, see arrays.py
         raise NotImplementedError
 
 
+class MetricQuality(Enum):
+    """ Values of the Sparkplug "Quality" metric property """
+    BAD = 0
+    GOOD = 192
+    STALE = 500
+
+
 class SparkplugMetric:
-    __instance_count = 0
+    '''
+    A metric is a thin view on a row of a MetricTable, which holds its current / previous value, read timestamp
+    and alias in per datatype columns. The object itself only keeps the functions and settings of the metric
+    '''
+    __slots__ = (
+        '__name', '__datatype', '__read_fn', '__write_fn', '__on_read', '__on_write', '__disable_alias', '__rbe_ignore',
+        '__data_source', '__read_timeout', '__scan_class', '__rbe_policy', '__stale', '__quality_pending', '__change_listener',
+        '__property_list', '__properties', '__table', '__column', '__row', '__birth_template', '__sample_rate', '__samples'
+    )
+    __shared_properties: Dict[tuple, tuple] = {}
+
     def __init__(
         self,
         name: str,
@@ -107,50 +141,129 @@ class SparkplugMetric:
         disable_alias: bool = False,
         rbe_ignore: bool = False,
         on_write = None,
-        on_read = None
+        on_read = None,
+        data_source: Optional[str] = None,
+        read_timeout: Optional[int] = None,
+        scan_class: Optional[str] = None,
+        rbe_policy: Optional[RbePolicy] = None,
+        sample_rate: Optional[int] = None,
+        history_size: Optional[int] = None
     ) -> None:
         """
         read function signature: read_function(prev_value)
-        returns value, whatever its datatype is
+        returns value, whatever its datatype is. Array datatypes (Int8Array - DateTimeArray) take sequences, buffers
+        (array.array, NumPy arrays, memoryview) or packed bytes, values are kept, published and written packed
+        (see arrays.py, array_value gives the elements)
 
         write function signature: write_function(value) -> bool
         The bool return value of write indicates success / failure
 
         on_read callback signature: on_read(metric_obj=self, current_value=value, success=success)
         on_write callback signature: on_write(metric_obj=self, value_written=value, success=success)
-        """
-        self.__instance_count += 1
-        if alias is None:
-            alias = self.__instance_count
 
+        alias is normally left as None, the edge node allocates a unique alias when the metric is added
+
+        data_source and read_timeout (ms) are used when the edge node reads metrics concurrently:
+        metrics sharing a data_source are read one after the other by the same worker,
+        a metric whose read does not finish within read_timeout is reported stale
+
+        scan_class is the name of one of the edge node's scan classes, None for the default class (see ScanClass)
+
+        rbe_policy (deadband, minimum interval, heartbeat) filters which changes are published, see rbe_due().
+        Without one every change is published
+
+        history_size keeps up to that many timestamped samples taken between scans (see record_sample()),
+        they go out in the metric's next NDATA as extra entries ahead of the scan value.
+        sample_rate (ms, needs history_size) has the edge node read such samples on its own, between scans
+
+        read_function, write_function, on_read and on_write may be coroutine functions,
+        such metrics are read and written with async_read() / async_write() (see AsyncSparkplugEdgeNode)
+        """
         self.__read_fn = read_function
         self.__on_read = on_read if on_read and callable(on_read) else None
         self.__write_fn = write_function
         self.__on_write = on_write if on_write and callable(on_write) else None
         
-        self.__alias = alias
         self.__disable_alias = disable_alias
         self.__name = name
         self.__datatype = datatype
-        self.__value_key = datatype.value_key
-        self.__value_key_camel_case = datatype.value_key_camel_case
 
-        self.__read_millis = 0
-        self.__current_value = None
-        self.__prev_value = None
+        self.__table = MetricTable.staging()
+        self.__column, self.__row = self.__table.allocate(datatype, owner=self, policy=None if rbe_ignore else rbe_policy)
+        if alias is not None:
+            self.__column.aliases[self.__row] = alias
 
         self.__rbe_ignore = rbe_ignore
+        self.__data_source = data_source
+        self.__read_timeout = read_timeout
+        self.__scan_class = scan_class
+        self.__rbe_policy = rbe_policy
+        self.__stale = False
+        self.__quality_pending = False
+        self.__change_listener: Optional[Callable[['SparkplugMetric'], None]] = None
+
+        self.__property_list, self.__properties = self.__metric_properties(self.writable, rbe_policy)
+        self.__birth_template: Optional[Tuple[bytes, bytes, bytes]] = None
+
+        if sample_rate is not None and (history_size is None or sample_rate <= 0):
+            raise ValueError(f'Metric "{name}" needs a history_size and a positive sample_rate to be sampled!')
+        self.__sample_rate = sample_rate
+        self.__samples = SampleBuffer(history_size) if history_size else None
+
+    @classmethod
+    def __metric_properties(cls, writable: bool, rbe_policy: Optional[RbePolicy]) -> tuple:
+        '''(property list, formatted properties), shared by every metric with the same settings'''
+        key = (writable, rbe_policy)
+        shared = cls.__shared_properties.get(key)
+        if shared is None:
+            property_list = [{'key': 'readOnly', 'type': 11, 'value': not writable}]
+            if rbe_policy is not None:
+                property_list.extend(rbe_policy.properties)
+            shared = (property_list, cls.make_metric_properties(property_list))
+            cls.__shared_properties[key] = shared
+        return shared
+
+    def __del__(self):
+        try:
+            if self.__table is MetricTable.staging():
+                self.__column.release(self.__row)
+        except (AttributeError, TypeError):  # __init__ did not get to allocate a row, or interpreter shutdown
+            pass
+
+    def bind_table(self, table: MetricTable):
+        '''Move the metric's row into table, the edge node keeps its metrics in a table of its own'''
+        if table is self.__table:
+            return
+        column, row = table.allocate(self.__datatype, owner=self, policy=None if self.__rbe_ignore else self.__rbe_policy)
+        column.copy_row(row, self.__column, self.__row)
+        self.__column.release(self.__row)
+        self.__table, self.__column, self.__row = table, column, row
+
+    @property
+    def table(self) -> MetricTable:
+        return self.__table
+
+    @property
+    def column(self) -> MetricColumn:
+        return self.__column
 
-        self.__properties = self.make_metric_properties([{'key': 'readOnly', 'type': 11, 'value': not self.writable}])
-        self.__coerce_fn = datatype.coerce_fn
+    @property
+    def row(self) -> int:
+        return self.__row
 
     @property
     def name(self) -> str:
         return self.__name
 
     @property
-    def alias(self) -> str:
-        return self.__alias
+    def alias(self) -> Optional[int]:
+        alias = self.__column.aliases[self.__row]
+        return None if alias == MetricColumn.NO_ALIAS else alias
+
+    def set_alias(self, alias: int):
+        """Used by the edge node's AliasAllocator, aliases must not change after NBIRTH"""
+        self.__column.aliases[self.__row] = MetricColumn.NO_ALIAS if alias is None else alias
+        self.__birth_template = None
     
     @property
     def writable(self) -> bool:
@@ -162,23 +275,67 @@ class SparkplugMetric:
 
     @property
     def value_key(self) -> str:
-        return self.__value_key
+        return self.__column.value_key
 
     @property
     def value_key_camel_case(self) -> str:
-        return self.__value_key_camel_case
+        return self.__datatype.value_key_camel_case
     
     @property
     def value_changed(self) -> bool:
-        return self.__prev_value != self.__current_value
+        return self.__column.row_changed(self.__row)
+
+    @property
+    def pushes_changes(self) -> bool:
+        '''True if the metric calls mark_changed() whenever its value changes, so it does not need to be polled'''
+        return False
+
+    @property
+    def group(self) -> Optional['MetricGroup']:
+        '''The MetricGroup the metric is read and written through, None for a metric with its own read_function'''
+        return None
+
+    def set_change_listener(self, listener: Optional[Callable[['SparkplugMetric'], None]]):
+        '''listener(metric) is called by mark_changed(), the edge node uses it to track changed push metrics'''
+        self.__change_listener = listener
+
+    def mark_changed(self):
+        '''Report a change of the value outside of a read'''
+        if self.__change_listener is not None:
+            self.__change_listener(self)
+
+    @property
+    def rbe_policy(self) -> Optional[RbePolicy]:
+        return self.__rbe_policy
+
+    def rbe_due(self, now: int) -> bool:
+        '''
+        True if the current value should be published: value_changed filtered by the rbe_policy,
+        which compares against the last published value (see mark_published). now is monotonic millis
+        '''
+        return self.__column.rbe_due(self.__row, now, self.__rbe_policy)
+
+    def mark_published(self, now: int):
+        '''Remember the current value as published at now (monotonic millis), the reference of the rbe_policy'''
+        self.__column.mark_published(self.__row, now)
+
+    @property
+    def array_value(self):
+        '''Elements of the current value of an array metric (see unpack_array), None if it is null'''
+        value = self.__column.get(self.__row)
+        return None if value is None else unpack_array(self.__datatype.value, value)
 
     @property
     def previous_value(self):
-        return self.__prev_value
+        return self.__column.get_previous(self.__row)
     
     @property
     def current_value(self):
-        return self.__current_value
+        return self.__column.get(self.__row)
+
+    @property
+    def read_millis(self) -> int:
+        return self.__column.timestamps[self.__row]
 
     @property
     def disable_alias(self) -> bool:
@@ -188,6 +345,51 @@ class SparkplugMetric:
     def rbe_ignore(self) -> bool:
         return self.__rbe_ignore
 
+    @property
+    def data_source(self) -> Optional[str]:
+        return self.__data_source
+
+    @property
+    def scan_class(self) -> Optional[str]:
+        return self.__scan_class
+
+    @property
+    def read_timeout(self) -> Optional[int]:
+        return self.__read_timeout
+
+    @property
+    def blocking_read(self) -> bool:
+        """True if read() may block on I/O, such metrics are read by the edge node's read workers"""
+        return True
+
+    @property
+    def is_async(self) -> bool:
+        '''True if the read or write function is a coroutine function, so the metric must be read / written with async_read() / async_write()'''
+        return inspect.iscoroutinefunction(self.__read_fn) or inspect.iscoroutinefunction(self.__write_fn)
+
+    @property
+    def stale(self) -> bool:
+        return self.__stale
+
+    def set_stale(self, stale: bool) -> bool:
+        """
+        Mark the value stale (its read timed out) or fresh again.
+        Returns True if the state changed, the next RBE metric then carries the Quality property
+        """
+        if stale == self.__stale:
+            return False
+        self.__stale = stale
+        self.__quality_pending = True
+        self.__birth_template = None
+        return True
+
+    @property
+    def quality(self) -> MetricQuality:
+        return MetricQuality.STALE if self.__stale else MetricQuality.GOOD
+
+    def __quality_property(self) -> List[dict]:
+        return [{'key': 'Quality', 'type': SparkplugDataTypes.Int32.value, 'value': self.quality.value}]
+
     @staticmethod
     def make_metric_properties(metric_props: List[dict]) -> dict:
         """take simple list of dict with keys 'key', 'value', 'type' and format for use in property structure for metric"""
@@ -200,19 +402,46 @@ class SparkplugMetric:
             datatype = SparkplugDataTypes(property['type'])
             props_formatted['values'].append({'type': property['type'], datatype.value_key: property['value']})
         return props_formatted
+
+    @staticmethod
+    def fill_metric_properties(property_set: sparkplug_pb2.Payload.PropertySet, metric_props: List[dict]):
+        """protobuf equivalent of make_metric_properties, fills property_set in place"""
+        for property in metric_props:
+            property_set.keys.append(property['key'])
+            property_value = property_set.values.add()
+            property_value.type = property['type']
+            setattr(property_value, SparkplugDataTypes(property['type']).value_key, property['value'])
     
+    @property
+    def on_read(self):
+        return self.__on_read
+
+    @property
+    def on_write(self):
+        return self.__on_write
+
+    def store_read(self, value, millis: int) -> bool:
+        '''Record value as read at millis by someone else (a MetricGroup), False if it does not fit the datatype'''
+        try:
+            self.__column.store(self.__row, value, millis)
+        except Exception:
+            return False
+        return True
+
     def read(self) -> bool:
         success = True
+        column, row = self.__column, self.__row
         try:
-            prev_value = self.__current_value
-            self.__current_value = self.__read_fn(prev_value)
-            self.__read_millis = helpers.millis()
-            self.__prev_value = prev_value
+            value = self.__read_fn(column.get(row))
+            if isinstance(value, CoroutineType):
+                value.close()
+                raise TypeError(f'Metric "{self.__name}" has an async read function, use async_read()')
+            column.store(row, value, helpers.millis())
         except Exception as err:
             success = False
 
         if self.__on_read:
-            self.__on_read(metric_obj=self, current_value=self.__current_value, success=success)
+            self.__on_read(metric_obj=self, current_value=column.get(row), success=success)
         return success
 
     def write(self, value) -> bool:
@@ -220,14 +449,114 @@ class SparkplugMetric:
             return False
         success = True
         try:
-            value = self.__coerce_fn(value)
+            value = self.__column.coerce_fn(value)
             success = self.__write_fn(value)
+            if inspect.iscoroutine(success):
+                success.close()
+                raise TypeError(f'Metric "{self.__name}" has an async write function, use async_write()')
         except Exception:
             success = False
         if self.__on_write:
             self.__on_write(metric_obj=self, value_written=value, success=success)
         return success
 
+    async def async_read(self) -> bool:
+        '''read() for use on an event loop, read_function and on_read may return awaitables'''
+        success = True
+        try:
+            value = self.__read_fn(self.__column.get(self.__row))
+            if inspect.isawaitable(value):
+                value = await value
+            self.__column.store(self.__row, value, helpers.millis())
+        except Exception as err:
+            success = False
+
+        if self.__on_read:
+            result = self.__on_read(metric_obj=self, current_value=self.__column.get(self.__row), success=success)
+            if inspect.isawaitable(result):
+                await result
+        return success
+
+    async def async_write(self, value) -> bool:
+        '''write() for use on an event loop, write_function and on_write may return awaitables'''
+        if not self.writable:
+            return False
+        success = True
+        try:
+            value = self.__column.coerce_fn(value)
+            success = self.__write_fn(value)
+            if inspect.isawaitable(success):
+                success = await success
+        except Exception:
+            success = False
+        if self.__on_write:
+            result = self.__on_write(metric_obj=self, value_written=value, success=success)
+            if inspect.isawaitable(result):
+                await result
+        return success
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        return self.__sample_rate
+
+    @property
+    def sample_buffer(self) -> Optional[SampleBuffer]:
+        return self.__samples
+
+    def record_sample(self, value, millis: Optional[int] = None) -> bool:
+        '''
+        Buffer value acquired at millis (now if None) between scans, e.g. from a driver callback.
+        False if the metric has no history_size, value does not fit the datatype or repeats the previous sample
+        '''
+        if self.__samples is None:
+            return False
+        try:
+            value = None if value is None else self.__column.coerce_fn(value)
+        except Exception:
+            return False
+        return self.__samples.append(value, helpers.millis() if millis is None else millis, current=self.__column.get(self.__row))
+
+    def sample(self) -> bool:
+        '''Read a sample between scans (see sample_rate), the scan value of the metric is left as is'''
+        try:
+            value = self.__read_fn(self.__column.get(self.__row))
+            if isinstance(value, CoroutineType):
+                value.close()
+                raise TypeError(f'Metric "{self.__name}" has an async read function, use async_sample()')
+        except Exception:
+            return False
+        return self.record_sample(value)
+
+    async def async_sample(self) -> bool:
+        '''sample() for use on an event loop'''
+        try:
+            value = self.__read_fn(self.__column.get(self.__row))
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception:
+            return False
+        return self.record_sample(value)
+
+    def fill_sample_metrics(self, pb_metrics) -> bool:
+        '''
+        Add the buffered samples taken before the current value was read to pb_metrics (Payload.metrics),
+        in the RBE form with their own timestamp. Returns False if the last of them carries the current value,
+        the metric then needs no entry of its own (unless its quality changed)
+        '''
+        if self.__samples is None or not len(self.__samples):
+            return True
+        samples = self.__samples.drain(before=self.read_millis)
+        for millis, value in samples:
+            metric = pb_metrics.add()
+            metric.timestamp = millis
+            metric.datatype = self.__datatype.value  # REMOVE THIS LINE FOR SPARKPLUG 3
+            if self.__disable_alias:
+                metric.name = self.__name
+            else:
+                metric.alias = self.alias
+            self.__set_value_for_pb(metric, value)
+        return not samples or self.__quality_pending or samples[-1][1] != self.__column.get(self.__row)
+
     @staticmethod
     def int_to_uint(value, bit_size=32) -> int:
         if not isinstance(value, int):
@@ -240,47 +569,233 @@ class SparkplugMetric:
         return value
     
     def __set_value_for_payload(self, metric_dict: dict):
-        if self.__current_value is None:
+        value = self.__column.get(self.__row)
+        if value is None:
             metric_dict['is_null'] = True
             return
 
-        value = self.__current_value
-        if self.__value_key == 'long_value':
-            value = self.int_to_uint(self.__current_value, bit_size=64)
-        elif self.__value_key == 'int_value':
-            value = self.int_to_uint(self.__current_value, bit_size=32)
-        metric_dict[self.__value_key] = value
-        
+        value_key = self.__column.value_key
+        if value_key == 'long_value':
+            value = self.int_to_uint(value, bit_size=64)
+        elif value_key == 'int_value':
+            value = self.int_to_uint(value, bit_size=32)
+        metric_dict[value_key] = value
+
+    def __set_value_for_pb(self, metric: sparkplug_pb2.Payload.Metric, value):
+        if value is None:
+            metric.is_null = True
+            return
+
+        value_key = self.__column.value_key
+        if value_key == 'long_value':
+            value = self.int_to_uint(value, bit_size=64)
+        elif value_key == 'int_value':
+            value = self.int_to_uint(value, bit_size=32)
+        if value is not None:
+            setattr(metric, value_key, value)
 
     def as_birth_metric(self) -> dict:
         metric = {
-            'timestamp': self.__read_millis,
+            'timestamp': self.read_millis,
             'name': self.__name,
             'datatype': self.__datatype.value,
-            'properties': self.__properties
+            'properties': self.__properties if not self.__stale else self.make_metric_properties(self.__property_list + self.__quality_property())
         }
         if not self.__disable_alias:
-            metric['alias'] = self.__alias
+            metric['alias'] = self.alias
         
         self.__set_value_for_payload(metric)
         return metric
 
     def as_rbe_metric(self) -> dict:
         metric = {
-            'timestamp': self.__read_millis,
-            self.__value_key: self.__current_value,
+            'timestamp': self.read_millis,
+            self.__column.value_key: self.current_value,
             'datatype': self.__datatype.value  # REMOVE THIS LINE FOR SPARKPLUG 3
         }
         if self.__disable_alias:
             metric['name'] = self.__name
         else:
-            metric['alias'] = self.__alias
+            metric['alias'] = self.alias
+        if self.__quality_pending:
+            self.__quality_pending = False
+            metric['properties'] = self.make_metric_properties(self.__quality_property())
 
         self.__set_value_for_payload(metric)
         return metric
 
+    def fill_birth_metric(self, metric: sparkplug_pb2.Payload.Metric, with_value: bool = True, compact: bool = False):
+        """
+        Write the birth form of this metric straight into a protobuf Metric, encodes identically to as_birth_metric.
+        with_value False leaves the value to the caller (see MetricColumn.fill_payload_values)
+        compact leaves out the RbePolicy properties (readOnly only), for births over the payload size limit
+        """
+        metric.timestamp = self.read_millis
+        metric.name = self.__name
+        metric.datatype = self.__datatype.value
+        self.fill_metric_properties(metric.properties, self.__property_list[:1] if compact else self.__property_list)
+        if self.__stale:
+            self.fill_metric_properties(metric.properties, self.__quality_property())
+        if not self.__disable_alias:
+            metric.alias = self.alias
+        if with_value:
+            self.__set_value_for_pb(metric, self.__column.get(self.__row))
+
+    def birth_template(self) -> Tuple[bytes, bytes, bytes]:
+        """
+        Encoded birth form of this metric without its timestamp and value: (name and alias, datatype, properties),
+        cached until the alias or the quality changes. Births put the current timestamp and value between
+        these fields in field number order, so the metric encodes exactly like a full encode
+        """
+        template = self.__birth_template
+        if template is None:
+            metric = sparkplug_pb2.Payload.Metric()
+            self.fill_birth_metric(metric, with_value=False)
+            datatype = sparkplug_pb2.Payload.Metric(datatype=metric.datatype).SerializeToString()
+            properties = sparkplug_pb2.Payload.Metric(properties=metric.properties).SerializeToString() if metric.HasField('properties') else b''
+            head = sparkplug_pb2.Payload.Metric(name=metric.name, alias=metric.alias) if metric.HasField('alias') else sparkplug_pb2.Payload.Metric(name=metric.name)
+            template = self.__birth_template = (head.SerializeToString(), datatype, properties)
+        return template
+
+    def fill_rbe_metric(self, metric: sparkplug_pb2.Payload.Metric, with_value: bool = True):
+        """Write the RBE form of this metric straight into a protobuf Metric, encodes identically to as_rbe_metric"""
+        metric.timestamp = self.read_millis
+        metric.datatype = self.__datatype.value  # REMOVE THIS LINE FOR SPARKPLUG 3
+        if self.__disable_alias:
+            metric.name = self.__name
+        else:
+            metric.alias = self.alias
+        if self.__quality_pending:
+            self.__quality_pending = False
+            self.fill_metric_properties(metric.properties, self.__quality_property())
+        if with_value:
+            self.__set_value_for_pb(metric, self.__column.get(self.__row))
+
+
+class MemoryTagStore:
+    """
+    Persistence file shared by every SparkplugMemoryTag saved to it.
+    The file is parsed once per process, tags restore their config from that snapshot.
+    Tags mark themselves dirty when their value changes, flush() writes all changed tags in one atomic file write.
+    Device tags are namespaced by their device id, so the node and its devices can share a file.
+    """
+    __stores: Dict[str, 'MemoryTagStore'] = {}
+    __stores_lock = threading.Lock()
+
+    @classmethod
+    def for_file(cls, filepath: str) -> 'MemoryTagStore':
+        """The store for filepath, created on first use and shared for the rest of the process"""
+        key = os.path.abspath(filepath)
+        with cls.__stores_lock:
+            if key not in cls.__stores:
+                cls.__stores[key] = cls(filepath)
+            return cls.__stores[key]
+
+    def __init__(self, filepath: str) -> None:
+        self.__filepath = filepath
+        self.__lock = threading.Lock()
+        self.__data: Optional[dict] = None
+        self.__tags: Dict[str, 'SparkplugMemoryTag'] = {}  # by key()
+        self.__dirty: Set[str] = set()
+        self.__load_millis = 0.0
+
+    @property
+    def filepath(self) -> str:
+        return self.__filepath
+
+    @staticmethod
+    def key(name: str, device_id: Optional[str] = None) -> str:
+        """Entry of a tag in the file, the tags of a device are namespaced by its id"""
+        return name if device_id is None else f'{device_id}\t{name}'
+
+    def register(self, tag: 'SparkplugMemoryTag'):
+        key = self.key(tag.name, tag.device_id)
+        with self.__lock:
+            self.__tags[key] = tag
+            self.__dirty.add(key)
+
+    def mark_dirty(self, tag: 'SparkplugMemoryTag'):
+        with self.__lock:
+            self.__dirty.add(self.key(tag.name, tag.device_id))
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self.__dirty)
+
+    @property
+    def load_millis(self) -> float:
+        """Time spent reading and parsing the persistence file"""
+        return self.__load_millis
+
+    def __create_file(self):
+        directory_path = os.path.dirname(self.__filepath)
+        if directory_path:
+            os.makedirs(directory_path, exist_ok=True)
+        with open(self.__filepath, 'w', newline='') as file:
+            json.dump({}, file)
+        logging.info(f'Created SparkplugMemoryTag persistence file "{self.__filepath}"')
+
+    def __load(self) -> dict:
+        started = helpers.perf_millis()
+        try:
+            with open(self.__filepath, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            self.__create_file()
+            return {}
+        except json.JSONDecodeError:
+            logging.error(f'Could not load persistence file "{self.__filepath}" (invalid json), it will be rewritten')
+            return {}
+        finally:
+            self.__load_millis += helpers.perf_millis() - started
+
+    def __ensure_loaded(self):
+        if self.__data is None:
+            self.__data = self.__load()
+
+    def get(self, name: str, device_id: Optional[str] = None) -> Optional[dict]:
+        """Persisted config of the tag "name" (of the device device_id, if given), None if the file holds nothing for it"""
+        with self.__lock:
+            self.__ensure_loaded()
+            return self.__data.get(self.key(name, device_id))
+
+    def __len__(self) -> int:
+        with self.__lock:
+            self.__ensure_loaded()
+            return len(self.__data)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Copy of every persisted tag config, keyed by key()"""
+        with self.__lock:
+            self.__ensure_loaded()
+            return dict(self.__data)
+
+    def flush(self) -> int:
+        """Write the dirty tags whose config changed since the last flush, returns the number of tags written"""
+        with self.__lock:
+            dirty, self.__dirty = self.__dirty, set()
+            self.__ensure_loaded()
+            changed = 0
+            for key in dirty:
+                tag_config = self.__tags[key].get_config()
+                if self.__data.get(key) == tag_config:
+                    continue
+                self.__data[key] = tag_config
+                changed += 1
+            if not changed:
+                return 0
+            try:
+                helpers.atomic_write_json(self.__filepath, self.__data, indent=4)
+            except OSError:
+                self.__dirty |= dirty  # try again on the next flush
+                raise
+            logging.debug(f'Saved {changed} memory tags to "{self.__filepath}"')
+            return changed
+
 
 class SparkplugMemoryTag(SparkplugMetric):
+    __slots__ = ('__mem_value', '__persistence_file', '__write_validator', '__store', '__device_id')
+
     def __init__(
         self,
         name: str,
@@ -293,13 +808,22 @@ class SparkplugMemoryTag(SparkplugMetric):
         persistence_file: Optional[str] = None,
         on_write: Optional[Callable] = None,
         on_read: Optional[Callable] = None,
-        write_validator: Optional[Callable] = None
+        write_validator: Optional[Callable] = None,
+        scan_class: Optional[str] = None,
+        rbe_policy: Optional[RbePolicy] = None,
+        history_size: Optional[int] = None,
+        device_id: Optional[str] = None
     ) -> None:
         """
         write_validator function signature write_validator(current_value, new_value) -> bool
         returns False if new_value is invalid, True if it is
+
+        history_size keeps the values of update_value() calls between scans as samples (see SparkplugMetric)
+
+        device_id is the id of the SparkplugDevice a persistent tag belongs to, its entry in the persistence file is namespaced by it
         """
         self.__mem_value = initial_value
+        self.__device_id = device_id
         self.__persistence_file = persistence_file
         self.__write_validator = write_validator if callable(write_validator) else None
 
@@ -312,57 +836,67 @@ class SparkplugMemoryTag(SparkplugMetric):
             disable_alias=disable_alias,
             rbe_ignore=rbe_ignore,
             on_write=on_write,
-            on_read=on_read
+            on_read=on_read,
+            scan_class=scan_class,
+            rbe_policy=rbe_policy,
+            history_size=history_size
         )
         
-        if persistence_file:  # Get value from storage
-            self.__create_persistence_file()
-            persistence_data = self.__read_persistence_file()
-            if persistence_data is None:
-                logging.warning(f'Persitence data could not be loaded "{persistence_file}"')
-            elif name in persistence_data.keys():
-                if 'current_value' in persistence_data[name].keys():
-                    self.__mem_value = persistence_data[name]['current_value']
+        self.__store = MemoryTagStore.for_file(persistence_file) if persistence_file else None
+        if self.__store is not None:  # Get value from storage
+            tag_config = self.__store.get(name, device_id)
+            if tag_config is not None:
+                if 'current_value' in tag_config.keys():
+                    self.__mem_value = tag_config['current_value']
                 for key in init_args.keys():
-                    if key not in persistence_data[name].keys():
+                    if key == 'alias':  # aliases are allocated and persisted by the edge node
                         continue
-                    init_args[key] = persistence_data[name][key]
-        
-        super().__init__(**init_args)
+                    if key not in tag_config.keys():
+                        continue
+                    init_args[key] = tag_config[key]
 
-        self.read()
+        super().__init__(**init_args)
 
-    def __create_persistence_file(self):
-        if not os.path.isfile(self.__persistence_file):
-            directory_path = os.path.dirname(self.__persistence_file)
-            os.makedirs(directory_path, exist_ok=True)
-            with open(self.__persistence_file, 'w', newline='') as file:
-                json.dump({}, file)
-            logging.info(f'Created SparkplugMemoryTag persistence file "{self.__persistence_file}"')
+        if self.__store is not None:
+            self.__store.register(self)
 
-    def __read_persistence_file(self) -> Optional[dict]:
-        if not self.persistent:
-            return None
-        try:
-            with open(self.__persistence_file, 'r') as file:
-                return json.load(file)
-        except json.JSONDecodeError as err:
-            logging.error(f'Could not load persistence file for Memory Tag "{self.name}" (invalid json)')
-            return None
+        self.read()
 
     def save_to_disk(self):
+        """Flush the tag's store, when saving many tags flush their store once instead (see SparkplugEdgeNode.save_config)"""
         if not self.persistent:
             logging.warning(f'Cannot save tag "{self.name}", no persistence file configured!')
             return
+        self.__store.mark_dirty(self)
+        self.__store.flush()
 
-        existing_file_data = self.__read_persistence_file()
-        if existing_file_data is None:
-            self.__create_persistence_file()
-            existing_file_data = {}
-        
-        existing_file_data[self.name] = self.get_config()
-        with open(self.__persistence_file, 'w', newline='') as file:
-            json.dump(existing_file_data, file, indent=4)
+    @classmethod
+    def create_many(cls, definitions: List[dict], persistence_file: Optional[str] = None, **defaults) -> List['SparkplugMemoryTag']:
+        """
+        Create a memory tag for every dict of constructor arguments in definitions, defaults apply to all of them.
+        The persistence file is loaded once and every tag restores from that snapshot.
+        """
+        if persistence_file:
+            store = MemoryTagStore.for_file(persistence_file)
+            logging.info(f'Loaded {len(store)} persisted memory tags from "{persistence_file}" in {store.load_millis:.1f}ms')
+        tags = []
+        for definition in definitions:
+            tag_args = dict(defaults, persistence_file=persistence_file)
+            tag_args.update(definition)
+            tags.append(cls(**tag_args))
+        return tags
+
+    @property
+    def store(self) -> Optional[MemoryTagStore]:
+        return self.__store
+
+    @property
+    def device_id(self) -> Optional[str]:
+        return self.__device_id
+
+    def __mark_dirty(self):
+        if self.__store is not None:
+            self.__store.mark_dirty(self)
 
     def __mem_reader(self, prev_value):
         return self.__mem_value
@@ -373,11 +907,24 @@ class SparkplugMemoryTag(SparkplugMetric):
         TODO remote_writable vs writeble 
         """
         self.__mem_value = value
+        self.__mark_dirty()
+        self.record_sample(value)
+        self.mark_changed()
 
     def __mem_writer(self, value) -> bool:
         if self.__write_validator is not None and not self.__write_validator(self.current_value, value):
             return False
         self.__mem_value = value
+        self.__mark_dirty()
+        self.mark_changed()
+        return True
+
+    @property
+    def blocking_read(self) -> bool:
+        return False
+
+    @property
+    def pushes_changes(self) -> bool:
         return True
 
     @property
@@ -393,5 +940,13 @@ class SparkplugMemoryTag(SparkplugMetric):
             'disable_alias': self.disable_alias,
             'rbe_ignore': self.rbe_ignore,
             'persistent': self.persistent,
-            'current_value': self.current_value
-        }
\ No newline at end of file
+            'current_value': self.__config_value()
+        }
+
+    def __config_value(self):
+        """The value as saved to the persistence file: arrays as their list of elements (packed bytes are not JSON), restored as is"""
+        value = self.__mem_value
+        if value is None or not self.sparkplug_datatype.is_array:
+            return value
+        datatype = self.sparkplug_datatype.value
+        return list(unpack_array(datatype, array_packer(datatype)(value)))
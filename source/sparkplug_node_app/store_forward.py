@@ -0,0 +1,233 @@
+from sparkplug_node_app import helpers
+from dataclasses import dataclass
+from enum import Enum
+from typing import List, Optional, Tuple
+import json
+import logging
+import os
+import struct
+import threading
+
+
+class EvictionPolicy(Enum):
+    """ What to do when the store is full """
+    DROP_OLDEST = 'drop_oldest'  # delete the oldest segment to make room
+    DROP_NEWEST = 'drop_newest'  # reject the message being stored
+
+
+@dataclass(frozen=True, kw_only=True)
+class StoreForwardConfig:
+    directory: str
+    max_bytes: int = 64 * 1024 * 1024
+    segment_bytes: int = 1024 * 1024
+    eviction: EvictionPolicy = EvictionPolicy.DROP_OLDEST
+    replay_rate: int = 10  # messages per second published from the store after reconnecting
+
+
+class SegmentLog:
+    '''
+    Bounded FIFO of (topic, payload) records kept in append-only segment files, survives restarts.
+    Records are only removed once consumed with pop(), so delivery is at-least-once. The read position in the oldest segment
+    is kept in a cursor file, so after a restart at most the record being published when it stopped is replayed again.
+    Record format: topic length (uint16 BE), payload length (uint32 BE), topic, payload
+    '''
+    SEGMENT_SUFFIX = '.seg'
+    CURSOR_FILENAME = 'cursor.json'
+    __header = struct.Struct('>HI')
+
+    def __init__(self, config: StoreForwardConfig) -> None:
+        if config.segment_bytes > config.max_bytes:
+            raise ValueError('Store and forward segment_bytes cannot be larger than max_bytes!')
+        self.__config = config
+        self.__lock = threading.Lock()
+        os.makedirs(config.directory, exist_ok=True)
+
+        self.__segments: List[int] = sorted(
+            int(filename[:-len(self.SEGMENT_SUFFIX)]) for filename in os.listdir(config.directory)
+            if filename.endswith(self.SEGMENT_SUFFIX) and filename[:-len(self.SEGMENT_SUFFIX)].isdigit()
+        )
+        self.__segment_sizes = {segment: os.path.getsize(self.__segment_path(segment)) for segment in self.__segments}
+        self.__read_offset = self.__load_cursor()
+        self.__writer = None
+        self.__roll_pending = bool(self.__segments)  # never append after a possibly torn record
+
+        self.__appended = 0
+        self.__replayed = 0
+        self.__dropped = 0
+        self.__dropped_bytes = 0
+
+        if self.__segments:
+            logging.info(f'Store and forward: recovered {self.pending_bytes} bytes in {len(self.__segments)} segments from "{config.directory}"')
+
+    def __cursor_path(self) -> str:
+        return os.path.join(self.__config.directory, self.CURSOR_FILENAME)
+
+    def __load_cursor(self) -> int:
+        '''Read offset in the oldest segment saved by the last run, 0 if it saved none for that segment'''
+        try:
+            with open(self.__cursor_path(), 'r') as file:
+                cursor = json.load(file)
+            segment, offset = cursor['segment'], cursor['offset']
+        except FileNotFoundError:
+            return 0
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logging.error(f'Store and forward: invalid cursor file in "{self.__config.directory}", replaying the oldest segment from its start')
+            return 0
+        if self.__segments and segment == self.__segments[0] and isinstance(offset, int) and 0 <= offset <= self.__segment_sizes[segment]:
+            return offset
+        self.__save_cursor(0)  # its segment was already deleted
+        return 0
+
+    def __save_cursor(self, offset: int):
+        '''Persist the read offset in the oldest segment, the file is removed when reading from its start'''
+        if self.__segments and offset > 0:
+            helpers.atomic_write_json(self.__cursor_path(), {'segment': self.__segments[0], 'offset': offset})
+            return
+        try:
+            os.remove(self.__cursor_path())
+        except FileNotFoundError:
+            pass
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.__config.directory, f'{segment:08d}{self.SEGMENT_SUFFIX}')
+
+    @property
+    def config(self) -> StoreForwardConfig:
+        return self.__config
+
+    @property
+    def pending_bytes(self) -> int:
+        return sum(self.__segment_sizes.values()) - self.__read_offset
+
+    @property
+    def empty(self) -> bool:
+        return self.pending_bytes <= 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'pending_bytes': self.pending_bytes,
+            'segments': len(self.__segments),
+            'appended': self.__appended,
+            'replayed': self.__replayed,
+            'dropped': self.__dropped,
+            'dropped_bytes': self.__dropped_bytes
+        }
+
+    def append(self, topic: str, payload: bytes) -> bool:
+        '''Store a message, returns False if it was dropped because the store is full'''
+        topic_bytes = topic.encode('utf-8')
+        record = self.__header.pack(len(topic_bytes), len(payload)) + topic_bytes + payload
+        with self.__lock:
+            while sum(self.__segment_sizes.values()) + len(record) > self.__config.max_bytes:
+                if self.__config.eviction == EvictionPolicy.DROP_NEWEST or not self.__segments:
+                    self.__dropped += 1
+                    self.__dropped_bytes += len(record)
+                    return False
+                self.__evict_oldest()
+
+            if self.__roll_pending or not self.__segments or self.__segment_sizes[self.__segments[-1]] + len(record) > self.__config.segment_bytes:
+                self.__roll_pending = False
+                self.__roll_segment()
+            if self.__writer is None:
+                self.__writer = open(self.__segment_path(self.__segments[-1]), 'ab')
+            self.__writer.write(record)
+            self.__writer.flush()
+            self.__segment_sizes[self.__segments[-1]] += len(record)
+            self.__appended += 1
+            return True
+
+    def __roll_segment(self):
+        self.__close_writer()
+        segment = self.__segments[-1] + 1 if self.__segments else 1
+        self.__segments.append(segment)
+        self.__segment_sizes[segment] = 0
+
+    def __close_writer(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+    def __evict_oldest(self):
+        segment = self.__segments[0]
+        dropped_bytes = self.__segment_sizes[segment] - self.__read_offset
+        dropped = self.__count_records(segment, self.__read_offset)
+        logging.warning(f'Store and forward full, dropping {dropped} messages ({dropped_bytes} bytes) of the oldest stored data')
+        self.__dropped += dropped
+        self.__dropped_bytes += dropped_bytes
+        self.__delete_segment(segment)
+
+    def __count_records(self, segment: int, offset: int) -> int:
+        '''Complete records from offset to the end of segment, reading their headers only'''
+        count = 0
+        size = self.__segment_sizes[segment]
+        with open(self.__segment_path(segment), 'rb') as file:
+            while offset + self.__header.size <= size:
+                file.seek(offset)
+                topic_length, payload_length = self.__header.unpack(file.read(self.__header.size))
+                offset += self.__header.size + topic_length + payload_length
+                if offset > size:
+                    break
+                count += 1
+        return count
+
+    def __delete_segment(self, segment: int):
+        if len(self.__segments) == 1:
+            self.__close_writer()
+        self.__segments.remove(segment)
+        del self.__segment_sizes[segment]
+        self.__read_offset = 0
+        try:
+            os.remove(self.__segment_path(segment))
+        except FileNotFoundError:
+            pass
+        self.__save_cursor(0)  # after the segment is gone, a crash in between leaves a cursor of a deleted segment (ignored)
+
+    def peek(self) -> Optional[Tuple[str, bytes]]:
+        '''Oldest stored (topic, payload), None if the store is empty'''
+        with self.__lock:
+            while self.__segments:
+                segment = self.__segments[0]
+                record = self.__read_record(segment, self.__read_offset)
+                if record is not None:
+                    return record[0], record[1]
+                if self.__read_offset < self.__segment_sizes[segment]:
+                    logging.error(f'Store and forward: discarding truncated record in segment {segment}')
+                self.__delete_segment(segment)
+            return None
+
+    def pop(self):
+        '''Remove the record returned by the last peek(), call once it has been published'''
+        with self.__lock:
+            if not self.__segments:
+                return
+            segment = self.__segments[0]
+            record = self.__read_record(segment, self.__read_offset)
+            if record is None:
+                return
+            self.__read_offset = record[2]
+            self.__replayed += 1
+            if self.__read_offset >= self.__segment_sizes[segment]:
+                self.__delete_segment(segment)
+            else:
+                self.__save_cursor(self.__read_offset)
+
+    def __read_record(self, segment: int, offset: int) -> Optional[Tuple[str, bytes, int]]:
+        '''(topic, payload, next offset) of the record at offset, None at the end of the segment or on a torn write'''
+        if offset >= self.__segment_sizes[segment]:
+            return None
+        with open(self.__segment_path(segment), 'rb') as file:
+            file.seek(offset)
+            header = file.read(self.__header.size)
+            if len(header) < self.__header.size:
+                return None
+            topic_length, payload_length = self.__header.unpack(header)
+            body = file.read(topic_length + payload_length)
+            if len(body) < topic_length + payload_length:
+                return None
+        next_offset = offset + self.__header.size + topic_length + payload_length
+        return body[:topic_length].decode('utf-8'), body[topic_length:], next_offset
+
+    def close(self):
+        with self.__lock:
+            self.__close_writer()
@@ -0,0 +1,83 @@
+'''
+AliasAllocator: dense allocation, persistence across restarts and explicit alias collisions
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app.registry import AliasAllocator
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import pytest
+
+
+def metric(name: str, alias: int = None, disable_alias: bool = False) -> SparkplugMetric:
+    return SparkplugMetric(name, SparkplugDataTypes.Int32, lambda prev_value: 0, alias=alias, disable_alias=disable_alias)
+
+
+def test_allocates_dense_aliases():
+    metrics = [metric('a'), metric('b'), metric('c', disable_alias=True), metric('d')]
+    AliasAllocator().assign(metrics)
+    assert [m.alias for m in metrics if not m.disable_alias] == [1, 2, 3]
+
+
+def test_aliases_survive_a_restart_in_any_order(tmp_path):
+    filepath = str(tmp_path / 'aliases.json')
+    allocator = AliasAllocator(filepath)
+    allocator.assign([metric('a'), metric('b'), metric('c')])
+    assert allocator.save()
+    assert not allocator.save()
+
+    metrics = [metric('c'), metric('new'), metric('a')]
+    AliasAllocator(filepath).assign(metrics)
+    assert [m.alias for m in metrics] == [3, 4, 1]
+
+
+def test_explicit_alias_wins_over_a_remembered_one(tmp_path):
+    filepath = str(tmp_path / 'aliases.json')
+    allocator = AliasAllocator(filepath)
+    allocator.assign([metric('a'), metric('b')])
+    allocator.save()
+
+    metrics = [metric('a'), metric('b', alias=1)]
+    AliasAllocator(filepath).assign(metrics)
+    assert metrics[1].alias == 1
+    assert metrics[0].alias not in (None, 1)
+
+
+def test_duplicate_explicit_alias_is_rejected():
+    with pytest.raises(ValueError):
+        AliasAllocator().assign([metric('a', alias=5), metric('b', alias=5)])
+
+
+def test_device_metrics_share_the_node_alias_space():
+    allocator = AliasAllocator()
+    node_metrics = [metric('a'), metric('b')]
+    device_metrics = [metric('a'), metric('b')]
+    allocator.assign(node_metrics)
+    allocator.assign(device_metrics, device_id='d1')
+    aliases = [m.alias for m in node_metrics + device_metrics]
+    assert len(set(aliases)) == len(aliases)
+
+
+def test_device_alias_colliding_with_a_node_alias_is_rejected():
+    allocator = AliasAllocator()
+    node_metrics = [metric('a'), metric('b', alias=7)]
+    allocator.assign(node_metrics)
+    for alias in (node_metrics[0].alias, 7):
+        device_metric = metric('x', alias=alias)
+        with pytest.raises(ValueError):
+            allocator.assign([device_metric], device_id='d1')
+
+
+def test_aliases_colliding_across_devices_are_rejected():
+    allocator = AliasAllocator()
+    allocator.assign([metric('x', alias=9)], device_id='d1')
+    with pytest.raises(ValueError):
+        allocator.assign([metric('x', alias=9)], device_id='d2')
+
+
+def test_assigning_the_same_metrics_again_keeps_their_aliases():
+    allocator = AliasAllocator()
+    metrics = [metric('a', alias=4), metric('b')]
+    allocator.assign(metrics)
+    aliases = [m.alias for m in metrics]
+    allocator.assign(metrics)
+    assert [m.alias for m in metrics] == aliases
@@ -0,0 +1,135 @@
+'''
+Sparkplug array datatypes: pack / unpack round-trips from lists, array.array and NumPy arrays,
+and persistence of array memory tags
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app.arrays import BOOLEAN_ARRAY, STRING_ARRAY, TYPECODES, pack_array, unpack_array
+from sparkplug_node_app.sparkplug_tags import MemoryTagStore, SparkplugDataTypes, SparkplugMemoryTag
+from array import array
+import json
+import pytest
+import struct
+
+
+SAMPLES = {
+    SparkplugDataTypes.Int8Array: [-128, 0, 127],
+    SparkplugDataTypes.Int16Array: [-32768, 1, 32767],
+    SparkplugDataTypes.Int32Array: [-2 ** 31, 2, 2 ** 31 - 1],
+    SparkplugDataTypes.Int64Array: [-2 ** 63, 3, 2 ** 63 - 1],
+    SparkplugDataTypes.UInt8Array: [0, 1, 255],
+    SparkplugDataTypes.UInt16Array: [0, 2, 65535],
+    SparkplugDataTypes.UInt32Array: [0, 3, 2 ** 32 - 1],
+    SparkplugDataTypes.UInt64Array: [0, 4, 2 ** 64 - 1],
+    SparkplugDataTypes.FloatArray: [-1.5, 0.0, 3.25],
+    SparkplugDataTypes.DoubleArray: [-1e300, 0.1, 2.5],
+    SparkplugDataTypes.DateTimeArray: [0, 1_700_000_000_000]
+}
+
+NUMPY_DTYPES = {
+    SparkplugDataTypes.Int8Array: 'int8', SparkplugDataTypes.Int16Array: 'int16',
+    SparkplugDataTypes.Int32Array: 'int32', SparkplugDataTypes.Int64Array: 'int64',
+    SparkplugDataTypes.UInt8Array: 'uint8', SparkplugDataTypes.UInt16Array: 'uint16',
+    SparkplugDataTypes.UInt32Array: 'uint32', SparkplugDataTypes.UInt64Array: 'uint64',
+    SparkplugDataTypes.FloatArray: 'float32', SparkplugDataTypes.DoubleArray: 'float64',
+    SparkplugDataTypes.DateTimeArray: 'int64'
+}
+
+
+@pytest.mark.parametrize('datatype', list(SAMPLES))
+def test_numbers_round_trip(datatype):
+    values = SAMPLES[datatype]
+    packed = pack_array(datatype.value, values)
+    assert packed == struct.pack(f'<{len(values)}{TYPECODES[datatype.value]}', *values)
+    assert list(unpack_array(datatype.value, packed)) == values
+    assert pack_array(datatype.value, packed) is packed
+    assert pack_array(datatype.value, array(TYPECODES[datatype.value], values)) == packed
+
+
+def test_booleans_round_trip():
+    values = [True, False, True, True, False, False, False, False, True]
+    packed = pack_array(BOOLEAN_ARRAY, values)
+    assert packed[:4] == (9).to_bytes(4, 'little')
+    assert packed[4:] == bytes([0b10110000, 0b10000000])
+    assert unpack_array(BOOLEAN_ARRAY, packed) == values
+    assert unpack_array(BOOLEAN_ARRAY, pack_array(BOOLEAN_ARRAY, [])) == []
+
+
+def test_strings_round_trip():
+    values = ['a', '', 'ünïcode']
+    packed = pack_array(STRING_ARRAY, values)
+    assert packed == b'a\x00\x00\xc3\xbcn\xc3\xafcode\x00'
+    assert unpack_array(STRING_ARRAY, packed) == values
+
+
+def test_invalid_values_are_rejected():
+    with pytest.raises(OverflowError):
+        pack_array(SparkplugDataTypes.Int8Array.value, [128])
+    with pytest.raises(OverflowError):
+        pack_array(SparkplugDataTypes.UInt16Array.value, [-1])
+    with pytest.raises(TypeError):
+        pack_array(SparkplugDataTypes.Int32Array.value, [1.5])
+    with pytest.raises(ValueError):
+        pack_array(SparkplugDataTypes.Int32Array.value, b'\x00\x00\x00')
+    with pytest.raises(ValueError):
+        pack_array(BOOLEAN_ARRAY, b'\x05\x00\x00\x00')
+    with pytest.raises(ValueError):
+        pack_array(STRING_ARRAY, ['nul\x00inside'])
+    with pytest.raises(TypeError):
+        pack_array(STRING_ARRAY, 'not a list')
+
+
+@pytest.mark.parametrize('datatype', list(SAMPLES))
+def test_numpy_arrays_of_the_element_type(datatype):
+    np = pytest.importorskip('numpy')
+    values = SAMPLES[datatype]
+    dtype = np.dtype(NUMPY_DTYPES[datatype])
+    expected = pack_array(datatype.value, values)
+    assert pack_array(datatype.value, np.array(values, dtype=dtype)) == expected
+    assert pack_array(datatype.value, np.array(values, dtype=dtype.newbyteorder('>'))) == expected
+
+
+def test_numpy_arrays_of_other_dtypes_are_converted_like_lists():
+    np = pytest.importorskip('numpy')
+    linspace = np.linspace(0.0, 1.0, 5)  # float64
+    assert list(unpack_array(SparkplugDataTypes.FloatArray.value, pack_array(SparkplugDataTypes.FloatArray.value, linspace))) == [0.0, 0.25, 0.5, 0.75, 1.0]
+    arange = np.arange(5)  # int64
+    for datatype in (SparkplugDataTypes.Int32Array, SparkplugDataTypes.UInt8Array, SparkplugDataTypes.DoubleArray):
+        assert pack_array(datatype.value, arange) == pack_array(datatype.value, list(range(5)))
+    assert pack_array(SparkplugDataTypes.Int16Array.value, np.array([True, False])) == pack_array(SparkplugDataTypes.Int16Array.value, [1, 0])
+    assert pack_array(SparkplugDataTypes.Int32Array.value, arange[::2]) == pack_array(SparkplugDataTypes.Int32Array.value, [0, 2, 4])
+
+
+def test_numpy_arrays_out_of_range_are_rejected_like_lists():
+    np = pytest.importorskip('numpy')
+    for datatype, values in (
+        (SparkplugDataTypes.Int32Array, [2 ** 31]),
+        (SparkplugDataTypes.UInt8Array, [-1]),
+        (SparkplugDataTypes.UInt8Array, [256])
+    ):
+        with pytest.raises(OverflowError):
+            pack_array(datatype.value, values)
+        with pytest.raises(OverflowError):
+            pack_array(datatype.value, np.array(values, dtype=np.int64))
+    with pytest.raises(TypeError):
+        pack_array(SparkplugDataTypes.Int32Array.value, np.linspace(0.0, 1.0, 3))
+
+
+def test_numpy_booleans():
+    np = pytest.importorskip('numpy')
+    values = [True, False, True]
+    assert pack_array(BOOLEAN_ARRAY, np.array(values)) == pack_array(BOOLEAN_ARRAY, values)
+
+
+def test_memory_tag_array_value_persists_as_a_list(tmp_path):
+    filepath = str(tmp_path / 'memory_tags.json')
+    tag = SparkplugMemoryTag('array', SparkplugDataTypes.Int32Array, writable=True, initial_value=[1, 2], persistence_file=filepath)
+    tag.update_value(pack_array(SparkplugDataTypes.Int32Array.value, [3, 4, 5]))  # packed, as written by an NCMD
+    tag.save_to_disk()
+    with open(filepath) as file:
+        assert json.load(file)['array']['current_value'] == [3, 4, 5]
+    assert MemoryTagStore(filepath).get('array')['current_value'] == [3, 4, 5]  # parsed again, as in a new process
+
+    restored = SparkplugMemoryTag('array', SparkplugDataTypes.Int32Array, writable=True, initial_value=[1, 2], persistence_file=filepath)
+    assert list(restored.array_value) == [3, 4, 5]
+    assert restored.current_value == pack_array(SparkplugDataTypes.Int32Array.value, [3, 4, 5])
@@ -0,0 +1,148 @@
+'''
+AsyncSparkplugEdgeNode: concurrent async reads, read timeouts and stale Quality, births built from the values of the last scan
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.async_node import AsyncSparkplugEdgeNode
+from sparkplug_node_app.rbe import RbePolicy
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import asyncio
+import time
+import types
+
+
+class Source:
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def read(self, prev_value):
+        return self.value
+
+
+class AsyncSource:
+    '''Value of a metric whose async reads wait while the gate is closed'''
+    def __init__(self, value) -> None:
+        self.value = value
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.reads = 0
+
+    async def read(self, prev_value):
+        await self.gate.wait()
+        self.reads += 1
+        return self.value
+
+
+def reading_node(metrics: list, read_timeout: int = 50) -> AsyncSparkplugEdgeNode:
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    return AsyncSparkplugEdgeNode('group', 'node', brokers, metrics=metrics, read_timeout=read_timeout)
+
+
+def test_async_reads_run_concurrently():
+    values = list(range(10))
+
+    def slow_read(idx: int):
+        async def read(prev_value):
+            await asyncio.sleep(0.05)
+            return values[idx]
+        return read
+
+    metrics = [SparkplugMetric(f'm{idx}', SparkplugDataTypes.Int32, slow_read(idx)) for idx in range(10)]
+    node = reading_node(metrics, read_timeout=1000)
+
+    async def scenario():
+        await node.read_metrics_async(rbe=False)
+        values[:] = [value + 100 for value in values]
+        started = time.monotonic()
+        changed = await node.read_metrics_async()
+        assert time.monotonic() - started < 0.3  # not 10 reads one after the other
+        return changed
+
+    assert sorted(asyncio.run(scenario()), key=lambda metric: metric.name) == metrics
+    assert [metric.current_value for metric in metrics] == [idx + 100 for idx in range(10)]
+
+
+def test_async_read_timeout_reports_stale_until_a_read_succeeds():
+    async def scenario():
+        source = AsyncSource(1)
+        metric = SparkplugMetric('slow', SparkplugDataTypes.Int32, source.read)
+        node = reading_node([metric])
+        await node.read_metrics_async(rbe=False)
+
+        source.gate.clear()
+        source.value = 2
+        assert await node.read_metrics_async() == [metric]
+        assert metric.stale
+        assert await node.read_metrics_async() == []  # previous read still running, skipped
+        assert source.reads == 1
+
+        source.gate.set()
+        await asyncio.sleep(0.01)  # the timed out read finishes late
+        assert metric.current_value == 2
+        source.gate.clear()
+        source.value = 3
+        assert await node.read_metrics_async() == []  # timed out again, the late value is not reported while stale
+
+        source.gate.set()
+        await asyncio.sleep(0.01)
+        assert await node.read_metrics_async() == [metric]
+        assert not metric.stale and metric.current_value == 3
+
+    asyncio.run(scenario())
+
+
+def make_node(monkeypatch, metrics: list) -> tuple:
+    '''Async edge node whose mqtt client "connects" on the event loop and records the published messages'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = AsyncSparkplugEdgeNode('group', 'node', brokers, metrics=metrics, scan_rate=60_000)
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    node._run_client = lambda client, broker: asyncio.get_running_loop().call_soon(client.on_connect, client, None, {}, 0)
+    node._stop_client_loop = lambda client: None
+    return node, published
+
+
+async def run(node: AsyncSparkplugEdgeNode, scenario):
+    task = asyncio.create_task(node.run_forever())
+    try:
+        while not node.online:
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.05)  # the first scan of the loop, the next one is a scan_rate away
+        await scenario()
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def message_types(published: list) -> list:
+    return [topic.split('/')[2] for topic, _ in published]
+
+
+def test_birth_values_are_the_published_values_of_the_next_scans(monkeypatch):
+    source = Source(0.0)
+    metric = SparkplugMetric('m', SparkplugDataTypes.Double, source.read, rbe_policy=RbePolicy(deadband=5))
+    node, published = make_node(monkeypatch, [metric])
+
+    async def scenario():
+        source.value = 3.0
+        assert await node.rbe() == []  # within the deadband of 0.0
+        node.client.on_connect(node.client, None, {}, 0)  # reconnected, the NBIRTH carries 3.0
+        source.value = 7.0
+        assert await node.rbe() == []  # within the deadband of the 3.0 of the NBIRTH
+        source.value = 8.5
+        assert await node.rbe() == [metric]
+
+    asyncio.run(run(node, scenario))
+    assert message_types(published) == ['NBIRTH', 'NBIRTH', 'NDATA']
@@ -0,0 +1,174 @@
+'''
+PublishBatcher: batches published when their window ends or they reach max_bytes, repeated samples of a metric merged,
+and the edge node dropping the batches an NBIRTH supersedes
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import helpers, mqtt_functions
+from sparkplug_node_app.batching import BatchConfig, PublishBatcher
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag
+import pytest
+import types
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0
+
+    def __call__(self) -> int:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(helpers, 'monotonic_millis', clock)
+    return clock
+
+
+def data_payload(*values) -> sparkplug_pb2.Payload:
+    '''Payload of (alias, value) entries'''
+    payload = sparkplug_pb2.Payload()
+    for alias, value in values:
+        metric = payload.metrics.add()
+        metric.alias = alias
+        metric.int_value = value
+    return payload
+
+
+def entries(payload: sparkplug_pb2.Payload) -> list:
+    return [(metric.alias, metric.int_value) for metric in payload.metrics]
+
+
+def test_batch_is_due_when_its_window_ends(clock):
+    batcher = PublishBatcher(BatchConfig(max_latency=100))
+    assert batcher.next_deadline is None
+    batcher.add('a', [1], data_payload((1, 10)))
+    clock.now = 40
+    batcher.add('b', [2], data_payload((2, 20)))
+    assert batcher.next_deadline == 100
+
+    clock.now = 99
+    assert batcher.take_due() == []
+    clock.now = 100
+    [(topic, payload)] = batcher.take_due()
+    assert topic == 'a' and entries(payload) == [(1, 10)]
+    assert batcher.next_deadline == 140
+    assert [topic for topic, _ in batcher.take_due(flush=True)] == ['b']
+    assert batcher.next_deadline is None
+    assert batcher.stats.batches == 2 and batcher.stats.size_flushes == 0
+
+
+def test_batch_reaching_max_bytes_is_full():
+    batcher = PublishBatcher(BatchConfig(max_latency=1000, max_bytes=30))
+    assert not batcher.add('a', [1], data_payload((1, 10)))
+    assert batcher.add('a', [2, 3, 4], data_payload((2, 20), (3, 30), (4, 40)))
+    assert entries(batcher.take('a')) == [(1, 10), (2, 20), (3, 30), (4, 40)]
+    assert batcher.take('a') is None
+    assert batcher.stats.size_flushes == 1
+
+
+def test_repeated_metric_keeps_its_latest_sample():
+    batcher = PublishBatcher(BatchConfig())
+    batcher.add('a', [1, 2], data_payload((1, 10), (2, 20)))
+    batcher.add('a', [1, None], data_payload((1, 11), (5, 50)))
+    batcher.add('a', [None], data_payload((5, 51)))  # None: never merged
+    [(_, payload)] = batcher.take_due(flush=True)
+    assert entries(payload) == [(2, 20), (1, 11), (5, 50), (5, 51)]  # the latest sample moves behind the entries added since
+    assert batcher.stats.samples == 5 and batcher.stats.merged == 1
+
+
+def test_merged_sample_keeps_the_quality_of_the_replaced_one():
+    batcher = PublishBatcher(BatchConfig())
+    first = data_payload((1, 10))
+    first.metrics[0].properties.keys.append('Quality')
+    first.metrics[0].properties.values.add().int_value = 500
+    batcher.add('a', [1], first)
+    batcher.add('a', [1], data_payload((1, 11)))
+    [(_, payload)] = batcher.take_due(flush=True)
+    assert entries(payload) == [(1, 11)]
+    assert list(payload.metrics[0].properties.keys) == ['Quality']
+
+
+def test_history_keeps_every_sample():
+    batcher = PublishBatcher(BatchConfig(history=True))
+    batcher.add('a', [1], data_payload((1, 10)))
+    batcher.add('a', [1], data_payload((1, 11)))
+    [(_, payload)] = batcher.take_due(flush=True)
+    assert entries(payload) == [(1, 10), (1, 11)]
+    assert batcher.stats.merged == 0
+
+
+def test_clear_drops_the_waiting_batches():
+    batcher = PublishBatcher(BatchConfig())
+    batcher.add('a', [1, 2], data_payload((1, 10), (2, 20)))
+    batcher.add('b', [1], data_payload((1, 10)))
+    assert batcher.clear() == 3
+    assert batcher.next_deadline is None and batcher.take_due(flush=True) == []
+
+
+def test_config_is_validated():
+    with pytest.raises(ValueError):
+        BatchConfig(max_latency=-1)
+    with pytest.raises(ValueError):
+        BatchConfig(max_bytes=0)
+
+
+def online_node(monkeypatch) -> tuple:
+    '''Batching edge node whose mqtt client records the published messages, after its NBIRTH'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    metrics = [SparkplugMemoryTag(name=f'm{idx}', datatype=SparkplugDataTypes.Int32, initial_value=0) for idx in range(3)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics, batching=BatchConfig(max_latency=100))
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    return node, metrics, published
+
+
+def decode(message: bytes) -> sparkplug_pb2.Payload:
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return payload
+
+
+def test_node_coalesces_scans_into_one_ndata(monkeypatch, clock):
+    node, metrics, published = online_node(monkeypatch)
+    for idx, value in [(0, 1), (1, 20), (0, 2), (2, 30), (0, 3)]:
+        metrics[idx].update_value(value)
+        node._rbe()
+    assert len(published) == 1  # the NBIRTH, the scans wait in the batch
+
+    clock.now = 100
+    node._publish_batches()
+    assert [topic.split('/')[2] for topic, _ in published] == ['NBIRTH', 'NDATA']
+    ndata = decode(published[-1][1])
+    assert ndata.seq == 1
+    assert sorted((metric.alias, metric.int_value) for metric in ndata.metrics) == [
+        (metrics[0].alias, 3), (metrics[1].alias, 20), (metrics[2].alias, 30)
+    ]
+    assert node.batch_stats.merged == 2
+
+
+def test_nbirth_drops_the_batches_it_supersedes(monkeypatch, clock):
+    node, metrics, published = online_node(monkeypatch)
+    metrics[0].update_value(1)
+    node._rbe()
+    node.client.on_connect(node.client, None, {}, 0)  # reconnected: the NBIRTH carries the value
+    node.flush_batches()
+    assert [topic.split('/')[2] for topic, _ in published] == ['NBIRTH', 'NBIRTH']
+    assert decode(published[-1][1]).seq == 0
+
+    metrics[0].update_value(2)
+    node._rbe()
+    node.flush_batches()
+    assert decode(published[-1][1]).seq == 1
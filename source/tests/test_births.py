@@ -0,0 +1,108 @@
+'''
+NBIRTH / DBIRTH built from the cached birth templates of the metrics: the same bytes as a full encode of the payload,
+on the first birth and on rebirths after values, the quality or aliases changed
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.rbe import RbePolicy
+from sparkplug_node_app.sparkplug import SparkplugDevice, SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag, SparkplugMetric
+import types
+
+
+class Source:
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def read(self, prev_value):
+        return self.value
+
+
+def make_metrics(sources: dict) -> list:
+    return [
+        SparkplugMetric('int', SparkplugDataTypes.Int32, sources['int'].read),
+        SparkplugMetric('double', SparkplugDataTypes.Double, sources['double'].read, rbe_policy=RbePolicy(deadband=0.5)),
+        SparkplugMetric('string', SparkplugDataTypes.String, sources['string'].read, disable_alias=True),
+        SparkplugMetric('array', SparkplugDataTypes.Int16Array, sources['array'].read),
+        SparkplugMemoryTag(name='writable', datatype=SparkplugDataTypes.Int64, initial_value=None, writable=True)
+    ]
+
+
+def online_node(monkeypatch, metrics: list, devices: dict = None) -> tuple:
+    '''Edge node whose mqtt client records the published messages, after its NBIRTH'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics)
+    for device_id, device_metrics in (devices or {}).items():
+        SparkplugDevice(node, device_id, metrics=device_metrics)
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    return node, published
+
+
+def full_encode(node: SparkplugEdgeNode, message: bytes, device: SparkplugDevice = None) -> bytes:
+    '''The birth encoded field by field from the metrics, with the header (timestamp, seq, bdSeq) of message'''
+    published = sparkplug_pb2.Payload()
+    published.ParseFromString(message)
+    payload = sparkplug_pb2.Payload()
+    payload.timestamp = published.timestamp
+    if device is None:
+        payload.metrics.add().CopyFrom(published.metrics[0])  # bdSeq
+    for metric in node.registry.metrics if device is None else device.metrics:  # as read for the birth, not read again
+        metric.fill_birth_metric(payload.metrics.add())
+    payload.seq = published.seq
+    return payload.SerializeToString()
+
+
+def test_birth_is_byte_identical_to_a_full_encode(monkeypatch):
+    sources = {'int': Source(7), 'double': Source(1.25), 'string': Source('text'), 'array': Source([1, -2, 3])}
+    node, published = online_node(monkeypatch, make_metrics(sources))
+    topic, nbirth = published[-1]
+    assert topic == node.topics.NBIRTH
+    assert nbirth == full_encode(node, nbirth)
+
+
+def test_rebirth_after_changes_is_byte_identical_to_a_full_encode(monkeypatch):
+    sources = {'int': Source(7), 'double': Source(1.25), 'string': Source('text'), 'array': Source([1, -2, 3])}
+    metrics = make_metrics(sources)
+    node, published = online_node(monkeypatch, metrics)
+    template = metrics[0].birth_template()
+
+    sources['int'].value = -5
+    sources['string'].value = ''
+    metrics[4].update_value(2 ** 40)
+    metrics[1].set_stale(True)  # Quality property
+    node.read_metrics()
+    node.client.on_connect(node.client, None, {}, 0)
+    nbirth = published[-1][1]
+    assert nbirth == full_encode(node, nbirth)
+    assert metrics[0].birth_template() is template  # only the value changed
+    assert b'Quality' in metrics[1].birth_template()[2]
+
+    metrics[4].update_value(None)
+    metrics[1].set_stale(False)
+    metrics[0].set_alias(999)
+    node.client.on_connect(node.client, None, {}, 0)
+    nbirth = published[-1][1]
+    assert nbirth == full_encode(node, nbirth)
+
+
+def test_dbirth_is_byte_identical_to_a_full_encode(monkeypatch):
+    device_metrics = [
+        SparkplugMemoryTag(name='x', datatype=SparkplugDataTypes.Float, initial_value=0.5, writable=True),
+        SparkplugMemoryTag(name='y', datatype=SparkplugDataTypes.Boolean, initial_value=True)
+    ]
+    node, published = online_node(monkeypatch, [], devices={'d1': device_metrics})
+    topic, dbirth = published[-1]
+    assert topic == node.devices['d1'].topics.DBIRTH
+    assert dbirth == full_encode(node, dbirth, device=node.devices['d1'])
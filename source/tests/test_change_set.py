@@ -0,0 +1,83 @@
+'''
+ChangeSet: push metrics (memory tags) reporting their changes, RBE scans reading only the polled metrics and
+the push metrics that changed
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.registry import ChangeSet
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag, SparkplugMetric
+
+
+def tag(name: str, scan_class: str = None) -> SparkplugMemoryTag:
+    return SparkplugMemoryTag(name=name, datatype=SparkplugDataTypes.Int32, initial_value=0, scan_class=scan_class)
+
+
+def test_take_returns_each_change_once_in_change_order():
+    changes = ChangeSet()
+    a, b, c = tag('a'), tag('b'), tag('c')
+    for metric in (b, a, b, c, a):
+        changes.mark(metric)
+    assert len(changes) == 3
+    assert changes.take() == [b, a, c]  # a metric changed twice is taken once, at its first change
+    assert len(changes) == 0 and changes.take() == []
+
+
+def test_take_select_leaves_the_other_changes():
+    changes = ChangeSet()
+    a, b, c = tag('a'), tag('b'), tag('c')
+    for metric in (a, b, c):
+        changes.mark(metric)
+    assert changes.take(lambda metric: metric.name != 'b') == [a, c]
+    assert changes.take() == [b]
+    changes.mark(a)
+    changes.clear()
+    assert changes.take() == []
+
+
+def make_node(metrics: list, **kwargs) -> SparkplugEdgeNode:
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics, **kwargs)
+    node.read_metrics(rbe=False)
+    return node
+
+
+def test_rbe_scan_reads_only_the_push_metrics_that_changed():
+    reads = []
+    polled = SparkplugMetric('polled', SparkplugDataTypes.Int32, lambda prev_value: reads.append(1) or 0)
+    tags = [tag(f't{idx}') for idx in range(100)]
+    node = make_node([polled] + tags)
+    assert node.pending_changes == 0
+    polled_metrics = node._scan_targets()
+    assert polled in polled_metrics and not set(polled_metrics) & set(tags)
+
+    tags[7].update_value(1)
+    tags[3].update_value(1)
+    tags[7].update_value(2)
+    assert node.pending_changes == 2
+    assert node._scan_targets() == polled_metrics + [tags[7], tags[3]]
+    assert node.pending_changes == 0
+
+    tags[5].update_value(1)
+    reads.clear()
+    assert node.read_metrics() == [tags[5]]
+    assert len(reads) == 1 and node.pending_changes == 0
+
+
+def test_scan_of_one_class_takes_only_its_changes():
+    fast, slow = tag('fast'), tag('slow', scan_class='slow')
+    node = make_node([fast, slow], scan_classes={'slow': 5000})
+    fast.update_value(1)
+    slow.update_value(1)
+    assert node.read_metrics(scan_classes=['slow']) == [slow]
+    assert node.pending_changes == 1
+    assert node.read_metrics() == [fast]
+
+
+def test_full_scan_drops_the_pending_changes():
+    metric = tag('t')
+    node = make_node([metric])
+    metric.update_value(1)
+    node.read_metrics(rbe=False)  # read every metric anyway
+    assert node.pending_changes == 0
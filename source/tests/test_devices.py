@@ -0,0 +1,137 @@
+'''
+Devices behind an edge node: DBIRTH after the NBIRTH (or at once when added online), DDATA per device,
+DCMD routing, DDEATH and device aliases in the node's alias space
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugDevice, SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag
+import types
+
+
+def memory_tags(value: int) -> list:
+    return [
+        SparkplugMemoryTag(name='x', datatype=SparkplugDataTypes.Int32, initial_value=value, writable=True),
+        SparkplugMemoryTag(name='y', datatype=SparkplugDataTypes.Int32, initial_value=0)
+    ]
+
+
+def online_node(monkeypatch, devices: int = 0) -> tuple:
+    '''Edge node with devices d0, d1, ..., whose mqtt client records the published messages, after its NBIRTH'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=[SparkplugMemoryTag(name='x', datatype=SparkplugDataTypes.Int32, initial_value=0)])
+    for idx in range(devices):
+        SparkplugDevice(node, f'd{idx}', metrics=memory_tags(idx))
+    published = []
+    subscriptions = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda topic, *args, **kwargs: subscriptions.append(topic) or (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    assert node.online
+    return node, published, subscriptions
+
+
+def decode(message: bytes) -> sparkplug_pb2.Payload:
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return payload
+
+
+def messages(published: list) -> list:
+    '''(message type, device id or None, seq) of the published messages'''
+    result = []
+    for topic, message in published:
+        parts = topic.split('/')
+        result.append((parts[2], parts[4] if len(parts) > 4 else None, decode(message).seq))
+    return result
+
+
+def send_dcmd(node: SparkplugEdgeNode, device_id: str, **values):
+    '''DCMD delivered through the client's topic subscriptions, like paho does'''
+    payload = sparkplug_pb2.Payload()
+    for name, value in values.items():
+        metric = payload.metrics.add()
+        metric.name = name
+        metric.int_value = value
+    message = mqtt_functions.mqtt.MQTTMessage(topic=f'spBv1.0/group/DCMD/node/{device_id}'.encode())
+    message.payload = payload.SerializeToString()
+    node.client._handle_on_message(message)
+
+
+def test_dbirth_follows_the_nbirth(monkeypatch):
+    node, published, subscriptions = online_node(monkeypatch, devices=2)
+    assert messages(published) == [('NBIRTH', None, 0), ('DBIRTH', 'd0', 1), ('DBIRTH', 'd1', 2)]
+    assert node.topics.DCMD in subscriptions
+    assert all(device.online for device in node.devices.values())
+
+
+def test_device_added_online_is_born_at_once(monkeypatch):
+    node, published, subscriptions = online_node(monkeypatch)
+    assert node.topics.DCMD not in subscriptions
+    device = SparkplugDevice(node, 'late', metrics=memory_tags(5))
+    assert messages(published) == [('NBIRTH', None, 0), ('DBIRTH', 'late', 1)]
+    assert node.topics.DCMD in subscriptions
+    assert device.online
+    dbirth = decode(published[-1][1])
+    assert {metric.name: metric.int_value for metric in dbirth.metrics} == {'x': 5, 'y': 0}
+
+
+def test_scan_publishes_one_ddata_per_changed_device(monkeypatch):
+    node, published, _ = online_node(monkeypatch, devices=3)
+    node.devices['d0'].registry.by_name('y').update_value(7)
+    node.devices['d2'].registry.by_name('x').update_value(8)
+    del published[:]
+    node._rbe()
+    assert sorted((kind, device_id) for kind, device_id, _ in messages(published)) == [('DDATA', 'd0'), ('DDATA', 'd2')]
+    assert sorted(seq for _, _, seq in messages(published)) == [4, 5]
+
+
+def test_dcmd_writes_the_metric_of_the_addressed_device(monkeypatch):
+    node, published, _ = online_node(monkeypatch, devices=2)
+    send_dcmd(node, 'd1', x=77)
+    send_dcmd(node, 'unknown', x=99)
+    assert node.devices['d1'].registry.by_name('x').current_value == 77
+    assert node.devices['d0'].registry.by_name('x').current_value == 0
+    assert node.registry.by_name('x').current_value == 0
+
+
+def test_ddeath_takes_the_next_seq_and_silences_the_device(monkeypatch):
+    node, published, _ = online_node(monkeypatch, devices=2)
+    device = node.devices['d0']
+    assert device.death()
+    assert messages(published)[-1] == ('DDEATH', 'd0', 3)
+    assert not device.online and not device.death()
+
+    device.registry.by_name('y').update_value(9)
+    node._rbe()
+    assert messages(published)[-1] == ('DDEATH', 'd0', 3)  # no DDATA while dead
+
+    assert device.birth() and device.online
+    assert messages(published)[-1] == ('DBIRTH', 'd0', 4)
+    node.client.on_connect(node.client, None, {}, 0)  # reconnected: DBIRTH of the enabled devices only
+    assert [kind for kind, _, _ in messages(published)][-3:] == ['NBIRTH', 'DBIRTH', 'DBIRTH']
+    device.death()
+    node.client.on_connect(node.client, None, {}, 0)
+    assert [(kind, device_id) for kind, device_id, _ in messages(published)][-2:] == [('NBIRTH', None), ('DBIRTH', 'd1')]
+
+
+def test_device_aliases_share_the_node_alias_space(monkeypatch):
+    node, published, _ = online_node(monkeypatch, devices=2)
+    births = [decode(message) for topic, message in published if 'BIRTH' in topic]
+    aliases = [metric.alias for payload in births for metric in payload.metrics if metric.HasField('alias')]
+    assert len(aliases) == len(set(aliases)) == 5  # x of the node, x and y of each device
+
+    node.devices['d1'].registry.by_name('x').update_value(3)
+    node._rbe()
+    ddata = decode(published[-1][1])
+    assert [metric.alias for metric in ddata.metrics] == [node.devices['d1'].registry.by_name('x').alias]
+    assert not ddata.metrics[0].name  # aliased in DDATA
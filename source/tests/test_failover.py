@@ -0,0 +1,247 @@
+'''
+Backoff delays, and the edge node walking its broker list: connect timeouts, failover to the backup broker,
+fallback to the primary broker through a standby connection
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import helpers, mqtt_functions
+from sparkplug_node_app.failover import Backoff, FailoverConfig
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import pytest
+import types
+
+
+def test_backoff_grows_to_the_maximum():
+    backoff = Backoff(100, 1000, multiplier=2.0, jitter=0)
+    assert [backoff.next_delay() for _ in range(6)] == [100, 200, 400, 800, 1000, 1000]
+    assert backoff.attempts == 6
+    backoff.reset()
+    assert backoff.next_delay() == 100
+
+
+def test_backoff_jitter_stays_within_bounds():
+    backoff = Backoff(1000, 1000, jitter=0.2)
+    assert all(800 <= backoff.next_delay() <= 1200 for _ in range(200))
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0
+
+    def __call__(self) -> int:
+        return self.now
+
+
+class FakeClient:
+    '''Stands in for a paho client: the test decides when the broker accepts the connection'''
+    def __init__(self, broker: mqtt_functions.BrokerInfo) -> None:
+        self.broker = broker
+        self.running = False
+        self.connected = False
+        self.will = None
+        self.published = []
+        self.on_connect = self.on_disconnect = self.on_publish = self.on_message = None
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload)
+
+    def subscribe(self, topic, qos=0):
+        return mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        rc = mqtt_functions.mqtt.MQTT_ERR_SUCCESS if self.connected else mqtt_functions.mqtt.MQTT_ERR_NO_CONN
+        return types.SimpleNamespace(rc=rc, mid=len(self.published))
+
+    def disconnect(self):
+        self.connected = False
+
+    def accept(self):
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def drop(self):
+        self.connected = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 1)
+
+    def message_types(self) -> list:
+        return [topic.split('/')[2] for topic, _ in self.published]
+
+
+def bdseq(message: bytes) -> int:
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return next(metric.long_value for metric in payload.metrics if metric.name == 'bdSeq')
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(helpers, 'monotonic_millis', clock)
+    return clock
+
+
+@pytest.fixture
+def clients(monkeypatch) -> list:
+    '''Every client the edge node created, in order'''
+    clients = []
+
+    def create_client(broker):
+        clients.append(FakeClient(broker))
+        return clients[-1]
+
+    monkeypatch.setattr(mqtt_functions.BrokerInfo, 'create_client', create_client)
+    return clients
+
+
+def make_node(read=lambda prev_value: 1, **failover) -> SparkplugEdgeNode:
+    brokers = [
+        mqtt_functions.BrokerInfo(client_id='test', host='primary', port=1883, use_tls=False, primary=True, name='primary'),
+        mqtt_functions.BrokerInfo(client_id='test', host='backup', port=1883, use_tls=False, name='backup')
+    ]
+    config = dict(connect_timeout=1000, backoff_initial=500, backoff_max=4000, backoff_jitter=0, primary_check_rate=5000)
+    config.update(failover)
+    node = SparkplugEdgeNode(
+        'group', 'node', brokers,
+        metrics=[SparkplugMetric('m', SparkplugDataTypes.Int32, read)],
+        failover=FailoverConfig(**config)
+    )
+    node._run_client = lambda client, broker: setattr(client, 'running', True)
+    node._stop_client_loop = lambda client: setattr(client, 'running', False)
+    return node
+
+
+def test_walks_to_the_backup_when_the_primary_times_out(clock, clients):
+    node = make_node()
+    assert node._maintain_connection() == 1000  # connect deadline
+    primary = clients[-1]
+    assert primary.running and primary.broker.name == 'primary'
+
+    clock.now = 999
+    assert node._maintain_connection() == 1000
+    clock.now = 1000
+    assert node._maintain_connection() == 1500  # after the backoff delay
+    assert not primary.running
+    assert node.current_broker.name == 'backup'
+
+    clock.now = 1500
+    node._maintain_connection()
+    backup = clients[-1]
+    assert backup.running and backup.broker.name == 'backup'
+    backup.accept()
+    assert node.online
+    assert backup.message_types()[0] == 'NBIRTH'
+    assert node.failover_stats.connect_failures == 1
+    assert node.failover_stats.last_transition['to'] == 'backup'
+
+
+def test_backoff_grows_with_failures_and_resets_once_online(clock, clients):
+    node = make_node()
+    delays = []
+    for _ in range(4):
+        node._maintain_connection()  # connect
+        clock.now += 1000
+        delays.append(node._maintain_connection() - clock.now)  # timed out
+        clock.now += delays[-1]
+    assert delays == [500, 1000, 2000, 4000]
+
+    node._maintain_connection()
+    clients[-1].accept()
+    node._maintain_connection()  # online
+    clients[-1].drop()
+    assert not node.online
+    node._maintain_connection()  # reconnect at once
+    clock.now += 1000
+    assert node._maintain_connection() - clock.now == 500
+
+
+def test_falls_back_to_the_primary_through_a_standby_connection(clock, clients):
+    node = make_node()
+    node._maintain_connection()
+    clock.now = 1000
+    node._maintain_connection()
+    clock.now = 1500
+    node._maintain_connection()
+    backup = clients[-1]
+    backup.accept()
+    birth_bdseq = bdseq(backup.published[0][1])
+
+    assert node._maintain_connection() == 2500  # standby connection to the primary broker
+    standby = clients[-1]
+    assert standby.running and standby.broker.name == 'primary'
+    assert node.online and node.current_broker.name == 'backup'
+    assert bdseq(standby.will[1]) == birth_bdseq + 1  # the will of the session it will carry
+
+    standby.accept()
+    node._maintain_connection()
+    assert node.current_broker.name == 'primary' and node.online
+    assert backup.message_types()[-1] == 'NDEATH'  # the old session is closed, its will is not sent on a clean disconnect
+    assert bdseq(backup.published[-1][1]) == birth_bdseq
+    assert not backup.running and not backup.connected
+    assert standby.message_types() == ['NBIRTH']
+    assert bdseq(standby.published[0][1]) == birth_bdseq + 1
+    assert node.failover_stats.standby_promotions == 1
+    assert node.failover_stats.fallbacks == 1
+
+
+def test_unreachable_standby_is_retried_at_the_primary_check_rate(clock, clients):
+    node = make_node()
+    node._maintain_connection()
+    clock.now = 1000
+    node._maintain_connection()
+    clock.now = 1500
+    node._maintain_connection()
+    clients[-1].accept()
+    node._maintain_connection()
+    standby = clients[-1]
+
+    clock.now = 2500
+    assert node._maintain_connection() == 7500
+    assert not standby.running
+    clock.now = 7500
+    node._maintain_connection()
+    assert clients[-1] is not standby and clients[-1].running
+
+
+def test_connection_is_kept_while_the_nbirth_is_published(clock, clients):
+    node = make_node()
+    node._maintain_connection()
+    client = clients[-1]
+    deadlines = []
+    publish = client.publish
+
+    def publish_nbirth(topic, payload=None, qos=0, retain=False):
+        deadlines.append(node._maintain_connection())  # the loop runs while the network thread publishes the NBIRTH
+        return publish(topic, payload, qos, retain)
+
+    client.publish = publish_nbirth
+    client.accept()
+    assert deadlines[0] == 1000
+    assert clients[-1] is client and client.running and node.online
+
+
+def test_publishes_in_flight_on_a_retired_client_are_forgotten(clock, clients):
+    node = make_node(read=lambda prev_value: (prev_value or 0) + 1)
+    node._maintain_connection()
+    clock.now = 1000
+    node._maintain_connection()
+    clock.now = 1500
+    node._maintain_connection()
+    clients[-1].accept()
+    node._rbe()
+    assert node.publish_stats.inflight == 2  # NBIRTH and NDATA, the fake client never completes them
+    node._maintain_connection()
+    clients[-1].accept()
+    node._maintain_connection()  # fallback to the primary broker
+    assert node.publish_stats.inflight == 1  # its NBIRTH
+    assert node.publish_stats.dropped == 2
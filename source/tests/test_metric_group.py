@@ -0,0 +1,145 @@
+'''
+MetricGroup: one read_function call per scan for all the members, bulk writes of one NCMD in one write_function call
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.metric_group import MetricGroup
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import asyncio
+import pytest
+
+
+class Block:
+    '''Registers of a PLC block, read and written in bulk'''
+    def __init__(self, size: int = 4) -> None:
+        self.registers = list(range(size))
+        self.reads = 0
+        self.writes = []
+        self.fail_keys = set()
+
+    def read(self):
+        self.reads += 1
+        return list(self.registers)
+
+    def write(self, values: dict):
+        self.writes.append(dict(values))
+        for key, value in values.items():
+            if key not in self.fail_keys:
+                self.registers[key] = value
+        return {key: key not in self.fail_keys for key in values}
+
+
+def make_group(block: Block) -> MetricGroup:
+    group = MetricGroup('plc', block.read, block.write)
+    for idx in range(len(block.registers)):
+        group.add_metric(f'plc/r{idx}', SparkplugDataTypes.Int32, key=idx, writable=True)
+    return group
+
+
+def test_one_read_feeds_every_member():
+    block = Block()
+    group = make_group(block)
+    missing = group.add_metric('plc/missing', SparkplugDataTypes.Int32, key=99)
+    assert group.read()
+    assert block.reads == 1
+    assert [metric.current_value for metric in group.metrics[:4]] == [0, 1, 2, 3]
+    assert len({metric.read_millis for metric in group.metrics[:4]}) == 1
+    assert not group.member_ok(missing) and group.member_ok(group.metrics[0])
+
+
+def test_failed_read_fails_every_member():
+    def read():
+        raise ConnectionError('PLC unreachable')
+
+    group = MetricGroup('plc', read)
+    metrics = [group.add_metric(f'm{idx}', SparkplugDataTypes.Int32, key=idx) for idx in range(3)]
+    assert not group.read()
+    assert not group.last_read_ok
+    assert not any(metric.read() for metric in metrics)
+
+
+def test_writes_go_in_one_call():
+    block = Block()
+    group = make_group(block)
+    block.fail_keys = {3}
+    r0, r1, _, r3 = group.metrics
+    assert group.write([(r0, 10), (r1, 11), (r3, 13), (r0, 100)]) == [True, True, False, True]
+    assert block.writes == [{0: 100, 1: 11, 3: 13}]  # a later write to the same member wins
+    assert block.registers[:2] == [100, 11]
+
+
+def test_writes_that_cannot_be_made_are_failed_without_a_call():
+    block = Block()
+    group = make_group(block)
+    read_only = group.add_metric('plc/status', SparkplugDataTypes.Int32, key=0)
+    assert group.write([(read_only, 1), (group.metrics[0], 'not a number')]) == [False, False]
+    assert block.writes == []
+    with pytest.raises(ValueError):
+        MetricGroup('no writes', block.read).add_metric('x', SparkplugDataTypes.Int32, writable=True)
+
+
+def test_async_group():
+    block = Block()
+
+    async def read():
+        await asyncio.sleep(0)
+        return block.read()
+
+    async def write(values):
+        await asyncio.sleep(0)
+        return block.write(values)
+
+    group = MetricGroup('plc', read, write)
+    metrics = [group.add_metric(f'r{idx}', SparkplugDataTypes.Int32, key=idx, writable=True) for idx in range(4)]
+    assert group.is_async
+
+    async def scenario():
+        assert await group.async_read()
+        return await group.async_write([(metrics[1], 5), (metrics[2], 6)])
+
+    assert asyncio.run(scenario()) == [True, True]
+    assert block.reads == 1 and block.writes == [{1: 5, 2: 6}]
+    assert not metrics[0].read()  # async groups need async_read()
+
+
+def make_node(metrics: list, read_workers=None) -> SparkplugEdgeNode:
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    return SparkplugEdgeNode('group', 'node', brokers, metrics=metrics, read_workers=read_workers)
+
+
+@pytest.mark.parametrize('read_workers', [None, 2])
+def test_node_scan_reads_the_group_once(read_workers):
+    block = Block()
+    group = make_group(block)
+    solo = SparkplugMetric('solo', SparkplugDataTypes.Int32, lambda prev_value: 5)
+    node = make_node(group.metrics + [solo], read_workers=read_workers)
+    node.read_metrics(rbe=False)
+    assert block.reads == 1
+    block.registers[2] = 22
+    assert node.read_metrics() == [group.metrics[2]]
+    assert block.reads == 2
+
+
+def test_ncmd_writes_to_members_are_one_group_write():
+    block = Block()
+    group = make_group(block)
+    solo_writes = []
+    solo = SparkplugMetric('solo', SparkplugDataTypes.Int32, lambda prev_value: 5, write_function=lambda value: solo_writes.append(value) or True)
+    node = make_node(group.metrics + [solo])
+    results = []
+    node._finish_ncmd = lambda client, command_results, **kwargs: results.extend(command_results)
+
+    payload = sparkplug_pb2.Payload()
+    for name, value in [('plc/r1', 11), ('solo', 1), ('plc/r2', 22), ('plc/r1', 111)]:
+        metric = payload.metrics.add()
+        metric.name = name
+        metric.int_value = value
+    node._process_ncmd(None, payload)
+    assert block.writes == [{1: 111, 2: 22}]
+    assert solo_writes == [1]
+    assert sorted((metric.name, value, success) for metric, value, success in results) == [
+        ('plc/r1', 11, True), ('plc/r1', 111, True), ('plc/r2', 22, True), ('solo', 1, True)
+    ]
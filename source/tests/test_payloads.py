@@ -0,0 +1,109 @@
+'''
+split_payload chunk sizes, and consecutive seq across the chunks an edge node publishes
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.payloads import split_payload, varint_size
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import types
+
+
+def make_payload(count: int, name_size: int = 20) -> sparkplug_pb2.Payload:
+    payload = sparkplug_pb2.Payload(timestamp=1_700_000_000_000, seq=255)
+    for idx in range(count):
+        metric = payload.metrics.add()
+        metric.name = f'{idx:0{name_size}d}'
+        metric.datatype = SparkplugDataTypes.Int64.value
+        metric.long_value = idx * 1_000_003
+    return payload
+
+
+def test_varint_size():
+    assert [varint_size(value) for value in (0, 127, 128, 16383, 16384, 2 ** 32)] == [1, 1, 2, 2, 3, 5]
+
+
+def test_small_payload_is_not_split():
+    payload = make_payload(5)
+    assert split_payload(payload, payload.ByteSize()) == [payload]
+
+
+def test_chunks_fit_and_keep_the_metrics_in_order():
+    payload = make_payload(500)
+    for max_size in (100, 257, 1000, 4096):
+        chunks = split_payload(payload, max_size)
+        assert len(chunks) > 1
+        assert all(chunk.ByteSize() <= max_size for chunk in chunks)
+        assert [metric for chunk in chunks for metric in chunk.metrics] == list(payload.metrics)
+        assert all(chunk.timestamp == payload.timestamp and chunk.seq == payload.seq for chunk in chunks)
+
+
+def test_chunks_are_filled():
+    '''A chunk is only closed when the next metric does not fit in it'''
+    payload = make_payload(500)
+    chunks = split_payload(payload, 1000)
+    for chunk, next_chunk in zip(chunks, chunks[1:]):
+        next_metric_size = next_chunk.metrics[0].ByteSize()
+        assert chunk.ByteSize() + 1 + varint_size(next_metric_size) + next_metric_size > 1000
+
+
+def test_oversized_metric_goes_alone():
+    payload = make_payload(6)
+    payload.metrics[3].name = 'x' * 500
+    chunks = split_payload(payload, 200)
+    oversized = [chunk for chunk in chunks if chunk.ByteSize() > 200]
+    assert len(oversized) == 1 and list(oversized[0].metrics) == [payload.metrics[3]]
+    assert [metric for chunk in chunks for metric in chunk.metrics] == list(payload.metrics)
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def read(self, prev_value):
+        self.value += 1
+        return self.value
+
+
+def online_node(monkeypatch, metric_count: int, max_payload_size: int) -> tuple:
+    '''Edge node whose mqtt client records the published messages instead of sending them, after its NBIRTH'''
+    counter = Counter()
+    metrics = [SparkplugMetric(f'metric/{idx:05d}', SparkplugDataTypes.Int64, counter.read) for idx in range(metric_count)]
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics, max_payload_size=max_payload_size)
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    assert node.online
+    return node, published
+
+
+def decode(message: bytes) -> sparkplug_pb2.Payload:
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return payload
+
+
+def test_published_chunks_have_consecutive_seq(monkeypatch):
+    node, published = online_node(monkeypatch, metric_count=600, max_payload_size=1024)
+    scans = 25
+    for _ in range(scans):
+        node._rbe()  # every read changes every metric
+    data = [(topic, decode(message)) for topic, message in published if '/NDATA/' in topic]
+    assert len(data) > 256  # every scan was split, seq wraps
+    assert all(len(message) <= 1024 for topic, message in published if '/NDATA/' in topic)
+    seqs = [decode(message).seq for _, message in published]
+    assert seqs[0] == 0  # NBIRTH
+    assert seqs == [idx % 256 for idx in range(len(seqs))]
+    aliases = [metric.alias for _, payload in data for metric in payload.metrics]
+    assert len(aliases) == scans * 600
@@ -0,0 +1,212 @@
+'''
+PublishPipeline ordering, bounded queues and backpressure, and the edge node's handling of the jobs
+still queued when its connection goes away or an NBIRTH starts a new session
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.pipeline import PipelineConfig, PublishPipeline
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+from sparkplug_node_app.store_forward import StoreForwardConfig
+import threading
+import time
+import types
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+class Inflight:
+    '''In flight count the publish stage checks, set by the test'''
+    def __init__(self, value: int = 0) -> None:
+        self.value = value
+
+    def __call__(self) -> int:
+        return self.value
+
+
+def make_pipeline(published: list, encode=lambda job: job, inflight=None, **config) -> PublishPipeline:
+    return PublishPipeline(
+        PipelineConfig(backpressure_poll=1, **config),
+        encode=encode,
+        publish=published.append,
+        inflight=inflight or Inflight()
+    )
+
+
+def test_publishes_in_submit_order():
+    published = []
+    pipeline = make_pipeline(published, encode=lambda job: job * 10, encode_queue=2, publish_queue=2)
+    pipeline.start()
+    for job in range(200):
+        pipeline.submit(job)
+    pipeline.stop()
+    assert published == [job * 10 for job in range(200)]
+    assert pipeline.stats.encoded == pipeline.stats.published == 200
+    assert not pipeline.running
+
+
+def test_publishing_pauses_while_too_many_publishes_are_in_flight():
+    published = []
+    inflight = Inflight(5)
+    pipeline = make_pipeline(published, inflight=inflight, max_inflight=2)
+    pipeline.start()
+    pipeline.submit('a')
+    pipeline.submit('b')
+    wait_until(lambda: pipeline.stats.backpressure_pauses == 1)
+    time.sleep(0.02)
+    assert published == []
+    inflight.value = 2
+    wait_until(lambda: len(published) == 2)
+    assert published == ['a', 'b']
+    assert pipeline.stats.backpressure_pauses == 1
+    pipeline.stop()
+
+
+def test_full_queues_block_the_stage_feeding_them():
+    published = []
+    started, release = threading.Event(), threading.Event()
+
+    def encode(job):
+        started.set()
+        release.wait()
+        return job
+
+    pipeline = make_pipeline(published, encode=encode, encode_queue=1, publish_queue=1)
+    pipeline.start()
+    pipeline.submit(1)  # taken by the encode stage, which waits
+    assert started.wait(5)
+    pipeline.submit(2)  # fills the encode queue
+    submitter = threading.Thread(target=pipeline.submit, args=(3,))
+    submitter.start()
+    time.sleep(0.05)
+    assert submitter.is_alive()  # the scan blocks instead of piling up jobs
+    assert pipeline.stats.encode_waits == 1
+    release.set()
+    submitter.join(5)
+    pipeline.stop()
+    assert published == [1, 2, 3]
+
+
+def test_discard_takes_the_queued_jobs_out():
+    published = []
+    inflight = Inflight(1)
+    pipeline = make_pipeline(published, inflight=inflight, max_inflight=0)
+    pipeline.start()
+    for job in range(5):
+        pipeline.submit(job)
+    wait_until(lambda: pipeline.stats.backpressure_pauses == 1 and pipeline.stats.encoded == 5)
+    jobs, encoded = pipeline.discard()
+    assert jobs == [] and encoded == [1, 2, 3, 4]  # 0 is held by the publish stage
+    assert pipeline.stats.discarded == 4
+    inflight.value = 0
+    pipeline.stop()
+    assert published == [0]
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def read(self, prev_value):
+        self.value += 1
+        return self.value
+
+
+def online_node(monkeypatch, tmp_path, metric_count: int = 3) -> tuple:
+    '''
+    Edge node with a pipeline and store and forward, after its NBIRTH. Its mqtt client records the published messages
+    and never completes them, so the NBIRTH stays in flight and holds the publish stage (max_inflight 0)
+    '''
+    counter = Counter()
+    metrics = [SparkplugMetric(f'metric/{idx}', SparkplugDataTypes.Int64, counter.read) for idx in range(metric_count)]
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode(
+        'group', 'node', brokers, metrics=metrics,
+        store_forward=StoreForwardConfig(directory=str(tmp_path)),
+        pipeline=PipelineConfig(max_inflight=0, backpressure_poll=1)
+    )
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    assert node.online
+    node._pipeline.start()
+    return node, published
+
+
+def queue_scans(node: SparkplugEdgeNode, count: int):
+    for _ in range(count):
+        node._rbe()
+    wait_until(lambda: node.pipeline_stats.backpressure_pauses == 1 and node.pipeline_stats.encoded == count)
+
+
+def stored_payloads(node: SparkplugEdgeNode) -> list:
+    payloads = []
+    while True:
+        record = node.store_forward.peek()
+        if record is None:
+            return payloads
+        payload = sparkplug_pb2.Payload()
+        payload.ParseFromString(record[1])
+        payloads.append(payload)
+        node.store_forward.pop()
+
+
+def message_types(published: list) -> list:
+    return [topic.split('/')[2] for topic, _ in published]
+
+
+def test_jobs_queued_across_a_disconnect_are_stored_as_historical(monkeypatch, tmp_path):
+    node, published = online_node(monkeypatch, tmp_path)
+    queue_scans(node, 3)
+    node.client.on_disconnect(node.client, None, 1)  # forgets the publishes in flight, the publish stage resumes
+    node._pipeline.stop()
+    assert message_types(published) == ['NBIRTH']
+    stored = stored_payloads(node)
+    assert len(stored) == 3
+    assert all(metric.is_historical for payload in stored for metric in payload.metrics)
+    values = [metric.long_value for payload in stored for metric in payload.metrics]
+    assert values == sorted(values)
+
+
+def test_jobs_queued_before_an_nbirth_are_not_published_after_it(monkeypatch, tmp_path):
+    node, published = online_node(monkeypatch, tmp_path)
+    queue_scans(node, 3)
+    node.client.on_connect(node.client, None, {}, 0)  # reconnected: a new session
+    assert node.pipeline_stats.discarded == 2  # the first scan is held by the publish stage
+    node.publish_stats.clear()
+    node._pipeline.stop()
+    assert message_types(published) == ['NBIRTH', 'NBIRTH']
+    assert node.pipeline_stats.published == 1  # stored instead
+    stored = stored_payloads(node)
+    assert len(stored) == 3
+    assert all(metric.is_historical and payload.seq == 0 for payload in stored for metric in payload.metrics)
+
+
+def test_jobs_are_published_with_consecutive_seq_after_the_nbirth(monkeypatch, tmp_path):
+    node, published = online_node(monkeypatch, tmp_path)
+    queue_scans(node, 3)
+    wait_until(lambda: node.publish_stats.clear() or node.pipeline_stats.published == 3)  # every publish completes
+    node._pipeline.stop()
+    assert message_types(published) == ['NBIRTH', 'NDATA', 'NDATA', 'NDATA']
+    seqs = []
+    for _, message in published:
+        payload = sparkplug_pb2.Payload()
+        payload.ParseFromString(message)
+        seqs.append(payload.seq)
+    assert seqs == [0, 1, 2, 3]
+    assert stored_payloads(node) == []
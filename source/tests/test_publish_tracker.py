@@ -0,0 +1,116 @@
+'''
+PublishTracker: in flight publishes by mid and their latencies, and seq taken at encode time in publish order
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.publish_tracker import LatencyHistogram, PublishTracker
+from sparkplug_node_app.sparkplug import SparkplugDevice, SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import threading
+import time
+import types
+
+
+def test_completes_publishes_by_mid():
+    tracker = PublishTracker()
+    for mid in (1, 2, 3):
+        tracker.track(mid, 'NDATA', mid * 100)
+    message_type, size, latency = tracker.complete(2)
+    assert (message_type, size) == ('NDATA', 200) and latency >= 0
+    assert tracker.inflight == 2
+    assert tracker.complete(2) is None  # already completed
+    tracker.complete(1)
+    tracker.complete(3)
+    assert tracker.inflight == 0 and tracker.completed == 3
+    assert tracker.histograms['NDATA'].count == 3
+
+
+def test_completion_before_track_is_kept_for_its_mid():
+    tracker = PublishTracker()
+    enqueued = tracker.now()
+    assert tracker.complete(7) is None  # on_publish ran before client.publish() returned
+    tracker.track(7, 'NBIRTH', 10, enqueued=enqueued)
+    assert tracker.inflight == 0 and tracker.completed == 1
+
+
+def test_completion_older_than_the_publish_belongs_to_an_earlier_use_of_the_mid():
+    tracker = PublishTracker()
+    tracker.complete(7)
+    tracker.track(7, 'NDATA', 10, enqueued=tracker.now())
+    assert tracker.inflight == 1 and tracker.completed == 0
+    tracker.complete(7)
+    assert tracker.inflight == 0 and tracker.completed == 1
+
+
+def test_inflight_is_bounded():
+    tracker = PublishTracker(max_inflight=2)
+    for mid in (1, 2, 3):
+        tracker.track(mid, 'NDATA', 10)
+    assert tracker.inflight == 2 and tracker.dropped == 1
+    assert tracker.complete(1) is None  # the oldest was dropped
+    tracker.clear()
+    assert tracker.inflight == 0 and tracker.dropped == 3
+
+
+def test_latency_histogram_buckets():
+    histogram = LatencyHistogram()
+    for millis in (0.5, 1, 1.5, 3, 5000, 6000):
+        histogram.record(millis)
+    summary = histogram.as_dict()
+    assert summary['count'] == 6
+    assert summary['max_ms'] == 6000
+    assert summary['mean_ms'] == round((0.5 + 1 + 1.5 + 3 + 5000 + 6000) / 6, 3)
+    buckets = summary['buckets']
+    assert list(buckets) == [f'<={bound}ms' for bound in LatencyHistogram.BOUNDS] + ['>5000ms']
+    assert {key: count for key, count in buckets.items() if count} == {'<=1ms': 2, '<=2ms': 1, '<=5ms': 1, '<=5000ms': 1, '>5000ms': 1}
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def read(self, prev_value):
+        self.value += 1
+        return self.value
+
+
+def test_seq_follows_the_publish_order_of_concurrent_publishers(monkeypatch):
+    '''Scans on one thread, DBIRTH / DDEATH on another: every message takes its seq when it is encoded and published'''
+    counter = Counter()
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=[SparkplugMetric('m', SparkplugDataTypes.Int64, counter.read)])
+    device = SparkplugDevice(node, 'device')
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        time.sleep(0)  # let the other thread in
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+
+    def toggle_device():
+        for _ in range(150):
+            device.death()
+            device.birth()
+
+    thread = threading.Thread(target=toggle_device)
+    thread.start()
+    for _ in range(300):
+        node._rbe()
+    thread.join()
+
+    seqs = []
+    for _, message in published:
+        payload = sparkplug_pb2.Payload()
+        payload.ParseFromString(message)
+        seqs.append(payload.seq)
+    assert len(seqs) > 600
+    assert seqs == [idx % 256 for idx in range(len(seqs))]
+    assert node.publish_stats.inflight == len(published)  # the fake client never completes them
@@ -0,0 +1,119 @@
+'''
+RbePolicy: deadbands, min_interval and max_silence, applied per metric and by MetricTable.collect()
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app.metric_table import MetricTable
+from sparkplug_node_app.rbe import RbePolicy
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import pytest
+
+
+class Source:
+    '''Value the read_function of a test metric returns'''
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def read(self, prev_value):
+        return self.value
+
+
+def policy_metric(source: Source, policy: RbePolicy, datatype: SparkplugDataTypes = SparkplugDataTypes.Double) -> SparkplugMetric:
+    metric = SparkplugMetric('m', datatype, source.read, rbe_policy=policy)
+    metric.read()
+    metric.mark_published(0)
+    return metric
+
+
+def update(metric: SparkplugMetric, source: Source, value, now: int) -> bool:
+    source.value = value
+    metric.read()
+    return metric.rbe_due(now)
+
+
+def test_negative_settings_are_rejected():
+    for name in ['deadband', 'deadband_percent', 'min_interval', 'max_silence']:
+        with pytest.raises(ValueError):
+            RbePolicy(**{name: -1})
+
+
+def test_deadband_compares_against_the_last_published_value():
+    source = Source(10.0)
+    metric = policy_metric(source, RbePolicy(deadband=0.5))
+    assert not update(metric, source, 10.4, 10)
+    assert not update(metric, source, 10.5, 20)
+    assert update(metric, source, 10.6, 30)  # drifted past the deadband in small steps
+    metric.mark_published(30)
+    assert not update(metric, source, 10.2, 40)
+    assert update(metric, source, 10.0, 50)
+
+
+def test_deadband_percent():
+    source = Source(200)
+    metric = policy_metric(source, RbePolicy(deadband_percent=5), SparkplugDataTypes.Int32)
+    assert not update(metric, source, 210, 10)
+    assert update(metric, source, 189, 20)
+    metric.mark_published(20)
+    assert not update(metric, source, 180, 30)  # 5% of 189
+
+
+def test_min_interval_holds_back_changes():
+    source = Source(1.0)
+    metric = policy_metric(source, RbePolicy(min_interval=1000))
+    assert not update(metric, source, 2.0, 500)
+    assert update(metric, source, 2.0, 1000)
+
+
+def test_max_silence_publishes_an_unchanged_value():
+    source = Source(1.0)
+    metric = policy_metric(source, RbePolicy(max_silence=1000, deadband=5))
+    assert not update(metric, source, 1.0, 999)
+    assert update(metric, source, 1.0, 1000)
+    assert update(metric, source, 2.0, 1001)  # within the deadband, but silent for too long
+
+
+def test_time_based():
+    assert not RbePolicy(deadband=1).time_based
+    assert RbePolicy(min_interval=1).time_based
+    assert RbePolicy(max_silence=1).time_based
+
+
+def test_properties_advertise_the_policy():
+    properties = RbePolicy(deadband=1, min_interval=100).properties
+    assert properties == [
+        {'key': 'deadband', 'type': 10, 'value': 1.0},
+        {'key': 'minInterval', 'type': 8, 'value': 100}
+    ]
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_table_collect_applies_policies_and_counts_suppressed(use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    table = MetricTable(use_numpy=use_numpy)
+    sources = [Source(0.0) for _ in range(3)]
+    metrics = [
+        SparkplugMetric('plain', SparkplugDataTypes.Double, sources[0].read),
+        SparkplugMetric('deadband', SparkplugDataTypes.Double, sources[1].read, rbe_policy=RbePolicy(deadband=1)),
+        SparkplugMetric('silence', SparkplugDataTypes.Double, sources[2].read, rbe_policy=RbePolicy(max_silence=100))
+    ]
+    for metric in metrics:
+        metric.bind_table(table)
+        metric.read()
+    table.collect(0)
+    for metric in metrics:
+        metric.mark_published(0)
+
+    for source in sources:
+        source.value = 0.5
+    for metric in metrics:
+        metric.read()
+    due, suppressed = table.collect(50)
+    assert sorted(metric.name for metric in due) == ['plain', 'silence']
+    assert suppressed == 1
+
+    for metric in metrics:
+        metric.read()
+    due, suppressed = table.collect(200)
+    assert [metric.name for metric in due] == ['silence']
+    assert suppressed == 0  # held back, but not changed since the last read
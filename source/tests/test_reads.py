@@ -0,0 +1,86 @@
+'''
+Concurrent reads (read_workers): slow data sources do not hold up a scan, reads that miss read_timeout report
+their metrics stale until a read succeeds again
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import MetricQuality, SparkplugDataTypes, SparkplugMetric
+import threading
+import time
+
+
+class GatedSource:
+    '''Value of a metric whose reads block while the gate is closed'''
+    def __init__(self, value) -> None:
+        self.value = value
+        self.gate = threading.Event()
+        self.gate.set()
+        self.reads = 0
+
+    def read(self, prev_value):
+        self.gate.wait(5)
+        self.reads += 1
+        return self.value
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def make_node(metrics: list) -> SparkplugEdgeNode:
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics, read_workers=4, read_timeout=50)
+    node.read_metrics(rbe=False)
+    return node
+
+
+def test_slow_read_is_reported_stale_without_holding_up_the_scan():
+    slow, fast = GatedSource(1), GatedSource(1)
+    slow_metric = SparkplugMetric('slow', SparkplugDataTypes.Int32, slow.read)
+    fast_metric = SparkplugMetric('fast', SparkplugDataTypes.Int32, fast.read)
+    node = make_node([slow_metric, fast_metric])
+
+    slow.gate.clear()
+    fast.value = 2
+    started = time.monotonic()
+    assert sorted(metric.name for metric in node.read_metrics()) == ['fast', 'slow']
+    assert time.monotonic() - started < 1
+    assert slow_metric.stale and slow_metric.quality == MetricQuality.STALE
+    assert not fast_metric.stale and fast_metric.current_value == 2
+    assert any(prop == 'Quality' for prop in slow_metric.as_rbe_metric()['properties']['keys'])
+
+    assert node.read_metrics() == []  # the previous read is still running: skipped, already reported stale
+    assert slow.reads == 1
+
+    slow.gate.set()
+    wait_until(lambda: slow.reads == 2)
+    assert node.read_metrics() == [slow_metric]  # good again, with its Quality
+    assert not slow_metric.stale
+
+
+def test_late_value_of_a_timed_out_read_is_not_reported_while_stale():
+    source = GatedSource(1)
+    metric = SparkplugMetric('slow', SparkplugDataTypes.Int32, source.read)
+    node = make_node([metric])
+
+    source.gate.clear()
+    source.value = 2
+    assert node.read_metrics() == [metric]
+    assert metric.stale
+    source.gate.set()
+    wait_until(lambda: metric.current_value == 2)  # the timed out read finished late
+
+    source.gate.clear()
+    source.value = 3
+    assert node.read_metrics() == []  # timed out again: still stale, the late value is not published as stale data
+    assert metric.stale
+
+    source.gate.set()
+    wait_until(lambda: metric.current_value == 3)
+    assert node.read_metrics() == [metric]
+    assert not metric.stale and metric.current_value == 3
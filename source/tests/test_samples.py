@@ -0,0 +1,130 @@
+'''
+SampleBuffer ring buffer (wraparound, drain order), SampleSchedule, and the samples a metric buffered between scans
+published oldest first ahead of its scan value
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import helpers, mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.samples import SampleBuffer, SampleSchedule
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+import pytest
+import types
+
+
+def test_full_buffer_drops_the_oldest_samples():
+    buffer = SampleBuffer(3)
+    for millis, value in enumerate([1, 2, 3, 4, 5]):
+        assert buffer.append(value, millis)
+    assert len(buffer) == 3 and buffer.dropped == 2
+    assert buffer.drain() == [(2, 3), (3, 4), (4, 5)]  # oldest first
+    assert len(buffer) == 0 and buffer.drain() == []
+
+    for millis, value in enumerate([6, 7], start=5):  # keeps wrapping around after a drain
+        buffer.append(value, millis)
+    assert buffer.drain() == [(5, 6), (6, 7)]
+
+
+def test_drain_before_leaves_the_newer_samples():
+    buffer = SampleBuffer(4)
+    for millis, value in [(10, 'a'), (20, 'b'), (30, 'c')]:
+        buffer.append(value, millis)
+    assert buffer.pending(before=20) and not buffer.pending(before=10)
+    assert buffer.drain(before=25) == [(10, 'a'), (20, 'b')]
+    assert buffer.drain(before=25) == []
+    assert buffer.drain(before=31) == [(30, 'c')]
+
+
+def test_repeated_value_is_not_a_sample():
+    buffer = SampleBuffer(4)
+    assert not buffer.append(1, 0, current=1)  # the metric already holds 1
+    assert buffer.append(2, 1, current=1)
+    assert not buffer.append(2, 2, current=1)
+    buffer.drain()
+    assert not buffer.append(2, 3)  # compared with the last sample, drained or not
+    assert buffer.append(1, 4)
+
+
+def test_buffer_size_is_validated():
+    with pytest.raises(ValueError):
+        SampleBuffer(0)
+
+
+def test_schedule_follows_a_fixed_grid(monkeypatch):
+    monkeypatch.setattr(helpers, 'monotonic_millis', lambda: 0)
+    fast = SparkplugMetric('fast', SparkplugDataTypes.Int32, lambda prev_value: 0, history_size=4, sample_rate=10)
+    slow = SparkplugMetric('slow', SparkplugDataTypes.Int32, lambda prev_value: 0, history_size=4, sample_rate=25)
+    schedule = SampleSchedule()
+    schedule.add(fast)
+    schedule.add(slow)
+    assert schedule.take_due(now=0) == [fast, slow]
+    assert schedule.next_deadline == 10
+    assert schedule.take_due(now=13) == [fast]  # next fast sample at 20, not 23
+    assert schedule.take_due(now=19) == []
+    assert schedule.take_due(now=25) == [fast, slow]
+    assert schedule.take_due(now=100) == [fast, slow]  # too late: the grid restarts from now
+    assert schedule.take_due(now=105) == []
+
+
+def online_node(monkeypatch, metrics: list) -> list:
+    '''Edge node whose mqtt client records the published messages, after its NBIRTH'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=metrics)
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    return node, published
+
+
+def ndata_entries(message: bytes, since: int) -> list:
+    '''(value, timestamp - since) of the NDATA entries'''
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return [(metric.int_value, metric.timestamp - since) for metric in payload.metrics]
+
+
+def test_samples_are_published_oldest_first_before_the_scan_value(monkeypatch):
+    source = {'value': 0}
+    metric = SparkplugMetric('m', SparkplugDataTypes.Int32, lambda prev_value: source['value'], history_size=3)
+    node, published = online_node(monkeypatch, [metric])
+
+    start = helpers.millis() - 100
+    for offset, value in enumerate([1, 2, 3, 4, 5]):
+        assert metric.record_sample(value, start + offset)
+    source['value'] = 6
+    node._rbe()
+    entries = ndata_entries(published[-1][1], start)
+    assert entries[:3] == [(3, 2), (4, 3), (5, 4)]  # 1 and 2 were dropped by the full buffer
+    assert entries[3][0] == 6 and entries[3][1] >= 100
+    assert metric.sample_buffer.dropped == 2
+
+
+def test_sampled_value_is_not_published_twice(monkeypatch):
+    source = {'value': 0}
+    metric = SparkplugMetric('m', SparkplugDataTypes.Int32, lambda prev_value: source['value'], history_size=4)
+    node, published = online_node(monkeypatch, [metric])
+
+    start = helpers.millis() - 100
+    metric.record_sample(1, start)
+    metric.record_sample(2, start + 1)
+    source['value'] = 2
+    node._rbe()
+    assert ndata_entries(published[-1][1], start) == [(1, 0), (2, 1)]  # the last sample is the scan value
+
+    metric.record_sample(7, start + 2)
+    metric.record_sample(2, start + 3)
+    node._rbe()  # the scan value did not change, the samples are published on their own
+    assert ndata_entries(published[-1][1], start) == [(7, 2), (2, 3)]
+
+    metric.record_sample(5, helpers.millis() + 60_000)  # taken after the scan read the metric: waits for a later scan
+    node._rbe()
+    assert len(published) == 3
@@ -0,0 +1,81 @@
+'''
+DeadlineScheduler: sleeping until the earliest deadline, wakeups from other threads and lateness stats
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import helpers
+from sparkplug_node_app.scheduler import DeadlineScheduler
+import threading
+import time
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0
+
+    def __call__(self) -> int:
+        return self.now
+
+
+def test_due_deadlines_are_consumed_only_when_due(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(helpers, 'monotonic_millis', clock)
+    scheduler = DeadlineScheduler()
+    scheduler.set_deadline('scan', 100)
+    scheduler.set_deadline('replay', 50)
+    scheduler.set_deadline('save', 300)
+    assert scheduler.next_deadline == 50
+
+    assert scheduler.wait(timeout=0) == []
+    clock.now = 120
+    assert sorted(scheduler.wait(timeout=0)) == ['replay', 'scan']
+    assert scheduler.wait(timeout=0) == []  # consumed, until set again
+    assert scheduler.next_deadline == 300
+
+    scheduler.set_deadline('save', None)
+    assert scheduler.next_deadline is None
+    stats = scheduler.stats
+    assert (stats['scan'].last, stats['replay'].last, stats['replay'].count) == (20, 70, 1)
+
+
+def test_wait_returns_at_the_earliest_deadline():
+    scheduler = DeadlineScheduler()
+    now = helpers.monotonic_millis()
+    scheduler.set_deadline('late', now + 500)
+    scheduler.set_deadline('early', now + 30)
+    started = time.monotonic()
+    assert scheduler.wait() == ['early']
+    assert 0.02 <= time.monotonic() - started < 0.4
+    assert scheduler.next_deadline == now + 500
+
+
+def test_wait_gives_up_after_timeout():
+    scheduler = DeadlineScheduler()
+    scheduler.set_deadline('later', helpers.monotonic_millis() + 10_000)
+    started = time.monotonic()
+    assert scheduler.wait(timeout=20) == []
+    assert time.monotonic() - started < 1
+
+
+def test_earlier_deadline_set_from_another_thread_wakes_the_waiter():
+    scheduler = DeadlineScheduler()
+    scheduler.set_deadline('scan', helpers.monotonic_millis() + 10_000)
+    timer = threading.Timer(0.02, lambda: scheduler.set_deadline('batch', helpers.monotonic_millis()))
+    timer.start()
+    started = time.monotonic()
+    assert scheduler.wait() == ['batch']
+    assert time.monotonic() - started < 1
+    timer.join()
+
+
+def test_wake_interrupts_the_wait():
+    scheduler = DeadlineScheduler()
+    timer = threading.Timer(0.02, scheduler.wake)
+    timer.start()
+    started = time.monotonic()
+    assert scheduler.wait() == []  # nothing due, the caller services its pending work
+    assert time.monotonic() - started < 1
+    timer.join()
+
+    scheduler.wake()  # a wake before the wait is not lost
+    assert scheduler.wait(timeout=10_000) == []
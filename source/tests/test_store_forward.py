@@ -0,0 +1,179 @@
+'''
+SegmentLog replay order, segment rotation, eviction and restart recovery, and the edge node's replay of stored messages
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMetric
+from sparkplug_node_app.store_forward import EvictionPolicy, SegmentLog, StoreForwardConfig
+import os
+import types
+
+
+def make_log(directory, max_bytes: int = 4096, segment_bytes: int = 256, **config) -> SegmentLog:
+    return SegmentLog(StoreForwardConfig(directory=str(directory), max_bytes=max_bytes, segment_bytes=segment_bytes, **config))
+
+
+def drain(log: SegmentLog) -> list:
+    records = []
+    while True:
+        record = log.peek()
+        if record is None:
+            return records
+        records.append(record)
+        log.pop()
+
+
+def segment_files(directory) -> list:
+    return sorted(filename for filename in os.listdir(directory) if filename.endswith(SegmentLog.SEGMENT_SUFFIX))
+
+
+def test_replays_in_order_across_segments(tmp_path):
+    log = make_log(tmp_path)
+    records = [('spBv1.0/g/NDATA/n', f'payload {idx}'.encode() * 4) for idx in range(40)]
+    for topic, payload in records:
+        assert log.append(topic, payload)
+    assert len(segment_files(tmp_path)) > 1
+    assert drain(log) == records
+    assert log.empty
+    assert segment_files(tmp_path) == []
+    assert log.stats['replayed'] == len(records)
+
+
+def test_peek_without_pop_replays_the_same_record(tmp_path):
+    log = make_log(tmp_path)
+    log.append('a', b'1')
+    log.append('b', b'2')
+    assert log.peek() == ('a', b'1')
+    assert log.peek() == ('a', b'1')
+    log.pop()
+    assert log.peek() == ('b', b'2')
+
+
+def test_restart_resumes_after_the_last_popped_record(tmp_path):
+    log = make_log(tmp_path, segment_bytes=4096)
+    for idx in range(10):
+        log.append('t', bytes([idx]) * 8)
+    for _ in range(4):
+        log.peek()
+        log.pop()
+    pending_bytes = log.pending_bytes
+    log.close()
+
+    log = make_log(tmp_path, segment_bytes=4096)
+    assert log.pending_bytes == pending_bytes
+    assert [payload[0] for _, payload in drain(log)] == list(range(4, 10))
+
+
+def test_restart_appends_to_a_new_segment(tmp_path):
+    log = make_log(tmp_path, segment_bytes=4096)
+    log.append('t', b'old')
+    log.close()
+
+    log = make_log(tmp_path, segment_bytes=4096)
+    log.append('t', b'new')
+    assert len(segment_files(tmp_path)) == 2
+    assert [payload for _, payload in drain(log)] == [b'old', b'new']
+
+
+def test_cursor_of_a_deleted_segment_is_ignored(tmp_path):
+    log = make_log(tmp_path, segment_bytes=64)
+    for idx in range(6):
+        log.append('t', bytes([idx]) * 20)
+    log.peek()
+    log.pop()
+    log.close()
+    first_segment = segment_files(tmp_path)[0]
+    os.remove(os.path.join(tmp_path, first_segment))  # e.g. removed by hand while the node was stopped
+
+    log = make_log(tmp_path, segment_bytes=64)
+    replayed = [payload[0] for _, payload in drain(log)]
+    assert replayed == sorted(replayed) and replayed[0] > 0
+    assert not os.path.exists(os.path.join(tmp_path, SegmentLog.CURSOR_FILENAME))
+
+
+def test_torn_record_is_discarded(tmp_path):
+    log = make_log(tmp_path, segment_bytes=4096)
+    log.append('t', b'complete')
+    log.append('t', b'torn record')
+    log.close()
+    segment_path = os.path.join(tmp_path, segment_files(tmp_path)[0])
+    with open(segment_path, 'r+b') as file:
+        file.truncate(os.path.getsize(segment_path) - 3)
+
+    log = make_log(tmp_path, segment_bytes=4096)
+    assert drain(log) == [('t', b'complete')]
+
+
+def test_drop_oldest_evicts_whole_segments(tmp_path):
+    log = make_log(tmp_path, max_bytes=512, segment_bytes=128)
+    for idx in range(40):
+        assert log.append('t', bytes([idx]) * 20)
+    replayed = [payload[0] for _, payload in drain(log)]
+    assert replayed[-1] == 39
+    assert replayed == list(range(replayed[0], 40))
+    assert log.stats['dropped_bytes'] > 0
+    assert log.stats['dropped'] == replayed[0]  # every evicted record is counted
+
+
+def test_drop_newest_rejects_when_full(tmp_path):
+    log = make_log(tmp_path, max_bytes=256, segment_bytes=128, eviction=EvictionPolicy.DROP_NEWEST)
+    results = [log.append('t', bytes([idx]) * 20) for idx in range(20)]
+    assert not all(results)
+    assert results[0]
+    kept = [payload[0] for _, payload in drain(log)]
+    assert kept == list(range(len(kept)))
+    assert log.stats['dropped'] == results.count(False)
+
+
+def test_drop_oldest_counts_the_unread_records_of_a_partly_replayed_segment(tmp_path):
+    log = make_log(tmp_path, max_bytes=256, segment_bytes=128)
+    for idx in range(4):
+        log.append('t', bytes([idx]) * 20)  # 27 bytes each, 4 records in the first segment
+    log.peek()
+    log.pop()
+    for idx in range(4, 10):
+        log.append('t', bytes([idx]) * 20)
+    assert log.stats['dropped'] == 3
+
+
+def test_failed_replay_keeps_the_record_and_its_seq(monkeypatch, tmp_path):
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode(
+        'group', 'node', brokers,
+        metrics=[SparkplugMetric('m', SparkplugDataTypes.Int32, lambda prev_value: (prev_value or 0) + 1)],
+        store_forward=StoreForwardConfig(directory=str(tmp_path))
+    )
+    stored = sparkplug_pb2.Payload(timestamp=1, seq=0)
+    node.store_forward.append(node.topics.NDATA, stored.SerializeToString())
+    published = []
+    rcs = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        rc = rcs.pop(0) if rcs else mqtt_functions.mqtt.MQTT_ERR_SUCCESS
+        if rc == mqtt_functions.mqtt.MQTT_ERR_SUCCESS:
+            published.append((topic, payload))
+        return types.SimpleNamespace(rc=rc, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    node._replay_stored()  # offline: nothing is published
+    client.on_connect(client, None, {}, 0)
+
+    rcs.append(mqtt_functions.mqtt.MQTT_ERR_QUEUE_SIZE)
+    node._replay_stored()
+    assert not node.store_forward.empty
+    node._replay_stored()
+    assert node.store_forward.empty
+    node._rbe()
+    seqs = []
+    for _, message in published:
+        payload = sparkplug_pb2.Payload()
+        payload.ParseFromString(message)
+        seqs.append(payload.seq)
+    assert [topic.split('/')[2] for topic, _ in published] == ['NBIRTH', 'NDATA', 'NDATA']
+    assert seqs == [0, 1, 2]
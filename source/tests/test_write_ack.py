@@ -0,0 +1,127 @@
+'''
+Failed NCMD / DCMD writes acknowledged with one NDATA / DDATA of the current values flagged writeResult False,
+or with a rebirth when rebirth_on_write_failure is set
+
+run from the source directory: python -m pytest -q
+'''
+from sparkplug_node_app import mqtt_functions
+from sparkplug_node_app.protobuf_files import sparkplug_pb2
+from sparkplug_node_app.sparkplug import SparkplugDevice, SparkplugEdgeNode
+from sparkplug_node_app.sparkplug_tags import SparkplugDataTypes, SparkplugMemoryTag
+import types
+
+
+def limited_tags(prefix: str = '') -> list:
+    '''Writable tags that refuse values over 100'''
+    return [
+        SparkplugMemoryTag(
+            name=f'{prefix}{name}', datatype=SparkplugDataTypes.Int32, initial_value=1, writable=True,
+            write_validator=lambda current_value, new_value: new_value <= 100
+        )
+        for name in ('a', 'b', 'c')
+    ]
+
+
+def online_node(monkeypatch, devices: bool = False, **kwargs) -> tuple:
+    '''Edge node (with device d1 if devices) whose mqtt client records the published messages, after its NBIRTH'''
+    brokers = [mqtt_functions.BrokerInfo(client_id='test', host='127.0.0.1', port=1883, use_tls=False, primary=True)]
+    node = SparkplugEdgeNode('group', 'node', brokers, metrics=limited_tags(), **kwargs)
+    if devices:
+        SparkplugDevice(node, 'd1', metrics=limited_tags())
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt_functions.mqtt.MQTT_ERR_SUCCESS, mid=len(published))
+
+    client = node.client
+    monkeypatch.setattr(client, 'publish', publish)
+    monkeypatch.setattr(client, 'subscribe', lambda *args, **kwargs: (mqtt_functions.mqtt.MQTT_ERR_SUCCESS, 0))
+    monkeypatch.setattr(client, 'is_connected', lambda: True)
+    client.on_connect(client, None, {}, 0)
+    del published[:]
+    return node, published
+
+
+def send_command(node: SparkplugEdgeNode, writes: list, device_id: str = None):
+    '''NCMD (DCMD to device_id) of the (name, value) writes, delivered through the client's topic subscriptions'''
+    payload = sparkplug_pb2.Payload()
+    for name, value in writes:
+        metric = payload.metrics.add()
+        metric.name = name
+        if isinstance(value, bool):
+            metric.boolean_value = value
+        else:
+            metric.int_value = value
+    topic = 'spBv1.0/group/NCMD/node' if device_id is None else f'spBv1.0/group/DCMD/node/{device_id}'
+    message = mqtt_functions.mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = payload.SerializeToString()
+    node.client._handle_on_message(message)
+
+
+def decode(message: bytes) -> sparkplug_pb2.Payload:
+    payload = sparkplug_pb2.Payload()
+    payload.ParseFromString(message)
+    return payload
+
+
+def write_results(payload: sparkplug_pb2.Payload) -> list:
+    '''(alias, value, writeResult or None) of the metrics of payload'''
+    results = []
+    for metric in payload.metrics:
+        keys = list(metric.properties.keys)
+        result = metric.properties.values[keys.index('writeResult')].boolean_value if 'writeResult' in keys else None
+        results.append((metric.alias, metric.int_value, result))
+    return results
+
+
+def test_failed_writes_are_acknowledged_in_one_ndata(monkeypatch):
+    node, published = online_node(monkeypatch)
+    a, b, c = (node.registry.by_name(name) for name in 'abc')
+    send_command(node, [('a', 500), ('b', 600), ('c', 7)])
+    assert [topic for topic, _ in published] == [node.topics.NDATA, node.topics.NDATA]
+    ack, rbe = (decode(message) for _, message in published)
+    assert write_results(ack) == [(a.alias, 1, False), (b.alias, 1, False)]  # their values did not change
+    assert write_results(rbe) == [(c.alias, 7, None)]
+    assert (ack.seq, rbe.seq) == (1, 2)
+
+
+def test_later_successful_write_cancels_the_failure(monkeypatch):
+    node, published = online_node(monkeypatch)
+    a = node.registry.by_name('a')
+    send_command(node, [('a', 500), ('a', 50)])
+    assert len(published) == 1
+    assert write_results(decode(published[0][1])) == [(a.alias, 50, None)]
+
+    send_command(node, [('a', 60), ('a', 500)])  # the last write failed
+    ack, rbe = (decode(message) for _, message in published[1:])
+    assert write_results(ack) == [(a.alias, 50, False)]  # the value of the last scan, the RBE of the writes follows
+    assert write_results(rbe) == [(a.alias, 60, None)]
+
+
+def test_failed_dcmd_write_is_acknowledged_in_one_ddata(monkeypatch):
+    node, published = online_node(monkeypatch, devices=True)
+    device = node.devices['d1']
+    send_command(node, [('b', 500)], device_id='d1')
+    assert [topic for topic, _ in published] == [device.topics.DDATA]
+    assert write_results(decode(published[0][1])) == [(device.registry.by_name('b').alias, 1, False)]
+    assert node.registry.by_name('b').current_value == 1
+
+
+def test_rebirth_on_write_failure(monkeypatch):
+    node, published = online_node(monkeypatch, devices=True, rebirth_on_write_failure=True)
+    send_command(node, [('a', 500)])
+    assert [topic.split('/')[2] for topic, _ in published] == ['NBIRTH', 'DBIRTH']
+    assert decode(published[0][1]).seq == 0
+
+    del published[:]
+    send_command(node, [('c', 500)], device_id='d1')
+    assert [topic for topic, _ in published] == [node.devices['d1'].topics.DBIRTH]
+
+
+def test_rebirth_command(monkeypatch):
+    node, published = online_node(monkeypatch)
+    send_command(node, [('Node Control/Rebirth', True)])
+    assert [topic.split('/')[2] for topic, _ in published] == ['NBIRTH']
+    send_command(node, [('Node Control/Rebirth', False)])
+    assert len(published) == 1